@@ -1,6 +1,10 @@
+import io
 import os
+import select
 import requests
 import json
+from http.client import HTTPConnection, HTTPSConnection, parse_headers
+from urllib.parse import urlsplit
 from sqlalchemy import desc
 from hashkernel.bakery import RemoteError, Cake, Content
 from hashstore.bakery.lite.node import ContentAddress
@@ -16,6 +20,81 @@ import logging
 log = logging.getLogger(__name__)
 
 
+# uploads smaller then that are posted without waiting for server
+# to tell if content is already there
+EXPECT_MIN_SIZE = 1 << 20
+
+# seconds that upload waits for server before it gives up
+UPLOAD_TIMEOUT = 60.0
+
+
+def _read_head(fp):
+    '''
+    :return: status and headers of response
+    '''
+    status = int(fp.readline().split()[1])
+    return status, parse_headers(fp)
+
+
+def post_expecting_continue(url, headers, fp, chunk_size=65355,
+                            wait=1.0, context=None,
+                            timeout=UPLOAD_TIMEOUT):
+    '''
+    POST content of `fp` with `Expect: 100-continue`, so server could
+    answer before body is sent. Body is sent in chunked encoding
+    after `100 Continue`, or when server did not answer in `wait`
+    seconds.
+
+    :param context: `ssl.SSLContext` of https connection
+    :param timeout: seconds that connect and every send or receive
+                    could block, `socket.timeout` is raised after
+    :return: status and text of response
+    '''
+    parts = urlsplit(url)
+    if parts.scheme == 'https':
+        conn = HTTPSConnection(parts.netloc, timeout=timeout,
+                               context=context)
+    else:
+        conn = HTTPConnection(parts.netloc, timeout=timeout)
+    try:
+        conn.putrequest('POST', parts.path or '/')
+        for k, v in headers.items():
+            conn.putheader(k, v)
+        conn.putheader('Expect', '100-continue')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        ready, _, _ = select.select([conn.sock], [], [], wait)
+        if ready:
+            # unbuffered, so nothing past interim response is read
+            raw = conn.sock.makefile('rb', buffering=0)
+            status, response_headers = _read_head(raw)
+            if status != 100:
+                length = response_headers.get('Content-Length')
+                body = io.BufferedReader(raw)
+                body = body.read() if length is None \
+                    else body.read(int(length))
+                return status, body.decode()
+        try:
+            while True:
+                buf = fp.read(chunk_size)
+                conn.send(b'%x\r\n%s\r\n' % (len(buf), buf))
+                if len(buf) == 0:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # server answered without reading body
+        r = conn.getresponse()
+        return r.status, r.read().decode()
+    finally:
+        conn.close()
+
+
+def _upload_size(fp):
+    try:
+        return os.fstat(fp.fileno()).st_size - fp.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
 class CakeClient:
     def __init__(self, home_dir = None):
         if home_dir is None:
@@ -68,8 +147,10 @@ class CakeClient:
 
 
 class ClientUserSession:
-    def __init__(self, client, url, session_id=None):
+    def __init__(self, client, url, session_id=None,
+                 upload_timeout=UPLOAD_TIMEOUT):
         self.url = normalize_url(url)
+        self.upload_timeout = upload_timeout
         resp = requests.get(self.url+'-/server_id')
         self.server_id, self.server_secret = (
             t.ensure_it(s) for t,s in
@@ -80,11 +161,31 @@ class ClientUserSession:
         self.init_headers()
 
         class AccessProxy:
-            def write_content(_, fp):
-                r = requests.post(self.url + '-/api/up',
-                                  headers=self.headers, data=fp)
-                log.debug('text: {r.text}'.format(**locals()))
-                return ContentAddress.ensure_it(json_decode(r.text))
+            def write_content(_, fp, expected=None):
+                '''
+                :param expected: cake of content, if server has it
+                                 already `fp` is not sent. Only
+                                 checked for uploads of at least
+                                 `EXPECT_MIN_SIZE` or of unknown
+                                 size, waiting for server costs
+                                 more then sending small file.
+                '''
+                url = self.url + '-/api/up'
+                size = _upload_size(fp)
+                if expected is None or expected.has_data() or \
+                        (size is not None and size < EXPECT_MIN_SIZE):
+                    text = requests.post(url, headers=self.headers,
+                                         data=fp,
+                                         timeout=self.upload_timeout).text
+                else:
+                    headers = dict(self.headers,
+                                   ExpectedCake=str(expected))
+                    status, text = post_expecting_continue(
+                        url, headers, fp, timeout=self.upload_timeout)
+                    if status not in (200, 409):
+                        raise RemoteError(f'{status}: {text}')
+                log.debug('text: {text}'.format(**locals()))
+                return ContentAddress.ensure_it(json_decode(text))
 
             def get_content(_, cake_or_path, skinny=True):
                 if isinstance(cake_or_path, Cake):
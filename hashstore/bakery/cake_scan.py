@@ -8,6 +8,7 @@ from hashkernel.bakery import (
     Cake, process_stream, CakeRack, CakePath)
 from hashstore.bakery.lite.client import (
     ScanBase, DirEntry, DirKey, FileType)
+from hashstore.bakery.lite.node.contents import STREAMED_CONTENT
 from sqlalchemy import desc
 from hashstore.utils.db import Dbf
 
@@ -272,7 +273,7 @@ def backup(scan_path, access):
                 name = dir_scan.bundle.get_name_by_cake(h)
                 file = os.path.join(dir_scan.path.fs_path, name)
                 fp = open(file, 'rb')
-                stored = access.write_content(fp)
+                stored = access.write_content(fp, expected=h)
                 if not stored.match(h):
                     log.info('path:%s, %s != %s' % (file, h, stored))
                     dir_scan.bundle[name] = Cake(stored.hash_bytes(),
@@ -310,10 +311,15 @@ def pull(store, cakepath, path):
                 file_cake = bundle[child_name]
                 try:
                     out_fp = open(file_path, "wb")
-                    in_fp = store.get_content(file_cake).stream()
-                    for chunk in read_in_chunks(in_fp):
-                        out_fp.write(chunk)
-                    in_fp.close()
+                    content = store.get_content(file_cake)
+                    if isinstance(content, STREAMED_CONTENT):
+                        for chunk in content.chunks():
+                            out_fp.write(chunk)
+                    else:
+                        in_fp = content.stream()
+                        for chunk in read_in_chunks(in_fp):
+                            out_fp.write(chunk)
+                        in_fp.close()
                     out_fp.close()
                 except:
                     reraise_with_msg( "%s -> %s" % (file_cake, file_path))
@@ -2,22 +2,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import requests
+import inspect
 import os
+import re
 import time
 import signal
+import threading
+from hashstore.bakery.lite.node import ContentAddress
 from hashstore.bakery.lite.node.access import (
     StoreContext, GuestAccess, FROM_COOKIE)
+from hashstore.bakery.lite.node.aio import AsyncBlobStore
+from hashstore.bakery.lite.node.contents import STREAMED_CONTENT
+from hashstore.bakery.lite.node.reshard import ShardMigration
 from hashkernel import (
     exception_message, utf8_encode, json_encode, json_decode,
     utf8_decode, ensure_bytes)
 from hashkernel.hashing import SaltedSha
 from hashkernel.bakery import (
-    cake_or_path, NotAuthorizedError, Content, PathInfo)
+    cake_or_path, NotAuthorizedError, Content, PathInfo, Cake)
 import tornado.web
 import tornado.template
 import tornado.ioloop
 import tornado.httpserver
-import tornado.gen as gen
 from tornado.iostream import PipeIOStream
 import logging
 
@@ -25,10 +31,61 @@ log = logging.getLogger(__name__)
 
 GIGABYTE = pow(1024, 3)
 
+# how often server checks if migration of blob shards was started
+RESHARD_POLL_SECONDS = 5
+
+BYTE_RANGE = re.compile(r'\s*bytes\s*=\s*(\d*)-(\d*)\s*$')
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def byte_range(header, size):
+    '''
+    Single range of bytes requested by `Range` header as
+    `(start, stop)`, other ranges are ignored.
+
+    >>> byte_range('bytes=0-99', 1000), byte_range('bytes=900-', 1000)
+    ((0, 100), (900, 1000))
+    >>> byte_range('bytes=-100', 1000), byte_range('bytes=5-5000', 1000)
+    ((900, 1000), (5, 1000))
+    >>> byte_range('bytes=0-1,5-6', 1000), byte_range('lines=0-1', 1000)
+    (None, None)
+    >>> byte_range('bytes=1000-', 1000)
+    Traceback (most recent call last):
+    ...
+    hashstore.bakery.cake_server.RangeNotSatisfiable: bytes=1000- of 1000
+
+    :return: `None` if whole content has to be sent
+    :raise RangeNotSatisfiable: if range is outside of content
+    '''
+    m = BYTE_RANGE.match(header)
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first == '':
+        if last == '':
+            return None
+        start, stop = max(size - int(last), 0), size
+        if int(last) == 0:
+            start = size
+    else:
+        start = int(first)
+        stop = size
+        if last != '':
+            if int(last) < start:
+                return None
+            stop = min(int(last) + 1, size)
+    if start >= size:
+        raise RangeNotSatisfiable(f'{header} of {size}')
+    return start, stop
+
 
 class _StoreAccessMixin:
-    def initialize(self, store):
+    def initialize(self, store, blobs):
         self.store = store
+        self.blobs = blobs
         self._ctx = None
 
         session_id = self.request.headers.get('UserSession')
@@ -64,21 +121,43 @@ class _StoreAccessMixin:
 
 
 class _ContentHandler(tornado.web.RequestHandler):
+    '''
+    Serves `Content`. Content that is not piped from file is served
+    in parts as well: single range of `Range` header is answered
+    with 206, `If-Range` is compared to `Etag` set by `content()`.
+    '''
     SUPPORTED_METHODS = ['GET']
 
     @tornado.web.asynchronous
-    @gen.coroutine
-    def get(self, path):
+    async def get(self, path):
         try:
             content = self.content(path)
+            if inspect.isawaitable(content):
+                content = await content
             self.set_header('Content-Type', content.mime)
-            if content.has_file() and os.name != 'nt':
+            if isinstance(content, STREAMED_CONTENT):
+                size = content.size
+                start, stop = self._range(size)
+                self.set_header('Content-Length', stop - start)
+                self.flush()
+                async for chunk in self.blobs.chunks(content, start=start,
+                                                     stop=stop):
+                    await self.request.connection.write(chunk)
+                self.finish()
+            elif content.has_file() and os.name != 'nt':
                 self.stream = PipeIOStream(content.open_fd())
                 self.stream.read_until_close(
                     callback=self.on_file_end,
                     streaming_callback=self.on_chunk)
             else:
-                self.finish(content.get_data())
+                data = content.get_data()
+                size = len(data)
+                start, stop = self._range(size)
+                self.finish(data[start:stop])
+        except RangeNotSatisfiable:
+            self.set_status(416)
+            self.set_header('Content-Range', f'bytes */{size}')
+            self.finish()
         except NotAuthorizedError:
             self.write(exception_message())
             self.send_error(403)
@@ -88,6 +167,28 @@ class _ContentHandler(tornado.web.RequestHandler):
             log.exception('error')
             self.send_error(500)
 
+    def _range(self, size):
+        '''
+        :return: `(start, stop)` of bytes to send, with status and
+                 headers of response set
+        '''
+        self.set_header('Accept-Ranges', 'bytes')
+        header = self.request.headers.get('Range')
+        if header is None:
+            return 0, size
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None and \
+                if_range != self._headers.get('Etag'):
+            return 0, size
+        requested = byte_range(header, size)
+        if requested is None:
+            return 0, size
+        start, stop = requested
+        self.set_status(206)
+        self.set_header('Content-Range',
+                        f'bytes {start}-{stop - 1}/{size}')
+        return start, stop
+
     def on_file_end(self, s):
         if s:
             self.write(s)
@@ -99,11 +200,18 @@ class _ContentHandler(tornado.web.RequestHandler):
 
 
 class GetCakeHandler(_StoreAccessMixin, _ContentHandler):
-    def content(self, path):
+    async def content(self, path):
         cake = cake_or_path(path[5:], relative_to_root=True)
         prefix = path[:5]
-        content = self.access.get_content(cake)
+        content = self.access.resolve_content(cake)
+        etag = None
+        if not isinstance(content, Content):
+            # content of cake never changes
+            etag = f'"{content}"'
+            content = await self.blobs.get_content(content)
         if 'data/' == prefix:
+            if etag is not None:
+                self.set_header('Etag', etag)
             return content
         elif 'info/' == prefix:
             return Content(
@@ -115,19 +223,52 @@ class GetCakeHandler(_StoreAccessMixin, _ContentHandler):
 
 @tornado.web.stream_request_body
 class StreamHandler(_StoreAccessMixin, tornado.web.RequestHandler):
+    '''
+    Upload of blob. Client that knows cake of content sends it in
+    `ExpectedCake` header: with `Expect: 100-continue` address of
+    blob that is already stored is returned before body is sent,
+    otherwise body is uploaded and checked against cake. Mismatch
+    is answered with 409 and address of uploaded content.
+    '''
     SUPPORTED_METHODS = ['POST']
 
-    def post(self):
-        k = self.w.done()
+    async def post(self):
+        k = await self.w.done()
         log.info('write_content: %s' % k)
+        if self.expected is not None and not k.match(self.expected):
+            self.set_status(409)
         self.write(json_encode(k))
         self.finish()
 
-    def prepare(self):
-        self.w = self.access.writer()
-
-    def data_received(self, chunk):
-        self.w.write(chunk)
+    async def prepare(self):
+        self.w = None
+        writer = self.access.writer()
+        self.expected = None
+        expected = self.request.headers.get('ExpectedCake')
+        if expected is not None:
+            try:
+                expected = Cake.ensure_it(expected)
+            except Exception:
+                log.debug(exception_message())
+                raise tornado.web.HTTPError(400)
+            if not expected.has_data():
+                self.expected = expected
+        if self.expected is not None and \
+                self.request.headers.get('Expect') == '100-continue':
+            lookup = await self.blobs.lookup(self.expected)
+            if lookup.found():
+                await self.blobs.run(self.blobs.store.confirm,
+                                     [self.expected])
+                k = ContentAddress(self.expected)
+                log.info('already stored: %s' % k)
+                self.finish(json_encode(k))
+                return
+        self.w = self.blobs.writer(writer)
+
+    async def data_received(self, chunk):
+        # body sent anyway after blob was found is dropped
+        if self.w is not None and not self._finished:
+            await self.w.write(chunk)
 
 
 class PostHandler(_StoreAccessMixin, tornado.web.RequestHandler):
@@ -157,10 +298,24 @@ def _string_handler(s):
 
 
 class CakeServer:
-    def __init__(self, store, max_file_size=20 * GIGABYTE):
+    def __init__(self, store, max_file_size=20 * GIGABYTE,
+                 io_threads=8):
         self.store = store
         self.config = self.store.server_config()
         self.max_file_size = max_file_size
+        self.io_threads = io_threads
+
+    def running_pid(self):
+        '''
+        :return: pid of server that listens on configured port or
+                 `None`
+        '''
+        try:
+            response = requests.get('http://localhost:%d/-/pid' %
+                                    (self.config.port,))
+            return int(response.content) or None
+        except (requests.RequestException, ValueError):
+            return None
 
     def shutdown(self, wait_until_down):
         try:
@@ -180,6 +335,12 @@ class CakeServer:
         except:
             pass
 
+    def _migrate_shards(self, migration):
+        try:
+            migration.run()
+        except Exception:
+            log.exception('migration of blob shards')
+
     def run_server(self):
 
         app_dir = os.path.join(os.path.dirname(__file__), 'app')
@@ -206,10 +367,19 @@ class CakeServer:
              str(SaltedSha.from_secret(str(self.config.secret))))
         )
 
-        store_ref = {'store': self.store}
+        blobs = AsyncBlobStore(self.store.blob_store(), self.io_threads)
+
+        class MetricsHandler(_ContentHandler):
+            def content(self, _):
+                return Content(
+                    data=utf8_encode(blobs.store.metrics.render()),
+                    mime='text/plain; version=0.0.4')
+
+        store_ref = {'store': self.store, 'blobs': blobs}
         handlers = [
             (r'/-/(pid)$', _string_handler(pid),),
             (r'/-/(server_id)$', _string_handler(server_id),),
+            (r'/-/(metrics)$', MetricsHandler,),
             (r'/-/api/up$', StreamHandler, store_ref),
             (r'/-/api/post$', PostHandler, store_ref),
             (r'/-/get/(.*)$', GetCakeHandler, store_ref),
@@ -225,5 +395,29 @@ class CakeServer:
         http_server.listen(self.config.port)
         logging.info('CakeServer({0.store.store_dir}) '
                      'listening=0.0.0.0:{0.config.port}'.format(self))
+        migration = ShardMigration(self.store)
+        migration_thread = None
+
+        def pick_up_migration():
+            nonlocal migration_thread
+            try:
+                pending = migration.pick_up()
+            except Exception:
+                log.exception('picking up migration of blob shards')
+                return
+            if pending and (migration_thread is None or
+                            not migration_thread.is_alive()):
+                migration_thread = threading.Thread(
+                    target=self._migrate_shards, args=(migration,),
+                    name='reshard', daemon=True)
+                migration_thread.start()
+        pick_up_migration()
+        tornado.ioloop.PeriodicCallback(
+            pick_up_migration, RESHARD_POLL_SECONDS * 1000).start()
         tornado.ioloop.IOLoop.instance().start()
+        if migration_thread is not None:
+            migration.stop()
+            migration_thread.join()
+        blobs.close()
+        self.store.close()
         logging.info('Finished')
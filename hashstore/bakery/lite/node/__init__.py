@@ -6,6 +6,7 @@ from sqlalchemy.orm import relationship
 from hashkernel.bakery import Cake
 from hashkernel import Stringable, EnsureIt
 from hashstore.utils.db import StringCast, IntCast
+from hashstore.utils.compress import Codec
 from hashstore.bakery.lite.mixins import (
     ReprIt, NameIt, Cdt, Udt, CakePk,  PortalPkWithSynapseDefault,
     ServersMixin, Singleton)
@@ -46,6 +47,8 @@ class ContentAddress(Stringable, EnsureIt):
     '21EUi09ZvZAelgu02ANS9dSpK9oPsERF0uSpfEEZcdMx'
     >>> from_id.match(a47)
     False
+    >>> from_id.shard_name, from_id.shard(8192), from_id.shard(16)
+    ('18j', '18j', '3')
     """
 
     def __init__(self, h: Union[HashBytes, str])->None:
@@ -58,6 +61,14 @@ class ContentAddress(Stringable, EnsureIt):
         shard_n = shard_num(self._hash_bytes, MAX_NUM_OF_SHARDS)
         self.shard_name = shard_name_int(shard_n)
 
+    def shard(self, num_shards: int)->str:
+        '''
+        name of shard of address in store of `num_shards` shards
+        '''
+        if num_shards == MAX_NUM_OF_SHARDS:
+            return self.shard_name
+        return shard_name_int(shard_num(self._hash_bytes, num_shards))
+
     def __str__(self):
         return self._id
 
@@ -88,9 +99,45 @@ BlobBase:Any = declarative_base(name='BlobBase')
 
 
 class Blob(NameIt, ReprIt, Cdt, BlobBase):
-    blob_id = Column(Integer, primary_key=True, autoincrement=True)
-    file_id = Column(StringCast(ContentAddress), nullable=False)
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
     content = Column(LargeBinary)
+    codec = Column(IntCast(Codec), nullable=True)
+    size = Column(Integer, nullable=True)
+
+
+class PackEntry(NameIt, ReprIt, Cdt, BlobBase):
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    pack_id = Column(String, nullable=False, index=True)
+    offset = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+
+
+class Manifest(NameIt, ReprIt, Cdt, BlobBase):
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    size = Column(Integer, nullable=False)
+    chunks = Column(LargeBinary, nullable=False)
+
+
+class ColdEntry(NameIt, ReprIt, Cdt, BlobBase):
+    '''
+    blob that was demoted from hot tier into cold one
+    '''
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    size = Column(Integer, nullable=False)
+
+
+class BlobAccess(NameIt, ReprIt, BlobBase):
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    accessed_dt = Column(DateTime, nullable=False)
+
+
+class BlobConfirm(NameIt, ReprIt, BlobBase):
+    '''
+    blob that was confirmed to writer while garbage collection
+    was in progress
+    '''
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    confirmed_dt = Column(DateTime, nullable=False)
 
 
 blob_meta = BlobBase.metadata
@@ -99,19 +146,86 @@ blob_meta = BlobBase.metadata
 blob = Blob.__table__
 
 
-IncomingBase:Any = declarative_base(name='IncomingBase')
+pack_entry = PackEntry.__table__
+
+
+manifest = Manifest.__table__
+
+
+cold_entry = ColdEntry.__table__
+
+
+blob_access = BlobAccess.__table__
+
+
+blob_confirm = BlobConfirm.__table__
+
+#--- gc
+
+GcBase:Any = declarative_base(name='GcBase')
+
+
+class GcState(NameIt, ReprIt, GcBase):
+    single = Column(Integer, primary_key=True, default=1)
+    phase = Column(String, nullable=False)
+    cursor = Column(Integer, nullable=False, default=0)
+    started_dt = Column(DateTime, nullable=False)
+    retain_since_dt = Column(DateTime, nullable=False)
+    remarked_dt = Column(DateTime, nullable=False)
+    finished_dt = Column(DateTime, nullable=True)
+    marked = Column(Integer, nullable=False, default=0)
+    swept = Column(Integer, nullable=False, default=0)
+
+
+class GcMark(NameIt, GcBase):
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+
+
+class GcQueue(NameIt, GcBase):
+    cake = Column(StringCast(Cake), primary_key=True)
+
+
+gc_state = GcState.__table__
+
+
+gc_mark = GcMark.__table__
+
+
+gc_queue = GcQueue.__table__
+
+#--- scrub
+
+ScrubBase:Any = declarative_base(name='ScrubBase')
+
+
+class ScrubState(NameIt, ReprIt, ScrubBase):
+    single = Column(Integer, primary_key=True, default=1)
+    pass_no = Column(Integer, nullable=False)
+    started_dt = Column(DateTime, nullable=False)
+    finished_dt = Column(DateTime, nullable=True)
+    checked = Column(Integer, nullable=False, default=0)
+    checked_bytes = Column(Integer, nullable=False, default=0)
+    corrupt = Column(Integer, nullable=False, default=0)
+
+
+class ScrubShard(NameIt, ScrubBase):
+    shard_name = Column(String, primary_key=True)
+    pass_no = Column(Integer, nullable=False)
+
+
+class ScrubCorrupt(NameIt, ReprIt, Cdt, ScrubBase):
+    file_id = Column(StringCast(ContentAddress), primary_key=True)
+    location = Column(String, primary_key=True)
+    path = Column(String, nullable=False)
 
 
-class Incoming(NameIt, ReprIt, Cdt, Udt, IncomingBase):
-    incoming_id = Column(Integer, primary_key=True, autoincrement=True)
-    file_id = Column(StringCast(ContentAddress), nullable=True)
-    new = Column(Boolean)
+scrub_state = ScrubState.__table__
 
 
-incoming = Incoming.__table__
+scrub_shard = ScrubShard.__table__
 
 
-incoming_meta = IncomingBase.metadata
+scrub_corrupt = ScrubCorrupt.__table__
 
 #--- cake_shard
 
@@ -379,6 +493,10 @@ class ServerKey(Singleton, ServerConfigBase):
     external_ip = Column(StringCast(InetAddress), nullable=True)
     port = Column(Integer, nullable=False)
     num_cake_shards = Column(Integer, nullable=False)
+    num_blob_shards = Column(Integer, nullable=True)
+    prev_num_blob_shards = Column(Integer, nullable=True)
+    blob_shards_migrated = Column(Integer, nullable=True)
+    cold_blob_dir = Column(String, nullable=True)
 
 
 class UserSession(PortalPkWithSynapseDefault, NameIt, Cdt, Udt,
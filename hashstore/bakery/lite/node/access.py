@@ -20,7 +20,7 @@ from hashstore.bakery.lite.node import (
 )
 
 from hashstore.bakery.lite.node import (
-    Portal, VolatileTree
+    Portal, VolatileTree, ContentAddress
 )
 
 import logging
@@ -157,6 +157,19 @@ class GuestAccess:
             to be check on all portals in redirect chain. redirect chain
             cannot be longer then 10.
         '''
+        content = self.resolve_content(cake_or_path)
+        if isinstance(content, Content):
+            return content
+        return self.blob_store().get_content(content)
+
+    def resolve_content(self, cake_or_path):
+        '''
+        Same as `get_content()`, but content stored in `BlobStore`
+        is not read: permissions are checked and portals resolved,
+        and cake of blob is returned instead.
+
+        :return: `Content` or resolved `Cake`
+        '''
         if isinstance(cake_or_path, CakePath):
             return self.get_content_by_path(cake_or_path)
         cake = cake_or_path
@@ -165,7 +178,7 @@ class GuestAccess:
                 role=cake.header.role, data=cake.data())
         elif cake.is_resolved():
             self.authorize(cake_or_path, Permissions.read_data_cake)
-            return self.blob_store().get_content(cake_or_path)
+            return cake_or_path
         elif cake.header.type.is_portal:
             self.authorize(cake_or_path, Permissions.read_portal)
             if cake.header.type == CakeType.PORTAL :
@@ -173,7 +186,7 @@ class GuestAccess:
                     self.ctx.cake_session, cake_or_path)
                 for resolved_portal in resolution_stack[:-1]:
                     self.authorize(cake_or_path, Permissions.read_portal)
-                return self.blob_store().get_content(resolution_stack[-1])
+                return resolution_stack[-1]
             elif cake.header.type in [CakeType.DMOUNT, CakeType.VTREE]:
                 return self.get_content_by_path(CakePath(None, _root=cake, _path=[]))
         else:
@@ -250,11 +263,16 @@ class PrivilegedAccess(GuestAccess):
         self.authorize(None, Permissions.write_data)
         return self.blob_store().writer()
 
-    def write_content(self, fp, chunk_size=65355):
+    def write_content(self, fp, chunk_size=65355, expected=None):
         '''
-            Write content
+            Write content, unless blob of `expected` cake is
+            stored already
         '''
         w = self.writer()
+        if expected is not None and not expected.has_data() and \
+                self.blob_store().lookup(expected).found():
+            self.blob_store().confirm([expected])
+            return ContentAddress(expected)
         while True:
             buf = fp.read(chunk_size)
             if len(buf) == 0:
@@ -273,12 +291,16 @@ class PrivilegedAccess(GuestAccess):
         :return:
         '''
         self.authorize(None, Permissions.write_data)
+        # blobs of directory entries has to be committed before
+        # bundles that reference them
+        self.blob_store().flush()
         name2cakepath = tuple_mapper(
             CakePath.ensure_it_or_none,
             Cake.ensure_it,
             CakeRack.ensure_it)
         directories = map(name2cakepath, directories)
         unseen_cakes = set()
+        stored_cakes = set()
         dirs_stored = set()
         dirs_mismatch_input_cake = set()
 
@@ -287,15 +309,17 @@ class PrivilegedAccess(GuestAccess):
                 lookup = self.blob_store().lookup(dir_cake)
                 if not lookup.found():
                     w = self.blob_store().writer()
-                    w.write(bytes(dir_contents), done=True)
+                    w.write(bytes(dir_contents))
+                    w.done(flush=True)
                     lookup = self.blob_store().lookup(dir_cake)
                     if lookup.found():
                         dirs_stored.add(dir_cake)
                     else: # pragma: no cover
                         dirs_mismatch_input_cake.add(dir_cake)
+                else:
+                    self.blob_store().confirm([dir_cake])
             for file_name in dir_contents:
-                self._collect_unseen(dir_contents[file_name],
-                                     unseen_cakes)
+                stored_cakes.add(dir_contents[file_name])
 
         for cake_path, dir_cake, dir_contents in directories:
             if cake_path is None or cake_path.root is None \
@@ -322,13 +346,15 @@ class PrivilegedAccess(GuestAccess):
         if len(dirs_mismatch_input_cake) > 0: # pragma: no cover
             raise AssertionError('could not store directories: %r' %
                                  dirs_mismatch_input_cake)
+        unseen_cakes.update(self._filter_unseen(stored_cakes))
         return len(dirs_stored), list(unseen_cakes)
 
-    def _collect_unseen(self, cake, unseen_set):
-        if not cake.has_data():
-            lookup = self.blob_store().lookup(cake)
-            if not lookup.found():
-                unseen_set.add(cake)
+    def _filter_unseen(self, cakes):
+        sizes = self.blob_store().exists_many(
+            cake for cake in cakes if not cake.has_data())
+        self.blob_store().confirm(
+            cake for cake, size in sizes.items() if size is not None)
+        return {cake for cake, size in sizes.items() if size is None}
 
     def add_user(self, email, ssha_pwd, full_name = None):
         self.authorize(None, (PT.Admin,))
@@ -503,7 +529,7 @@ class PrivilegedAccess(GuestAccess):
         VT = VolatileTree
         if asof_dt is None:
             asof_dt = datetime.datetime.utcnow()
-        unseen_cakes = set()
+        added_cakes = set()
 
         def add_cake_to_vtree(action, cake_path, cake):
             if action == PatchAction.delete:
@@ -544,13 +570,13 @@ class PrivilegedAccess(GuestAccess):
                         start_by=self.auth_user.id,
                         cake=cake,
                         start_dt=asof_dt))
-                    self._collect_unseen(cake, unseen_cakes)
+                    added_cakes.add(cake)
                     dal.ensure_vtree_path(cake_session, parent, asof_dt,
                                           self.auth_user)
 
         for action, cake_path, cake in files:
             add_cake_to_vtree(action,cake_path,cake)
-        return list(unseen_cakes)
+        return list(self._filter_unseen(added_cakes))
 
     @user_api.call()
     def delete_in_portal_tree(self, cake_path, asof_dt = None):
@@ -0,0 +1,407 @@
+import os
+import mmap
+import time
+import uuid
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Iterable
+
+from hashkernel.hashing import B36
+from hashstore.utils.fio import ensure_directory, fsync_path
+from . import ContentAddress
+import logging
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+HASH_SIZE = 32
+RECORD_SIZE = HASH_SIZE + 1
+ADD, DISCARD = b'+', b'-'
+NUM_BUCKETS = 256
+
+
+class _SortedHashes:
+    '''
+    sorted array of hashes in memory mapped file, as sequence
+    '''
+    def __init__(self, path):
+        self.mm = None
+        self.count = 0
+        try:
+            with open(path, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size >= HASH_SIZE:
+                    self.mm = mmap.mmap(fp.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+                    self.count = size // HASH_SIZE
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.mm[i * HASH_SIZE:(i + 1) * HASH_SIZE]
+
+    def __contains__(self, h):
+        i = bisect_left(self, h)
+        return i < self.count and self[i] == h
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class _Bucket:
+    def __init__(self, key, base, delta):
+        self.key = key
+        self.base = base
+        # hash -> True if it was added after base was written,
+        # False if it was discarded
+        self.delta = delta
+
+    def __contains__(self, h):
+        present = self.delta.get(h)
+        if present is None:
+            return h in self.base
+        return present
+
+    def __iter__(self):
+        added = sorted(h for h, present in self.delta.items()
+                       if present)
+        i = 0
+        for h in self.base:
+            while i < len(added) and added[i] < h:
+                yield added[i]
+                i += 1
+            if i < len(added) and added[i] == h:
+                i += 1
+            if self.delta.get(h, True):
+                yield h
+        yield from added[i:]
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _replay(data, into):
+    for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        into[data[i + 1:i + RECORD_SIZE]] = data[i:i + 1] == ADD
+    return into
+
+
+class AddressIndex:
+    '''
+    Sorted set of addresses of all blobs in store, kept in `dir`.
+    Raw hashes are split into 256 buckets by their first byte, every
+    bucket is sorted array of hashes (`XX.idx`), memory mapped and
+    binary searched, and journal (`XX.log`) of additions and
+    removals made after array was written. Journal is appended by
+    writers of any process and merged into array when it grows over
+    quarter of array. Readers notice merges and appends by `stat()`
+    of journal and array, so index is shared by all processes that
+    use the store.
+
+    Index is trusted only when `complete`: it was built by
+    `rebuild()` from scan of store, and writers maintained it
+    since. Writers maintain index whenever `dir` exists, so every
+    blob stored after `rebuild()` started is either seen by scan or
+    journaled. Address is journaled before blob is stored: blob
+    that is not in index is taken as missing, so index may list
+    blobs that are not stored, but never miss one.
+
+    Appends to journal reach the disk by `persist(file, dirs)`
+    (`BlobStore.persist`, so as `Durability` of store says), and
+    on `close()`. While process writes journal it holds `flock` on
+    its `writer.*` marker, marker left by process that did not
+    close index means appends could be lost, and `check()` marks
+    index incomplete until it is rebuilt.
+    '''
+    def __init__(self, dir, min_merge=1024, persist=None):
+        self.dir = dir
+        self.min_merge = min_merge
+        self.persist = persist
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self._complete = None
+        self.writer_fd = None
+        self.writer_marker = None
+        self.journaled = set()
+
+    def exists(self):
+        return os.path.isdir(self.dir)
+
+    def _marker(self):
+        return os.path.join(self.dir, 'complete')
+
+    def complete(self):
+        '''
+        index covers whole store, answer is checked on disk at most
+        once a second
+        '''
+        now = time.monotonic()
+        if self._complete is None or self._complete[1] < now:
+            self._complete = (os.path.exists(self._marker()), now + 1)
+        return self._complete[0]
+
+    def _paths(self, b):
+        name = os.path.join(self.dir, '%02x' % b)
+        return name + '.idx', name + '.log'
+
+    def _bucket(self, b) -> _Bucket:
+        base_path, log_path = self._paths(b)
+        try:
+            log_size = os.path.getsize(log_path)
+        except FileNotFoundError:
+            log_size = None
+        with self.lock:
+            cached = self.buckets.get(b)
+        if cached is not None and cached.key[0] == log_size and \
+                cached.key[1] == _stat_key(base_path):
+            return cached
+        # journal is read before array, so entries merged from
+        # journal meanwhile are found in new array
+        data = b''
+        if log_size:
+            try:
+                with open(log_path, 'rb') as fp:
+                    data = fp.read(log_size)
+            except FileNotFoundError:
+                pass
+        bucket = _Bucket((log_size, _stat_key(base_path)),
+                         _SortedHashes(base_path), _replay(data, {}))
+        with self.lock:
+            # mapping of replaced bucket is closed on collect, it
+            # could be still in use by other thread
+            self.buckets[b] = bucket
+        return bucket
+
+    def __contains__(self, file_id):
+        h = file_id.hash_bytes()
+        return h in self._bucket(h[0])
+
+    def __iter__(self):
+        '''
+        addresses in order of their hashes
+        '''
+        for b in range(NUM_BUCKETS):
+            for h in self._bucket(b):
+                yield ContentAddress(B36.encode(h))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _hold_writer_marker(self):
+        with self.lock:
+            if self.writer_fd is not None or fcntl is None:
+                return
+            path = os.path.join(self.dir, f'writer.{uuid.uuid4().hex}')
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # marker has to outlive appends that are not synced
+            fsync_path(self.dir)
+            self.writer_fd, self.writer_marker = fd, path
+
+    def _journal(self, op, file_ids):
+        self._hold_writer_marker()
+        by_bucket = defaultdict(list)
+        for file_id in file_ids:
+            h = file_id.hash_bytes()
+            by_bucket[h[0]].append(h)
+        for b, hashes in by_bucket.items():
+            # records are appended even if they change nothing: array
+            # could be replaced by `rebuild()` meanwhile
+            records = [op + h for h in hashes]
+            _, log_path = self._paths(b)
+            created = not os.path.exists(log_path)
+            fd = os.open(log_path, os.O_WRONLY | os.O_APPEND |
+                         os.O_CREAT)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                os.write(fd, b''.join(records))
+                if self.persist is None:
+                    os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            with self.lock:
+                self.journaled.add(log_path)
+            if self.persist is None:
+                if created:
+                    fsync_path(self.dir)
+            else:
+                self.persist(log_path, (self.dir,) if created else ())
+            if size // RECORD_SIZE > max(self.min_merge,
+                                         len(self._bucket(b).base) // 4):
+                self.merge(b)
+
+    def add(self, file_ids: Iterable[ContentAddress]):
+        '''
+        record stored blobs, if index exists
+        '''
+        if self.exists():
+            self._journal(ADD, file_ids)
+
+    def discard(self, file_ids: Iterable[ContentAddress]):
+        '''
+        record removed blobs, if index exists
+        '''
+        if self.exists():
+            self._journal(DISCARD, file_ids)
+
+    def merge(self, b, base=None):
+        '''
+        Merge journal of bucket `b` into its sorted array, other
+        writers wait for merge to finish.
+
+        :param base: hashes to replace current array with
+        '''
+        if fcntl is None:  # pragma: no cover
+            return
+        base_path, log_path = self._paths(b)
+        fd = os.open(log_path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            data = os.read(fd, size)
+            if base is None:
+                current = _SortedHashes(base_path)
+                base = set(current)
+                current.close()
+            for h, present in _replay(data, {}).items():
+                if present:
+                    base.add(h)
+                else:
+                    base.discard(h)
+            tmp = base_path + '.tmp'
+            with open(tmp, 'wb') as fp:
+                fp.write(b''.join(sorted(base)))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, base_path)
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+    def rebuild(self, file_ids: Iterable[ContentAddress]):
+        '''
+        Build index from addresses of all blobs in store. Journal
+        is created before `file_ids` are consumed, so blobs stored
+        or removed meanwhile are accounted for.
+
+        :return: number of indexed addresses
+        '''
+        ensure_directory(self.dir)
+        try:
+            os.remove(self._marker())
+        except FileNotFoundError:
+            pass
+        self._complete = None
+        hashes = defaultdict(set)
+        for file_id in file_ids:
+            h = file_id.hash_bytes()
+            hashes[h[0]].add(h)
+        for b in range(NUM_BUCKETS):
+            self.merge(b, hashes.get(b, set()))
+        with open(self._marker(), 'w'):
+            pass
+        self._complete = None
+        count = len(self)
+        log.info(f'address index built with {count} addresses')
+        return count
+
+    def check(self):
+        '''
+        Journal with torn record (writer crashed in the middle of
+        append) cannot be trusted, index is marked incomplete until
+        it is rebuilt.
+
+        Same is true for journal appended by process that did not
+        close index.
+
+        :return: `True` if index is complete
+        '''
+        trusted = True
+        for b in range(NUM_BUCKETS):
+            try:
+                size = os.path.getsize(self._paths(b)[1])
+            except FileNotFoundError:
+                continue
+            if size % RECORD_SIZE:
+                log.warning(f'torn journal of address index bucket '
+                            f'{b:02x}, index has to be rebuilt')
+                trusted = False
+                break
+        for name in os.listdir(self.dir):
+            if name.startswith('writer.') and self._abandoned(name):
+                log.warning(f'writer of address index did not close '
+                            f'it, index has to be rebuilt')
+                trusted = False
+        if not trusted:
+            try:
+                os.remove(self._marker())
+            except FileNotFoundError:
+                pass
+        self._complete = None
+        return self.complete()
+
+    def _abandoned(self, name):
+        '''
+        removes marker of writer that is gone
+
+        :return: `True` if marker was abandoned
+        '''
+        if fcntl is None:  # pragma: no cover
+            return False
+        path = os.path.join(self.dir, name)
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False  # writer is alive
+            os.remove(path)
+            return True
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            buckets = list(self.buckets.values())
+            self.buckets.clear()
+            journaled, self.journaled = self.journaled, set()
+            fd, self.writer_fd = self.writer_fd, None
+        for bucket in buckets:
+            bucket.base.close()
+        if fd is None:
+            return
+        for path in journaled:
+            try:
+                fsync_path(path)
+            except FileNotFoundError:
+                pass
+        fsync_path(self.dir)
+        os.remove(self.writer_marker)
+        os.close(fd)
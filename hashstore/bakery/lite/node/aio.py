@@ -0,0 +1,100 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+from hashkernel.bakery import Cake, CakeRole, Content
+from . import ContentAddress
+from .contents import STREAMED_CONTENT, content_chunks
+
+_END = object()
+
+
+class AsyncBlobStore:
+    '''
+    asyncio facade of `BlobStore`: blocking calls (SQLite queries,
+    file io, moving of uploaded files) run in pool of `max_workers`
+    threads, so event loop never waits for disk. Calls beyond
+    `max_workers` wait in queue of pool. Blobs that are in cache of
+    `BlobStore` are served without leaving event loop.
+    '''
+    def __init__(self, store, max_workers=8):
+        self.store = store
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='blob-io')
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        :return: future of `fn(*args, **kwargs)` called in pool
+        '''
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    def _cached(self, k):
+        file_id = ContentAddress.ensure_it(k)
+        lookup = self.store.cache_lookup_factory(self.store, file_id)
+        return lookup if lookup.found() else None
+
+    async def lookup(self, k: Union[Cake, ContentAddress]):
+        cached = self._cached(k)
+        if cached is not None:
+            return cached
+        return await self.run(self.store.lookup, k)
+
+    async def get_content(self, k: Union[Cake, ContentAddress])->Content:
+        cached = self._cached(k)
+        if cached is not None:
+            role = k.header.role if isinstance(k, Cake) \
+                else CakeRole.SYNAPSE
+            return cached.content(role)
+        return await self.run(self.store.get_content, k)
+
+    async def exists_many(self, keys):
+        return await self.run(self.store.exists_many, keys)
+
+    async def flush(self):
+        await self.run(self.store.flush)
+
+    async def chunks(self, content: Content, chunk_size=1 << 20,
+                     start=0, stop=None):
+        '''
+        async iterator over bytes `start:stop` of content, chunks of
+        `STREAMED_CONTENT` are read in pool
+        '''
+        chunks = content_chunks(content, chunk_size, start, stop)
+        if not isinstance(content, STREAMED_CONTENT):
+            for chunk in chunks:
+                yield chunk
+            return
+        while True:
+            chunk = await self.run(next, chunks, _END)
+            if chunk is _END:
+                return
+            yield chunk
+
+    def writer(self, writer=None):
+        '''
+        :param writer: `ContentWriter` to drive, new one by default
+        '''
+        if writer is None:
+            writer = self.store.writer()
+        return AsyncContentWriter(self, writer)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncContentWriter:
+    '''
+    `ContentWriter` driven from event loop, every call has to be
+    awaited before next one is made
+    '''
+    def __init__(self, blobs, writer):
+        self.blobs = blobs
+        self.writer = writer
+
+    async def write(self, content, done=False):
+        return await self.blobs.run(self.writer.write, content, done)
+
+    async def done(self, flush=False)->ContentAddress:
+        return await self.blobs.run(self.writer.done, flush)
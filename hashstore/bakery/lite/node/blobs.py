@@ -1,18 +1,36 @@
 import os
+import time
 import shutil
+import tempfile
 import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from typing import Union
 
-import pylru
-from hashstore.utils.db import Dbf
-from hashstore.utils.fio import ensure_directory
-from hashkernel.hashing import (is_it_shard, Hasher)
-from sqlalchemy import func, select
+from hashstore.utils.bloom import BloomFilter
+from hashstore.utils.chunking import Chunker
+from hashstore.utils.cache import BlobCache
+from hashstore.utils.compress import (
+    Codec, compress_if_worth, worth_compressing, pack_header,
+    read_header, logical_size, MAGIC, SAMPLE_SIZE)
+from hashstore.utils.fio import ensure_directory, fsync_path
+from hashstore.utils.metrics import Metrics
+from hashkernel.hashing import is_it_shard, Hasher
+from sqlalchemy import (func, select, event, and_, or_, union,
+                        union_all, column, case)
 from hashkernel.bakery import (NotFoundError, CakeRole,
                               Content, Cake)
-from . import (blob_meta, blob,
-               incoming_meta, incoming,
-               ContentAddress, MAX_NUM_OF_SHARDS)
+from . import (blob, pack_entry, manifest, cold_entry, blob_access,
+               blob_confirm, ContentAddress, MAX_NUM_OF_SHARDS)
+from .packs import Packs
+from .addresses import AddressIndex
+from .shards import FilePresence, ShardPool
+from .commit import GroupCommit, InFlightWrites
+from .durability import Durability, SyncBatch
+from .contents import (MappedContent, CompressedContent, ChunkedContent,
+                       DbContent, STREAMED_CONTENT, content_chunks,
+                       pack_manifest, parse_manifest)
 import logging
 
 
@@ -20,6 +38,9 @@ log = logging.getLogger(__name__)
 
 
 class Lookup:
+    # where blob was found, label of metrics
+    tier = 'miss'
+
     def __init__(self, store, file_id):
         self.size = None
         self.created_dt = None
@@ -36,22 +57,47 @@ class Lookup:
         content = self._content(role)
         content.size = self.size
         content.created_dt = self.created_dt
+        self.store.metrics.read_bytes.inc(self.size, tier=self.tier)
+        if self.store.tier_keeper is not None:
+            self.store.tier_keeper.touch(self.file_id)
         return content
 
 
 NULL_LOOKUP = Lookup(None, None)
 
 
+class PendingLookup(Lookup):
+    tier = 'pending'
+
+    def __init__(self, store, file_id, data):
+        Lookup.__init__(self, store, file_id)
+        self.size = len(data)
+        self.data = data
+
+    def _content(self, role: CakeRole)->Content:
+        return Content.from_data_and_role(
+            role=role, data=self.data)
+
+
 class ContentAddressLookup(Lookup):
-    def __init__(self, store, file_id):
+    '''
+    Lookup in shard of `file_id`, or in `shard_name` when blob is
+    looked for at its location in previous layout of shards
+    '''
+    def __init__(self, store, file_id, shard_name=None):
         Lookup.__init__(self,store,file_id)
-        self.dir = os.path.join(store.root, self.file_id.shard_name)
+        if shard_name is None:
+            shard_name = store.shard_name(file_id)
+        self.shard_name = shard_name
+        self.dir = os.path.join(store.root, shard_name)
 
     def blob_db(self):
-        return self.store.blob_dbf(self.file_id.shard_name)
+        return self.store.blob_dbf(self.shard_name)
 
 
 class CacheLookup(Lookup):
+    tier = 'cache'
+
     def __init__(self, lookup, data):
         Lookup.__init__(self, lookup.store, lookup.file_id)
         self.size = lookup.size
@@ -65,84 +111,629 @@ class CacheLookup(Lookup):
 
 
 class DbLookup(ContentAddressLookup):
-    def __init__(self, store, file_id):
-        ContentAddressLookup.__init__(self,store,file_id)
-        blob_db = self.blob_db()
-        if blob_db.exists():
-            q = select([
-                    func.char_length(blob.c.content).label('size'),
-                    blob.c.created_dt
-                ]).where(blob.c.file_id == self.file_id)
-            result = blob_db.execute(q).fetchall()
-            if len(result) == 1:
-                self.size = result[0].size
-                self.created_dt = result[0].created_dt
-            elif len(result) != 0:
-                raise AssertionError('PK?: %r' % self.file_id)
+    '''
+    Lookup in `blob` table. Metadata comes from `size` column, so
+    content is not read unless `fetch` is set: then metadata and
+    content are selected by one statement, for callers that are
+    going to read content anyway. Uncompressed blobs of
+    `DB_STREAM_MIN_SIZE` or bigger are not selected, but streamed
+    as `DbContent`.
+    '''
+    tier = 'db'
+
+    def __init__(self, store, file_id, shard_name=None, fetch=False):
+        ContentAddressLookup.__init__(self, store, file_id, shard_name)
+        self.data = None
+        self.fetched = False
+        with self.blob_db() as blob_db:
+            if blob_db.exists():
+                row = blob_db.execute(self._select(fetch)).first()
+                if row is not None:
+                    self.size = row.size
+                    self.created_dt = row.created_dt
+                    if fetch:
+                        self._fetched(row)
+
+    def _select(self, fetch):
+        columns = [blob.c.size, blob.c.created_dt]
+        if fetch:
+            columns += [blob.c.codec, case([(
+                or_(blob.c.codec != None,
+                    blob.c.size < DB_STREAM_MIN_SIZE),
+                blob.c.content)]).label('content')]
+        return select(columns).where(blob.c.file_id == self.file_id)
+
+    def _fetched(self, row):
+        self.fetched = True
+        if row.content is None:
+            return
+        if row.codec is None:
+            self.data = row.content
+        else:
+            self.data = row.codec.decompress(row.content)
 
     def save_content(self, content):
-        blob_db = self.blob_db()
         if not self.found():
             ensure_directory(self.dir)
-            blob_db.ensure_db()
-            blob_db.execute(blob.insert().values(
-                    content = content,
-                    file_id = self.file_id ))
+            with self.blob_db() as blob_db:
+                blob_db.ensure_db()
+                # concurrent writer may store same blob first
+                blob_db.execute(
+                    blob.insert().prefix_with('OR IGNORE')
+                    .values(**self.store.blob_row(self.file_id,
+                                                  content)))
             return True
         else:
             return False
 
     def _content(self, role: CakeRole)->Content:
-        row = self.blob_db().execute(
-            select([blob.c.content])
-            .where(blob.c.file_id == self.file_id)).fetchone()
+        if not self.fetched:
+            with self.blob_db() as blob_db:
+                row = blob_db.execute(self._select(True)).first()
+            if row is None:
+                raise NotFoundError(self.file_id)
+            self._fetched(row)
+        data = self.data
+        if data is None:
+            return DbContent.from_lookup(self, role)
         if self.size < self.store.cached_max_size:
-            return CacheLookup(self, row.content)._content(role)
-        return Content.from_data_and_role(
-            role=role, data=row.content)
+            return CacheLookup(self, data)._content(role)
+        return Content.from_data_and_role(role=role, data=data)
+
+
+class PackLookup(ContentAddressLookup):
+    tier = 'pack'
+
+    def __init__(self, store, file_id, shard_name=None):
+        ContentAddressLookup.__init__(self, store, file_id, shard_name)
+        self.pack_id = None
+        self.offset = None
+        self._locate()
+
+    def _locate(self):
+        with self.blob_db() as blob_db:
+            if blob_db.exists():
+                row = blob_db.execute(select([
+                        pack_entry.c.pack_id,
+                        pack_entry.c.offset,
+                        pack_entry.c.size,
+                        pack_entry.c.created_dt
+                    ]).where(pack_entry.c.file_id == self.file_id)
+                ).first()
+                if row is not None:
+                    self.pack_id = row.pack_id
+                    self.offset = row.offset
+                    self.size = row.size
+                    self.created_dt = row.created_dt
+
+    def save_content(self, content):
+        if not self.found():
+            pack_id, offset = self.store.packs.append(content)
+            self.store.persist(self.store.packs.path(pack_id),
+                               (self.store.packs.dir,))
+            ensure_directory(self.dir)
+            with self.blob_db() as blob_db:
+                blob_db.ensure_db()
+                # concurrent writer may pack same blob first,
+                # then bytes appended here are reclaimed by repack
+                blob_db.execute(
+                    pack_entry.insert().prefix_with('OR IGNORE')
+                    .values(file_id=self.file_id, pack_id=pack_id,
+                            offset=offset, size=len(content)))
+            return True
+        else:
+            return False
+
+    def _content(self, role: CakeRole)->Content:
+        try:
+            data = self.store.packs.read(
+                self.pack_id, self.offset, self.size)
+        except FileNotFoundError:
+            # pack was compacted after lookup, entry moved
+            self._locate()
+            data = self.store.packs.read(
+                self.pack_id, self.offset, self.size)
+        if self.size < self.store.cached_max_size:
+            return CacheLookup(self, data)._content(role)
+        return Content.from_data_and_role(role=role, data=data)
 
 
 class FileLookup(ContentAddressLookup):
-    def __init__(self, store, file_id):
-        ContentAddressLookup.__init__(self, store, file_id)
+    tier = 'file'
+
+    def __init__(self, store, file_id, shard_name=None):
+        ContentAddressLookup.__init__(self, store, file_id, shard_name)
         self.file = os.path.join(self.dir, str(self.file_id) )
+        self.encoded = False
         try:
-            (self.size, _, _, ctime) = os.stat(self.file)[6:]
+            with open(self.file, 'rb') as fp:
+                header = read_header(fp)
+                (self.size, _, _, ctime) = os.fstat(fp.fileno())[6:]
             self.created_dt=datetime.datetime.utcfromtimestamp(ctime)
+            if header is not None:
+                self.encoded = True
+                self.size = header[1]
         except OSError as e:
             if e.errno != 2:  # No such file
                  raise # pragma: no cover
 
     def _content(self, role: CakeRole)->Content:
-        content = Content.from_data_and_role(
+        if self.encoded:
+            content_cls = CompressedContent
+        else:
+            content_cls = MappedContent
+        content = content_cls.from_data_and_role(
             file=self.file, role=role)
         if self.size < self.store.cached_max_size:
             return CacheLookup(self, content.stream().read())._content(role)
         return content
 
 
+class ManifestLookup(ContentAddressLookup):
+    tier = 'manifest'
+
+    def __init__(self, store, file_id, shard_name=None):
+        ContentAddressLookup.__init__(self, store, file_id, shard_name)
+        with self.blob_db() as blob_db:
+            if blob_db.exists():
+                row = blob_db.execute(select([
+                        manifest.c.size,
+                        manifest.c.created_dt
+                    ]).where(manifest.c.file_id == self.file_id)
+                ).first()
+                if row is not None:
+                    self.size = row.size
+                    self.created_dt = row.created_dt
+
+    def save_content(self, chunks, size):
+        if not self.found():
+            ensure_directory(self.dir)
+            with self.blob_db() as blob_db:
+                blob_db.ensure_db()
+                blob_db.execute(
+                    manifest.insert().prefix_with('OR IGNORE')
+                    .values(file_id=self.file_id, size=size,
+                            chunks=pack_manifest(chunks)))
+            return True
+        else:
+            return False
+
+    def _content(self, role: CakeRole)->Content:
+        with self.blob_db() as blob_db:
+            row = blob_db.execute(
+                select([manifest.c.chunks])
+                .where(manifest.c.file_id == self.file_id)).first()
+        return ChunkedContent.from_chunks(
+            self.store, parse_manifest(row.chunks), role)
+
+
+class ColdLookup(ContentAddressLookup):
+    '''
+    Blob demoted into cold tier, found by its `cold_entry` in
+    `blob.db` of hot tier, so cold tier is not touched for
+    blobs that are missing.
+    '''
+    tier = 'cold'
+
+    def __init__(self, store, file_id, shard_name=None):
+        ContentAddressLookup.__init__(self, store, file_id, shard_name)
+        with self.blob_db() as blob_db:
+            if blob_db.exists():
+                row = blob_db.execute(select([
+                        cold_entry.c.size,
+                        cold_entry.c.created_dt
+                    ]).where(cold_entry.c.file_id == self.file_id)
+                ).first()
+                if row is not None:
+                    self.size = row.size
+                    self.created_dt = row.created_dt
+
+    def content(self, role: CakeRole)->Content:
+        content = Lookup.content(self, role)
+        self.store.tier_keeper.read_cold(self.file_id)
+        return content
+
+    def _content(self, role: CakeRole)->Content:
+        return self.store.cold.lookup(
+            self.file_id, fetch=True).content(role)
+
+
 MAX_DB_BLOB_SIZE = 1 << 16
 
+# blobs in `blob.db` that are that big are read with `DbContent`
+DB_STREAM_MIN_SIZE = 1 << 16
+
+# shard names are at most 3 digits in base 36
+MAX_SHARD_LIMIT = 36 ** 3
+
+# seconds that `BlobStore.collecting()` trusts last check of marker
+COLLECTING_CHECK_INTERVAL = 1.0
+
+
+class TierKeeper:
+    '''
+    Background work of tiered `BlobStore`. Reads of blobs are
+    recorded in memory, and every `interval` seconds last access
+    time of every read blob is written into `blob_access` table
+    of its shard, so demotion could pick blobs that were not read
+    for long time. With `promote` set, cold blobs that were read
+    are promoted back into hot tier by the same thread. Reads made
+    by demotion and promotion themselves are not recorded.
+    '''
+    def __init__(self, store, interval=10.0, promote=False):
+        self.store = store
+        self.interval = interval
+        self.promote = promote
+        self.lock = threading.Lock()
+        self.accessed = {}
+        self.to_promote = set()
+        self.promoted = 0
+        self.local = threading.local()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='tier-keeper', daemon=True)
+        self.thread.start()
+
+    def touch(self, file_id):
+        if not getattr(self.local, 'untracked', False):
+            self.accessed[file_id] = datetime.datetime.utcnow()
+
+    def read_cold(self, file_id):
+        if self.promote and not getattr(self.local, 'untracked', False):
+            with self.lock:
+                self.to_promote.add(file_id)
+
+    @contextmanager
+    def untracked(self):
+        '''
+        reads of this thread inside of context are not recorded
+        '''
+        self.local.untracked = True
+        try:
+            yield
+        finally:
+            self.local.untracked = False
+
+    def flush(self):
+        '''
+        write access times and promote cold blobs that were read
+        '''
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+            to_promote, self.to_promote = self.to_promote, set()
+        by_shard = defaultdict(list)
+        for file_id, accessed_dt in accessed.items():
+            by_shard[self.store.shard_name(file_id)].append(
+                dict(file_id=file_id, accessed_dt=accessed_dt))
+        for shard_name, rows in by_shard.items():
+            ensure_directory(os.path.join(self.store.root, shard_name))
+            with self.store.blob_dbf(shard_name) as blob_db:
+                blob_db.ensure_db()
+                blob_db.execute(
+                    blob_access.insert().prefix_with('OR REPLACE'), rows)
+        for file_id in to_promote:
+            if self.store.promote(file_id) is not None:
+                self.promoted += 1
+
+    def _run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('tier keeper')
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+
+class BlobMetrics:
+    '''
+    Metrics of `BlobStore`, kept in `registry` (`Metrics`).
+    Lookups and writes are labeled with `tier` where blob was
+    found or stored: `cache`, `pending`, `db`, `pack`, `file`,
+    `manifest`, `cold` or `miss`. Chunks of chunked blob are
+    written as blobs of their own, so writes of `manifest` tier
+    add no bytes.
+    '''
+    def __init__(self, store, registry=None):
+        if registry is None:
+            registry = Metrics()
+        self.registry = registry
+        m = registry
+        self.lookups = m.histogram(
+            'blob_lookup_seconds', 'time to find blob, by tier')
+        self.read_bytes = m.counter(
+            'blob_read_bytes_total', 'size of content read, by tier')
+        self.writes = m.histogram(
+            'blob_write_seconds',
+            'time spent in calls of writer of blob, by tier')
+        self.written_bytes = m.counter(
+            'blob_written_bytes_total', 'size of written blobs, by tier')
+        self.incoming = m.histogram(
+            'incoming_close_seconds',
+            'time to move uploaded file into its shard')
+        self.incoming_bytes = m.counter(
+            'incoming_bytes_total', 'bytes of uploaded files')
+        self.incoming_duplicates = m.counter(
+            'incoming_duplicates_total',
+            'uploaded files dropped, blob was already stored')
+        self.shard_opens = m.counter(
+            'shard_db_opens_total', 'blob.db shards opened by pool')
+        self.queries = m.histogram(
+            'shard_db_query_seconds', 'time of statements on blob.db')
+        cache = store.cache.stats
+        for key in ('hits', 'misses', 'evictions'):
+            m.gauge(f'blob_cache_{key}_total',
+                    lambda key=key: cache()[key], kind='counter')
+        m.gauge('blob_cache_bytes', lambda: cache()['bytes'])
+        m.gauge('shard_db_open', lambda: len(store.shard_pool.shards))
+        m.gauge('shard_db_connections',
+                lambda: store.shard_pool.open_connections)
+        m.gauge('shard_db_evictions_total',
+                lambda: store.shard_pool.evictions, kind='counter')
+
+    def time_queries(self, engine):
+        def before(conn, *_):
+            conn.info.setdefault('query_start', []).append(
+                time.perf_counter())
+
+        def after(conn, *_):
+            self.queries.observe(
+                time.perf_counter() - conn.info['query_start'].pop())
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    def snapshot(self):
+        return self.registry.snapshot()
+
+    def render(self):
+        return self.registry.render()
+
 
 class BlobStore:
     '''
     Storage backend that keep blobs in set of sharded directories.
-    BLOBs smaller then db_limit will be stored in SQLite and bigger
-    as individual files in directory
+    BLOBs smaller then `db_max_blob_size` will be stored in SQLite
+    and bigger as individual files in directory, or, if enabled,
+    in pack files (`pack_max_blob_size`, see `Packs`) or as content
+    defined chunks (`chunk_avg_size`, see `ChunkedContent`).
+
+    Other options are described by classes that implement them:
+    `group_commit_count` - `GroupCommit`, `durability` -
+    `Durability`, `bloom_capacity` - `BloomFilter` (only in process
+    that is the only writer into `root`), `cold_root` -
+    `TierKeeper` and `Tiering`, `prev_num_shards` -
+    `ShardMigration`, `lookup_hints` - `FilePresence`, `metrics` -
+    `BlobMetrics`. With `compression` set, blobs are compressed
+    unless they do not shrink to `compress_min_ratio`, codec is
+    recorded per blob. Once `rebuild_index()` was called, writers
+    keep `AddressIndex` of all blobs.
 
     '''
-    def __init__(self, root, cache_size=1000, cached_max_size=80000):
+    def __init__(self, root, cache_max_bytes=64 << 20,
+                 cached_max_size=80000,
+                 max_open_shards=64, connections_per_shard=1,
+                 bloom_capacity=None, pack_max_blob_size=None,
+                 pack_file_size=1 << 30, group_commit_count=None,
+                 group_commit_bytes=4 << 20, group_commit_delay=1.0,
+                 durability=Durability.relaxed, sync_interval=1.0,
+                 compression=None, compress_min_ratio=0.9,
+                 chunk_avg_size=None, num_shards=MAX_NUM_OF_SHARDS,
+                 prev_num_shards=None, cold_root=None,
+                 promote_on_read=False, access_interval=10.0,
+                 lookup_hints=True, db_max_blob_size=MAX_DB_BLOB_SIZE,
+                 metrics=None):
         self.root = root
-        self.cache = pylru.lrucache(cache_size)
+        self.db_max_blob_size = db_max_blob_size
+        self.file_presence = FilePresence(root) if lookup_hints else None
+        self.set_shards(num_shards, prev_num_shards)
+        self.chunk_avg_size = chunk_avg_size
+        if isinstance(compression, str):
+            compression = Codec[compression]
+        self.compression = compression
+        self.compress_min_ratio = compress_min_ratio
+        self.cache = BlobCache(cache_max_bytes,
+                               sizeof=lambda l: len(l.data))
         self.cached_max_size = cached_max_size
         self.incoming_dir = os.path.join(self.root,'incoming')
         ensure_directory(self.incoming_dir)
-        self.in_db = Dbf(incoming_meta, self.incoming_dir + '.db')
-        self.in_db.ensure_db()
+        self.sweep_incoming()
+        self.metrics = BlobMetrics(self, metrics)
+        self.shard_pool = ShardPool(self.root, max_open_shards,
+                                    connections_per_shard, self.metrics)
+        self.packs = Packs(self.root, pack_file_size)
+        self.pack_max_blob_size = pack_max_blob_size
+        self.lookup_factories = [self.cache_lookup_factory, FileLookup,
+                                 DbLookup, ManifestLookup]
+        if pack_max_blob_size is not None or self.packs.exists():
+            self.lookup_factories.insert(2, PackLookup)
+        self._collecting = None
+        self.group_commit = None
+        if group_commit_count is not None:
+            self.group_commit = GroupCommit(
+                self, group_commit_count, group_commit_bytes,
+                group_commit_delay)
+            self.lookup_factories.insert(1, self.pending_lookup_factory)
+        if isinstance(durability, str):
+            durability = Durability[durability]
+        self.durability = durability
+        self.sync_batch = None
+        if durability == Durability.batched:
+            self.sync_batch = SyncBatch(sync_interval)
+        self.cold = None
+        self.tier_keeper = None
+        if cold_root is not None:
+            self.cold = BlobStore(
+                cold_root, cached_max_size=0,
+                max_open_shards=max_open_shards, durability=durability,
+                db_max_blob_size=db_max_blob_size,
+                compression=compression,
+                compress_min_ratio=compress_min_ratio)
+            self.lookup_factories.append(ColdLookup)
+            self.tier_keeper = TierKeeper(self, access_interval,
+                                          promote_on_read)
+        self.in_flight = InFlightWrites()
+        self.index = AddressIndex(os.path.join(self.root, 'index'),
+                                  persist=self.persist)
+        if self.index.exists():
+            self.index.check()
+        self.bloom = None
+        # snapshot is dropped by first write of store without filter
+        self.bloom_snapshot_dropped = bloom_capacity is not None
+        if bloom_capacity is not None:
+            self.bloom = self._load_bloom(bloom_capacity)
+
+    def sweep_incoming(self, max_age=24 * 3600):
+        '''
+        Remove `*.tmp` files left in `incoming` by writers that
+        crashed. Name of file starts with pid of writer, so files of
+        processes that still alive are kept unless they were not
+        touched for `max_age` seconds. Orphaned upload is never
+        finalized: it could be incomplete, and its writer never
+        returned address to client anyway.
+
+        :return: number of removed files
+        '''
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.incoming_dir):
+            if not name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.incoming_dir, name)
+            pid = name.split('-')[0]
+            try:
+                if pid.isdigit() and pid_alive(int(pid)) and \
+                        now - os.stat(path).st_mtime < max_age:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue  # writer finished meanwhile
+            log.info(f'removed orphaned {path}')
+            removed += 1
+        return removed
+
+    def _bloom_snapshot(self):
+        return os.path.join(self.root, 'bloom.snapshot')
+
+    def drop_bloom_snapshot(self):
+        '''
+        Called on writes of store without filter: snapshot does not
+        have blobs written here, so it is removed once.
+        '''
+        if self.bloom_snapshot_dropped:
+            return
+        self.bloom_snapshot_dropped = True
+        try:
+            os.remove(self._bloom_snapshot())
+        except FileNotFoundError:
+            pass
+
+    def _load_bloom(self, capacity):
+        '''
+        Snapshot of filter is consumed on start and written back on
+        `close()`. If snapshot is missing (process crashed, or other
+        store wrote blobs meanwhile, see `drop_bloom_snapshot()`)
+        filter is rebuilt by scanning the store.
+        '''
+        snapshot = self._bloom_snapshot()
+        loaded = BloomFilter.load(snapshot)
+        bloom = BloomFilter(capacity)
+        if loaded is not None:
+            os.remove(snapshot)
+            if loaded.num_bits == bloom.num_bits:
+                return loaded
+        for file_id in self:
+            bloom.add(file_id.hash_bytes())
+        log.info(f'bloom filter built with {len(bloom)} addresses')
+        return bloom
+
+    def set_shards(self, num_shards, prev_num_shards=None):
+        '''
+        switch layout of shards, `prev_num_shards` is layout that
+        blobs are being migrated from
+        '''
+        for n in (num_shards, prev_num_shards):
+            if n is not None and not 0 < n <= MAX_SHARD_LIMIT:
+                raise ValueError(f'number of shards out of range: {n}')
+        if prev_num_shards == num_shards:
+            prev_num_shards = None
+        self.num_shards = num_shards
+        self.prev_num_shards = prev_num_shards
+
+    def shard_name(self, file_id):
+        return file_id.shard(self.num_shards)
+
+    def _shards_of(self, file_id):
+        '''
+        shards where blob could be: its shard and, while migration
+        is running, shard in previous layout
+        '''
+        shards = [self.shard_name(file_id)]
+        prev = self.prev_num_shards
+        if prev is not None and file_id.shard(prev) != shards[0]:
+            shards.append(file_id.shard(prev))
+        return shards
+
+    def max_shards(self):
+        return max(self.num_shards, self.prev_num_shards or 0)
 
     def blob_dbf(self, shard_name):
-        path = os.path.join(self.root, shard_name, 'blob.db')
-        return Dbf(blob_meta, path)
+        '''
+        context manager that leases `BlobDbf` of shard from pool
+        '''
+        return self.shard_pool.lease(shard_name)
+
+    def blob_row(self, file_id, content):
+        '''
+        values of `blob` row for `content`, compressed if it is
+        worth it
+        '''
+        codec, data = None, content
+        if self.compression is not None:
+            compressed = compress_if_worth(self.compression, content,
+                                           self.compress_min_ratio)
+            if compressed is not None:
+                codec, data = self.compression, compressed
+        return dict(file_id=file_id, content=data, codec=codec,
+                    size=len(content))
+
+    def flush(self):
+        '''
+        commit all queued blobs and fsync files of recent blobs
+        '''
+        if self.group_commit is not None:
+            self.group_commit.flush()
+        if self.sync_batch is not None:
+            self.sync_batch.sync()
+
+    def persist(self, file, dirs=()):
+        '''
+        apply durability policy to `file` that was just written and
+        `dirs` where entries were just added
+        '''
+        if self.durability == Durability.strict:
+            fsync_path(file)
+            for d in dirs:
+                fsync_path(d)
+        elif self.durability == Durability.batched:
+            self.sync_batch.add(file, dirs)
+
+    def close(self):
+        if self.tier_keeper is not None:
+            self.tier_keeper.close()
+        if self.group_commit is not None:
+            self.group_commit.close()
+        if self.sync_batch is not None:
+            self.sync_batch.close()
+        if self.bloom is not None:
+            self.bloom.save(self._bloom_snapshot())
+        self.packs.close()
+        self.shard_pool.close()
+        self.index.close()
+        if self.cold is not None:
+            self.cold.close()
 
     @staticmethod
     def cache_lookup_factory(self, file_id):
@@ -151,103 +742,921 @@ class BlobStore:
         except KeyError:
             return NULL_LOOKUP
 
+    def shard_names(self):
+        max_shards = self.max_shards()
+        return filter(lambda s: is_it_shard(s, max_shards),
+                      os.listdir(self.root))
+
+    @staticmethod
+    def pending_lookup_factory(self, file_id):
+        data = self.group_commit.get(file_id)
+        if data is None:
+            return NULL_LOOKUP
+        return PendingLookup(self, file_id, data)
+
     def __iter__(self):
-        for shard_name in filter(
-                lambda s: is_it_shard(s,MAX_NUM_OF_SHARDS),
-                os.listdir(self.root)):
-            blob_db = self.blob_dbf(shard_name)
+        if self.index.complete():
+            return iter(self.index)
+        return self.scan()
+
+    def scan(self):
+        '''
+        addresses of all blobs, read from every shard
+        '''
+        for shard_name in self.shard_names():
+            yield from self.shard_blobs(shard_name)
+
+    def rebuild_index(self):
+        '''
+        Build `AddressIndex` from scan of store, writers maintain it
+        from the moment it is started.
+
+        :return: number of indexed blobs
+        '''
+        return self.index.rebuild(self.scan())
+
+    def shard_blobs(self, shard_name, created_before=None):
+        '''
+        addresses of blobs stored in shard
+
+        :param created_before: only blobs created before that
+                               moment (naive UTC `datetime`)
+        '''
+        tables = (blob, pack_entry, manifest, cold_entry)
+        queries = [select([t.c.file_id]) for t in tables]
+        mtime_before = None
+        if created_before is not None:
+            queries = [q.where(t.c.created_dt < created_before)
+                       for q, t in zip(queries, tables)]
+            mtime_before = (created_before -
+                            datetime.datetime(1970, 1, 1)).total_seconds()
+        with self.blob_dbf(shard_name) as blob_db:
             if blob_db.exists():
-                for row in blob_db.execute(select([blob.c.file_id])):
-                    yield row.file_id
-            shard_path = os.path.join(self.root, shard_name)
-            for f in os.listdir(shard_path):
-                if len(f) > 48:
-                    yield ContentAddress(f)
-
-    def get_content(self, k:Union[Cake,ContentAddress]):
+                rows = blob_db.execute(union(*queries)).fetchall()
+            else:
+                rows = []
+        for row in rows:
+            yield row.file_id
+        try:
+            with os.scandir(os.path.join(self.root,
+                                         shard_name)) as entries:
+                files = [entry.name for entry in entries
+                         if len(entry.name) > 48 and
+                         (mtime_before is None or
+                          entry.stat().st_mtime < mtime_before)]
+        except FileNotFoundError:
+            return
+        for f in files:
+            yield ContentAddress(f)
+
+    def _collecting_marker(self):
+        return os.path.join(self.root, 'collecting')
+
+    def collecting(self):
+        '''
+        :return: `True` if garbage collection is in progress,
+                 marker is checked at most every
+                 `COLLECTING_CHECK_INTERVAL` seconds
+        '''
+        now = time.monotonic()
+        if self._collecting is None or self._collecting[1] < now:
+            self._collecting = (os.path.exists(self._collecting_marker()),
+                                now + COLLECTING_CHECK_INTERVAL)
+        return self._collecting[0]
+
+    def set_collecting(self, collecting):
+        '''
+        Create or remove marker of garbage collection in progress,
+        writers of other processes notice it within
+        `COLLECTING_CHECK_INTERVAL` seconds.
+        '''
+        marker = self._collecting_marker()
+        if collecting:
+            with open(marker, 'w'):
+                pass
+        elif os.path.exists(marker):
+            os.remove(marker)
+        self._collecting = None
+
+    def confirm(self, file_ids):
+        '''
+        Record in `blob_confirm` that blobs were confirmed to be
+        stored to writer that did not upload them again. Writer
+        references them afterwards, so garbage collector that
+        is in progress does not sweep them (see `confirmed_since`).
+        Nothing is written while no collection is in progress.
+        '''
+        if not self.collecting():
+            return
+        now = datetime.datetime.utcnow()
+        by_shard = defaultdict(list)
+        for k in file_ids:
+            file_id = ContentAddress.ensure_it(k)
+            by_shard[self.shard_name(file_id)].append(
+                dict(file_id=file_id, confirmed_dt=now))
+        for shard_name, rows in by_shard.items():
+            ensure_directory(os.path.join(self.root, shard_name))
+            with self.blob_dbf(shard_name) as blob_db:
+                blob_db.ensure_db()
+                blob_db.execute(
+                    blob_confirm.insert().prefix_with('OR REPLACE'), rows)
+
+    def confirmed_since(self, file_ids, since, batch=500):
+        '''
+        :return: set of blobs that were confirmed since `since`
+        '''
+        by_shard = defaultdict(list)
+        for file_id in file_ids:
+            for shard_name in self._shards_of(file_id):
+                by_shard[shard_name].append(file_id)
+        confirmed = set()
+        for shard_name, in_shard in by_shard.items():
+            with self.blob_dbf(shard_name) as blob_db:
+                if not blob_db.exists():
+                    continue
+                for i in range(0, len(in_shard), batch):
+                    confirmed.update(row.file_id for row in blob_db.execute(
+                        select([blob_confirm.c.file_id]).where(and_(
+                            blob_confirm.c.file_id.in_(
+                                in_shard[i:i + batch]),
+                            blob_confirm.c.confirmed_dt >= since))))
+        return confirmed
+
+    def forget_confirmed(self, shard_name, before):
+        '''
+        Drop confirmations that are older than `before` from shard.
+        '''
+        with self.blob_dbf(shard_name) as blob_db:
+            if blob_db.exists():
+                blob_db.execute(blob_confirm.delete().where(
+                    blob_confirm.c.confirmed_dt < before))
+
+    def remove(self, file_ids, batch=500):
+        '''
+        Delete blobs. Space taken by packed blobs is reclaimed
+        later by `repack()`, chunks of removed manifest are left
+        for garbage collector.
+
+        :return: number of removed blobs
+        '''
+        file_ids = list(file_ids)
+        if self.cold is None:
+            removed = self._remove_hot(file_ids, batch, (blob_confirm,))
+        else:
+            removed = self._remove_hot(file_ids, batch,
+                                       (cold_entry, blob_access,
+                                        blob_confirm))
+            removed += self.cold.remove(file_ids, batch)
+        self.index.discard(file_ids)
+        return removed
+
+    def _remove_hot(self, file_ids, batch=500, other_tables=()):
+        '''
+        :param other_tables: rows of blobs are deleted from these
+                             tables too, but they are not counted
+        '''
+        by_shard = defaultdict(list)
+        for file_id in file_ids:
+            for shard_name in self._shards_of(file_id):
+                by_shard[shard_name].append(file_id)
+        removed = 0
+        for shard_name, shard_ids in by_shard.items():
+            with self.blob_dbf(shard_name) as blob_db:
+                if blob_db.exists():
+                    for i in range(0, len(shard_ids), batch):
+                        in_batch = shard_ids[i:i + batch]
+                        for table in (blob, pack_entry, manifest):
+                            removed += blob_db.execute(
+                                table.delete().where(
+                                    table.c.file_id.in_(in_batch))
+                            ).rowcount
+                        for table in other_tables:
+                            blob_db.execute(table.delete().where(
+                                table.c.file_id.in_(in_batch)))
+            for file_id in shard_ids:
+                self.cache.discard(file_id)
+                try:
+                    os.remove(os.path.join(self.root, shard_name,
+                                           str(file_id)))
+                    removed += 1
+                    if self.file_presence is not None:
+                        self.file_presence.discard(shard_name,
+                                                   str(file_id))
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def manifest_chunks(self, file_ids, batch=500):
+        '''
+        :return: addresses of chunks of those `file_ids` that are
+                 stored as manifests
+        '''
+        by_shard = defaultdict(list)
+        for file_id in file_ids:
+            for shard_name in self._shards_of(file_id):
+                by_shard[shard_name].append(file_id)
+        for shard_name, shard_ids in by_shard.items():
+            with self.blob_dbf(shard_name) as blob_db:
+                if not blob_db.exists():
+                    continue
+                rows = []
+                for i in range(0, len(shard_ids), batch):
+                    rows.extend(blob_db.execute(
+                        select([manifest.c.chunks]).where(
+                            manifest.c.file_id.in_(
+                                shard_ids[i:i + batch]))).fetchall())
+            for row in rows:
+                for file_id, _ in parse_manifest(row.chunks):
+                    yield file_id
+
+    def get_content(self, k:Union[Cake,ContentAddress], size_hint=None):
         role = k.header.role if isinstance(k, Cake) else CakeRole.SYNAPSE
-        return self.lookup(k).content(role)
+        return self.lookup(k, size_hint, fetch=True).content(role)
+
+    def read_range(self, k: Union[Cake, ContentAddress], start=0,
+                   stop=None) -> bytes:
+        '''
+        Bytes `start:stop` of blob. Only that part of blob stored as
+        file, in `blob.db` or as chunks is read (see `content_chunks`).
+        '''
+        return b''.join(content_chunks(self.get_content(k),
+                                       start=start, stop=stop))
+
+    def _expected_location(self, size):
+        '''
+        lookup factory of location where writer puts blob of `size`
+        '''
+        if size < self.db_max_blob_size:
+            return DbLookup
+        if self.pack_max_blob_size is not None and \
+                size < self.pack_max_blob_size:
+            return PackLookup
+        if self.chunk_avg_size is not None:
+            return ManifestLookup
+        return FileLookup
 
-    def lookup(self, cake_or_cadr):
+    def _lookup_order(self, file_id, size_hint):
+        factories = self.lookup_factories
+        if self.file_presence is None:
+            return factories
+        if size_hint is not None:
+            first = self._expected_location(size_hint)
+        elif self.file_presence.may_have(self.shard_name(file_id),
+                                         str(file_id)):
+            first = FileLookup
+        else:
+            first = None
+        in_memory = [f for f in factories if not isinstance(f, type)]
+        order = in_memory
+        if first in factories:
+            order = order + [first]
+        order += [f for f in factories
+                  if isinstance(f, type) and
+                  f not in (first, FileLookup, ColdLookup)]
+        # file is last resort: it could be written by other process
+        if first is not FileLookup and FileLookup in factories:
+            order.append(FileLookup)
+        if ColdLookup in factories:
+            order.append(ColdLookup)
+        return order
+
+    def lookup(self, cake_or_cadr, size_hint=None, fetch=False):
+        '''
+        :param size_hint: size of blob if it is known, so blob is
+                          looked for where writer puts blobs of that
+                          size first
+        :param fetch: content is going to be read, blob found in
+                      `blob` table is read by same query as metadata
+        '''
+        start = time.perf_counter()
+        l = self._lookup(cake_or_cadr, size_hint, fetch)
+        self.metrics.lookups.observe(time.perf_counter() - start,
+                                     tier=l.tier)
+        return l
+
+    def _lookup(self, cake_or_cadr, size_hint, fetch):
         file_id = ContentAddress.ensure_it(cake_or_cadr)
-        for lookup_contr in (self.cache_lookup_factory,
-                             FileLookup, DbLookup):
-            l = lookup_contr(self, file_id)
+        if self.bloom is not None and \
+                file_id.hash_bytes() not in self.bloom:
+            return NULL_LOOKUP
+        unindexed = None
+        for lookup_contr in self._lookup_order(file_id, size_hint):
+            if isinstance(lookup_contr, type):
+                # index is consulted only after in memory lookups,
+                # only blobs queued by group commit are not indexed
+                if unindexed is None:
+                    unindexed = self.index.complete() and \
+                        file_id not in self.index
+                if unindexed:
+                    break
+            if fetch and lookup_contr is DbLookup:
+                l = DbLookup(self, file_id, fetch=True)
+            else:
+                l = lookup_contr(self, file_id)
             if l.found():
                 return l
+        prev = self.prev_num_shards
+        if prev is not None and not unindexed and \
+                file_id.shard(prev) != self.shard_name(file_id):
+            return self._prev_lookup(file_id, file_id.shard(prev), fetch)
         return NULL_LOOKUP
 
+    def _prev_lookup(self, file_id, prev_shard_name, fetch=False):
+        '''
+        Blob is not yet moved from its shard in previous layout, or
+        it was moved after it was looked for in its new shard.
+        '''
+        factories = [f for f in self.lookup_factories
+                     if isinstance(f, type) and
+                     issubclass(f, ContentAddressLookup)]
+        for shard_name in (prev_shard_name, None):
+            for lookup_contr in factories:
+                if fetch and lookup_contr is DbLookup:
+                    l = DbLookup(self, file_id, shard_name, fetch=True)
+                else:
+                    l = lookup_contr(self, file_id, shard_name)
+                if l.found():
+                    return l
+        return NULL_LOOKUP
+
+    def exists_many(self, keys):
+        '''
+        Check existence of many blobs at once. Keys are grouped by
+        shard, and every shard costs one `IN (...)` query against
+        `blob.db` (and its pack index) and one `os.scandir` of
+        shard directory.
+
+        :return: dict that maps every key to size of blob or
+                 `None` if blob is not stored
+        '''
+        result = {}
+        missing = defaultdict(list)
+        indexed = self.index.complete()
+        for k in keys:
+            file_id = ContentAddress.ensure_it(k)
+            result[k] = None
+            if self.bloom is not None and \
+                    file_id.hash_bytes() not in self.bloom:
+                continue
+            if self.group_commit is not None:
+                data = self.group_commit.get(file_id)
+                if data is not None:
+                    result[k] = len(data)
+                    continue
+            if indexed and file_id not in self.index:
+                continue
+            missing[file_id].append(k)
+
+        def found(file_id, size):
+            for k in missing.pop(file_id, ()):
+                result[k] = size
+
+        layouts = [self.num_shards]
+        prev = self.prev_num_shards
+        if prev is not None:
+            # blobs moved by migration between passes are found
+            # by last one
+            layouts += [prev, self.num_shards]
+        for num_shards in layouts:
+            by_shard = defaultdict(dict)
+            for file_id in missing:
+                by_shard[file_id.shard(num_shards)][str(file_id)] = \
+                    file_id
+            for shard_name, names in by_shard.items():
+                for file_id, size in self._db_sizes(
+                        shard_name, list(names.values())):
+                    found(file_id, size)
+                if not any(file_id in missing
+                           for file_id in names.values()):
+                    continue
+                try:
+                    with os.scandir(os.path.join(
+                            self.root, shard_name)) as entries:
+                        for entry in entries:
+                            if names.get(entry.name) in missing:
+                                try:
+                                    size = logical_size(entry.path)
+                                except FileNotFoundError:
+                                    continue
+                                found(names[entry.name], size)
+                except FileNotFoundError:
+                    pass
+            if not missing:
+                break
+        return result
+
+    def _db_sizes(self, shard_name, file_ids, batch=500):
+        with self.blob_dbf(shard_name) as blob_db:
+            if not blob_db.exists():
+                return
+            for i in range(0, len(file_ids), batch):
+                in_batch = file_ids[i:i + batch]
+                q = union_all(
+                    select([blob.c.file_id, blob.c.size])
+                    .where(blob.c.file_id.in_(in_batch)),
+                    select([pack_entry.c.file_id, pack_entry.c.size])
+                    .where(pack_entry.c.file_id.in_(in_batch)),
+                    select([manifest.c.file_id, manifest.c.size])
+                    .where(manifest.c.file_id.in_(in_batch)),
+                    select([cold_entry.c.file_id, cold_entry.c.size])
+                    .where(cold_entry.c.file_id.in_(in_batch)))
+                yield from blob_db.execute(q).fetchall()
+
+    def repack(self, min_live_ratio=0.5):
+        '''
+        Compact sealed packs where less then `min_live_ratio` of
+        bytes are referenced by pack index: live entries are copied
+        into active pack, index is repointed and old pack removed.
+
+        :return: number of removed packs and bytes reclaimed
+        '''
+        sealed = self.packs.sealed()
+        if not sealed:
+            return 0, 0
+        live = defaultdict(int)
+        shards_of = defaultdict(set)
+        for shard_name in self.shard_names():
+            with self.blob_dbf(shard_name) as blob_db:
+                if not blob_db.exists():
+                    continue
+                rows = blob_db.execute(select([
+                    pack_entry.c.pack_id,
+                    func.sum(pack_entry.c.size).label('size')
+                ]).group_by(pack_entry.c.pack_id)).fetchall()
+            for row in rows:
+                live[row.pack_id] += row.size
+                shards_of[row.pack_id].add(shard_name)
+        removed, reclaimed = 0, 0
+        for pack_id, pack_size in sealed.items():
+            if pack_size > 0 and \
+                    live[pack_id] / pack_size >= min_live_ratio:
+                continue
+            for shard_name in shards_of[pack_id]:
+                self._move_pack_entries(shard_name, pack_id)
+            self.packs.remove(pack_id)
+            log.info(f'repacked {pack_id}: {live[pack_id]} bytes live '
+                     f'out of {pack_size}')
+            removed += 1
+            reclaimed += pack_size - live[pack_id]
+        return removed, reclaimed
+
+    def _move_pack_entries(self, shard_name, pack_id):
+        with self.blob_dbf(shard_name) as blob_db:
+            rows = blob_db.execute(select([
+                pack_entry.c.file_id,
+                pack_entry.c.offset,
+                pack_entry.c.size
+            ]).where(pack_entry.c.pack_id == pack_id)).fetchall()
+            for row in rows:
+                data = self.packs.read(pack_id, row.offset, row.size)
+                new_pack_id, offset = self.packs.append(data)
+                blob_db.execute(
+                    pack_entry.update()
+                    .values(pack_id=new_pack_id, offset=offset)
+                    .where(and_(pack_entry.c.file_id == row.file_id,
+                                pack_entry.c.pack_id == pack_id)))
+
+    def migrate_shard(self, shard_name, batch=500):
+        '''
+        Move blobs that don't belong to shard `shard_name` in current
+        layout into their shards: files are renamed, rows of
+        `blob.db` are copied in batches and deleted once copy is
+        committed, so blob is always readable at one of locations.
+        Shard that is beyond current layout is removed when it
+        is empty.
+
+        :return: number of moved blobs
+        '''
+        shard_dir = os.path.join(self.root, shard_name)
+        if not os.path.isdir(shard_dir):
+            return 0
+        moved = 0
+        for table in (blob, pack_entry, manifest, cold_entry,
+                      blob_access, blob_confirm):
+            moved += self._move_rows(shard_name, table, batch)
+        with os.scandir(shard_dir) as entries:
+            names = [entry.name for entry in entries
+                     if len(entry.name) > 48]
+        for name in names:
+            target = self.shard_name(ContentAddress(name))
+            if target == shard_name:
+                continue
+            target_dir = os.path.join(self.root, target)
+            dirs = [target_dir, shard_dir]
+            if ensure_directory(target_dir):
+                dirs.append(self.root)
+            try:
+                os.replace(os.path.join(shard_dir, name),
+                           os.path.join(target_dir, name))
+            except FileNotFoundError:
+                continue  # removed meanwhile
+            self.persist(os.path.join(target_dir, name), dirs)
+            if self.file_presence is not None:
+                self.file_presence.add(target, name)
+                self.file_presence.discard(shard_name, name)
+            moved += 1
+        if not is_it_shard(shard_name, self.num_shards):
+            self._drop_shard(shard_name)
+        return moved
+
+    def _move_rows(self, shard_name, table, batch):
+        rowid = column('rowid')
+        last = 0
+        moved = 0
+        while True:
+            with self.blob_dbf(shard_name) as blob_db:
+                if not blob_db.exists():
+                    return moved
+                rows = blob_db.execute(
+                    select([rowid, table]).where(rowid > last)
+                    .order_by(rowid).limit(batch)).fetchall()
+            if not rows:
+                return moved
+            last = rows[-1].rowid
+            by_target = defaultdict(list)
+            for row in rows:
+                target = self.shard_name(row.file_id)
+                if target != shard_name:
+                    by_target[target].append(
+                        {c.name: row[c.name] for c in table.c})
+            for target, values in by_target.items():
+                ensure_directory(os.path.join(self.root, target))
+                with self.blob_dbf(target) as blob_db:
+                    blob_db.ensure_db()
+                    blob_db.execute(
+                        table.insert().prefix_with('OR IGNORE'), values)
+                with self.blob_dbf(shard_name) as blob_db:
+                    blob_db.execute(table.delete().where(
+                        table.c.file_id.in_(
+                            [v['file_id'] for v in values])))
+                moved += len(values)
+
+    def _drop_shard(self, shard_name):
+        shard_dir = os.path.join(self.root, shard_name)
+        with self.shard_pool.lock:
+            if any(name != 'blob.db' for name in os.listdir(shard_dir)):
+                return
+            with self.blob_dbf(shard_name) as blob_db:
+                if blob_db.exists() and any(
+                        blob_db.execute(
+                            select([t.c.file_id]).limit(1)).first()
+                        for t in (blob, pack_entry, manifest,
+                                  cold_entry, blob_access, blob_confirm)):
+                    return
+            self.shard_pool.evict(shard_name)
+            shutil.rmtree(shard_dir)
+            if self.file_presence is not None:
+                self.file_presence.forget(shard_name)
+        log.info(f'removed empty shard {shard_name}')
+
+    def demote(self, file_id):
+        '''
+        Move blob from hot tier into cold one. Blob is copied and
+        recorded in `cold_entry` before it is removed from hot tier,
+        so it is readable all along.
+
+        :return: size of demoted blob or `None` if blob is not
+                 in hot tier
+        '''
+        lookup = self.lookup(file_id, fetch=True)
+        if not lookup.found() or isinstance(lookup, ColdLookup):
+            return None
+        copied = self._copy(lookup, self.cold.writer())
+        if copied != file_id:
+            log.error(f'{file_id} is not demoted, content does '
+                      f'not match: {copied}')
+            return None
+        with self.blob_dbf(self.shard_name(file_id)) as blob_db:
+            blob_db.ensure_db()
+            blob_db.execute(
+                cold_entry.insert().prefix_with('OR IGNORE')
+                .values(file_id=file_id, size=lookup.size))
+        self._remove_hot([file_id], other_tables=(blob_access,))
+        return lookup.size
+
+    def promote(self, file_id):
+        '''
+        Move blob from cold tier back into hot one.
+
+        :return: size of promoted blob or `None` if blob is not
+                 in cold tier
+        '''
+        lookup = self.lookup(file_id)
+        if not isinstance(lookup, ColdLookup):
+            return None
+        self._copy(lookup, self.writer())
+        with lookup.blob_db() as blob_db:
+            blob_db.execute(cold_entry.delete().where(
+                cold_entry.c.file_id == file_id))
+        self.cold.remove([file_id])
+        return lookup.size
+
+    def _copy(self, lookup, writer):
+        with self.tier_keeper.untracked():
+            content = lookup._content(CakeRole.SYNAPSE)
+            if isinstance(content, STREAMED_CONTENT):
+                for chunk in content.chunks():
+                    writer.write(bytes(chunk))
+            else:
+                writer.write(content.get_data())
+            return writer.done(flush=True)
+
     def writer(self):
         return ContentWriter(self)
 
 
+def pid_alive(pid):
+    if pid == os.getpid() or os.name == 'nt':
+        return True  # os.kill() would terminate process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # owned by other user
+    return True
+
+
+@contextmanager
+def pid_lock(path, already_running=AssertionError):
+    '''
+    Exclusive lock on `path` that holds pid of owner. Lock left by
+    process that is gone is removed, lock held by live process
+    raises `already_running`.
+    '''
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(path) as fp:
+            pid = fp.read().strip()
+        if pid.isdigit() and pid_alive(int(pid)):
+            raise already_running(f'pid={pid}')
+        log.warning(f'removing stale {path} pid={pid}')
+        os.remove(path)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(path)
+
+
 class IncomingFile:
+    '''
+    Blob being uploaded into `<pid>-<random>.tmp` in `incoming`
+    directory, name is unique, so writers don't need to coordinate.
+    Uploaded file is published into its shard by hard link, that
+    never replaces file stored by other process meanwhile, so
+    first copy wins and the rest are dropped.
+
+    First `SAMPLE_SIZE` bytes are held back to decide if content
+    is compressed. Compressed file (and file that happens to start
+    with header `MAGIC`) is written with header that is patched
+    with uncompressed size on `close()`.
+    '''
     def __init__(self, backend):
         self.backend = backend
-        rp = self.backend.in_db.execute( incoming.insert())
-        self.incoming_id = rp.lastrowid
-        self.file = os.path.join(self.backend.incoming_dir,
-                                 '%d.tmp' % self.incoming_id)
-        self.fd = open(self.file, 'wb')
+        fd, self.file = tempfile.mkstemp(
+            suffix='.tmp', prefix=f'{os.getpid()}-',
+            dir=self.backend.incoming_dir)
+        self.fd = os.fdopen(fd, 'wb')
+        self.head = bytearray()
+        self.codec = None
+        self.compressor = None
+        self.encoded = None
+        self.size = 0
+
+    def _start(self, input=b''):
+        head = bytes(self.head)
+        self.head = None
+        sample = head + input[:SAMPLE_SIZE]
+        codec = self.backend.compression
+        if codec is not None and worth_compressing(
+                sample, self.backend.compress_min_ratio):
+            self.codec = codec
+            self.compressor = codec.compressor()
+        self.encoded = self.codec is not None or \
+            sample.startswith(MAGIC)
+        if self.encoded:
+            self.fd.write(pack_header(self.codec, 0))
+        self._write(head)
+        self._write(input)
+
+    def _write(self, data):
+        self.size += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.fd.write(data)
 
     def write(self, input):
-        return self.fd.write(input)
+        if self.head is None:
+            self._write(input)
+        elif len(self.head) + len(input) < SAMPLE_SIZE:
+            self.head += input
+        else:
+            self._start(input)
 
     def close(self, lookup):
+        '''
+        :return: `True` if file was moved into shard, `False` if
+                 blob was already stored and file was dropped
+        '''
+        start = time.perf_counter()
+        if self.head is not None:
+            self._start()
         new = not lookup.found()
+        if new:
+            if self.compressor is not None:
+                self.fd.write(self.compressor.flush())
+            if self.encoded:
+                self.fd.seek(0)
+                self.fd.write(pack_header(self.codec, self.size))
+            if self.backend.durability == Durability.strict:
+                self.fd.flush()
+                os.fsync(self.fd.fileno())
         self.fd.close()
         self.fd = None
         if new:
-            ensure_directory(lookup.dir)
+            dirs = [lookup.dir]
+            if ensure_directory(lookup.dir):
+                dirs.append(self.backend.root)
             log.debug('mv %s %s' % (self.file, lookup.file))
-            shutil.move(self.file, lookup.file)
+            new = self._publish(lookup.file)
+        if new:
+            if self.backend.file_presence is not None:
+                self.backend.file_presence.add(lookup.shard_name,
+                                               str(lookup.file_id))
+            if self.backend.durability == Durability.strict:
+                for d in dirs:
+                    fsync_path(d)
+            else:
+                self.backend.persist(lookup.file, dirs)
         else:
             log.debug('rm %s' % self.file)
             os.remove(self.file)
-        self.backend.in_db.execute(
-            incoming.update().values(new=new,
-                                     file_id=lookup.file_id)
-                .where( incoming.c.incoming_id == self.incoming_id))
+        metrics = self.backend.metrics
+        metrics.incoming.observe(time.perf_counter() - start)
+        metrics.incoming_bytes.inc(self.size)
+        if not new:
+            metrics.incoming_duplicates.inc()
+        return new
 
+    def _publish(self, path):
+        '''
+        atomically create `path` as uploaded file, unless it exists
+        '''
+        try:
+            os.link(self.file, path)
+        except FileExistsError:
+            return False
+        except OSError:
+            # file system without hard links, `incoming` is on
+            # the same file system, so rename is atomic still
+            os.replace(self.file, path)
+            return True
+        os.remove(self.file)
+        return True
 
 class ContentWriter:
-    def __init__(self, backend):
+    def __init__(self, backend, chunking=True):
         self.backend = backend
-        self.buffer = bytes()
+        self.buffer = bytearray()
+        self.buffer_limit = backend.db_max_blob_size
+        if backend.pack_max_blob_size is not None:
+            self.buffer_limit = max(self.buffer_limit,
+                                    backend.pack_max_blob_size)
+        self.chunking = chunking and backend.chunk_avg_size is not None
+        self.chunker = None
+        self.chunks = None
         self.incoming_file = None
         self.hasher = Hasher()
         self.file_id = None
+        self.size = 0
+        self.elapsed = 0.
+
+    def _add_chunks(self, chunks):
+        for chunk in chunks:
+            w = ContentWriter(self.backend, chunking=False)
+            self.chunks.append((w.write(chunk, done=True), len(chunk)))
+
+    def _flush_chunks(self):
+        group_commit = self.backend.group_commit
+        if group_commit is not None:
+            for shard_name in {self.backend.shard_name(f)
+                               for f, _ in self.chunks}:
+                group_commit.commit(shard_name)
+        if self.backend.sync_batch is not None:
+            self.backend.sync_batch.sync()
 
     def write(self, content, done=False):
+        start = time.perf_counter()
         if not isinstance(content,bytes):
             raise AssertionError(
                 f'expecting bytes, got: {type(content)} {content!r}')
+        self.size += len(content)
         self.hasher.update(content)
         if self.buffer is not None:
-            if MAX_DB_BLOB_SIZE > (len(self.buffer) + len(content)):
+            if self.buffer_limit > (len(self.buffer) + len(content)):
                 self.buffer += content
+            elif self.chunking:
+                self.chunker = Chunker(self.backend.chunk_avg_size)
+                self.chunks = []
+                self._add_chunks(self.chunker.feed(bytes(self.buffer)))
+                self.buffer = None
             else:
                 self.incoming_file = IncomingFile(self.backend)
                 if len(self.buffer) > 0:
                     self.incoming_file.write(self.buffer)
                 self.buffer = None
-        if self.buffer is None:
+        if self.chunker is not None:
+            self._add_chunks(self.chunker.feed(content))
+        elif self.buffer is None:
             self.incoming_file.write(content)
+        self.elapsed += time.perf_counter() - start
         if done:
             return self.done()
 
-    def done(self):
+    def done(self, flush=False):
+        '''
+        :param flush: with group commit or batched durability,
+                      commit and fsync blob before returning.
+                      Otherwise it is only queued.
+        :return: address of blob
+        '''
+        start = time.perf_counter()
+        tier = None
         if self.file_id is None:
             self.file_id = ContentAddress(self.hasher)
-            if self.buffer is not None:
-                lookup = DbLookup(self.backend, self.file_id)
-                lookup.save_content(self.buffer)
-                self.buffer = None
-            elif self.incoming_file is not None:
-                file_lookup = FileLookup(self.backend, self.file_id)
-                self.incoming_file.close(file_lookup)
-                self.incoming_file = None
+            group_commit = self.backend.group_commit
+            chunked = self.chunker is not None
+            if chunked:
+                # chunks are stored before blob itself
+                self._add_chunks(self.chunker.flush())
+                self.chunker = None
+            with self.backend.in_flight.storing(self.file_id):
+                small = self.buffer is not None and \
+                    len(self.buffer) < self.backend.db_max_blob_size
+                if not small or group_commit is None:
+                    # blob is indexed before it is stored, see
+                    # `AddressIndex`, queued blobs by `GroupCommit`
+                    self.backend.index.add([self.file_id])
+                stored = True
+                if small:
+                    tier = DbLookup.tier
+                    lookup = DbLookup(self.backend, self.file_id)
+                    if group_commit is None:
+                        stored = lookup.save_content(bytes(self.buffer))
+                    elif not lookup.found():
+                        group_commit.add(self.file_id, bytes(self.buffer))
+                    else:
+                        stored = False
+                    self.buffer = None
+                elif self.buffer is not None:
+                    tier = PackLookup.tier
+                    stored = False
+                    if not FileLookup(self.backend, self.file_id).found():
+                        lookup = PackLookup(self.backend, self.file_id)
+                        stored = lookup.save_content(bytes(self.buffer))
+                    self.buffer = None
+                elif self.incoming_file is not None:
+                    tier = FileLookup.tier
+                    file_lookup = FileLookup(self.backend, self.file_id)
+                    stored = self.incoming_file.close(file_lookup)
+                    self.incoming_file = None
+                elif chunked:
+                    tier = ManifestLookup.tier
+                    # single chunk is stored under address of blob
+                    size = sum(s for _, s in self.chunks)
+                    lookup = self.backend.lookup(self.file_id, size)
+                    if len(self.chunks) > 1 and (
+                            not lookup.found() or
+                            isinstance(lookup, ColdLookup)):
+                        # chunks have to be durable before manifest
+                        self._flush_chunks()
+                        ManifestLookup(self.backend, self.file_id)\
+                            .save_content(self.chunks, size)
+                    elif len(self.chunks) > 1:
+                        stored = False
+                else:
+                    raise AssertionError('what else: %r' % self.file_id )
+                if not stored:
+                    # same content written again
+                    self.backend.confirm([self.file_id])
+            if self.backend.bloom is not None:
+                self.backend.bloom.add(self.file_id.hash_bytes())
             else:
-                raise AssertionError('what else: %r' % self.file_id )
+                self.backend.drop_bloom_snapshot()
+        if flush and self.backend.group_commit is not None:
+            self.backend.group_commit.commit(
+                self.backend.shard_name(self.file_id))
+        if flush and self.backend.sync_batch is not None:
+            self.backend.sync_batch.sync()
+        if tier is not None:
+            self.elapsed += time.perf_counter() - start
+            metrics = self.backend.metrics
+            metrics.writes.observe(self.elapsed, tier=tier)
+            if tier != ManifestLookup.tier:
+                metrics.written_bytes.inc(self.size, tier=tier)
         return self.file_id
 
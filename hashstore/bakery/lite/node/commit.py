@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from hashstore.utils.fio import ensure_directory
+from . import blob
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class GroupCommit:
+    '''
+    Queues small blobs per shard and inserts them into `blob.db`
+    of the shard in single transaction, once shard queue has
+    `max_count` blobs or `max_bytes` of content, or when its oldest
+    blob waited for `max_delay` seconds. Queued blobs are visible
+    to lookups of this process right away, but they survive crash
+    only after commit. Rows are prepared (compressed) by writers
+    before they are queued, so lock is held only for bookkeeping.
+
+    '''
+    def __init__(self, store, max_count=1000, max_bytes=4 << 20,
+                 max_delay=1.0):
+        self.store = store
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = defaultdict(OrderedDict)
+        self.pending_bytes = defaultdict(int)
+        self.since = {}
+        self.commits = 0
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='group-commit', daemon=True)
+        self.thread.start()
+
+    def get(self, file_id):
+        with self.lock:
+            queue = self.pending.get(self.store.shard_name(file_id))
+            entry = None if queue is None else queue.get(file_id)
+            return None if entry is None else entry[0]
+
+    def add(self, file_id, content):
+        shard_name = self.store.shard_name(file_id)
+        row = self.store.blob_row(file_id, content)
+        with self.lock:
+            queue = self.pending[shard_name]
+            if file_id in queue:
+                return
+            if not queue:
+                self.since[shard_name] = time.monotonic()
+            queue[file_id] = (content, row)
+            self.pending_bytes[shard_name] += len(content)
+            full = len(queue) >= self.max_count or \
+                self.pending_bytes[shard_name] >= self.max_bytes
+        if full:
+            self.commit(shard_name)
+
+    def flush(self, shard_name=None):
+        with self.lock:
+            shard_names = list(self.pending) \
+                if shard_name is None else [shard_name]
+        for shard_name in shard_names:
+            self.commit(shard_name)
+
+    def commit(self, shard_name):
+        with self.lock:
+            queue = self.pending.get(shard_name)
+            if not queue:
+                return
+            rows = [row for _, row in queue.values()]
+        ensure_directory(os.path.join(self.store.root, shard_name))
+        # blobs are indexed before they are stored, see `AddressIndex`
+        self.store.index.add(row['file_id'] for row in rows)
+        with self.store.blob_dbf(shard_name) as blob_db:
+            blob_db.ensure_db()
+            with blob_db.engine().begin() as conn:
+                conn.execute(blob.insert().prefix_with('OR IGNORE'),
+                             rows)
+        with self.lock:
+            self.commits += 1
+            for row in rows:
+                entry = queue.pop(row['file_id'], None)
+                if entry is not None:
+                    self.pending_bytes[shard_name] -= len(entry[0])
+            if self.pending.get(shard_name) is not queue:
+                return  # concurrent commit already cleaned up
+            if queue:
+                self.since[shard_name] = time.monotonic()
+            else:
+                del self.pending[shard_name]
+                del self.pending_bytes[shard_name]
+                del self.since[shard_name]
+
+    def _run(self):
+        while not self.closed.wait(self.max_delay / 2):
+            now = time.monotonic()
+            with self.lock:
+                due = [shard_name
+                       for shard_name, since in self.since.items()
+                       if now - since >= self.max_delay]
+            for shard_name in due:
+                try:
+                    self.commit(shard_name)
+                except Exception:
+                    log.exception(f'group commit of {shard_name}')
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+
+class InFlightWrites:
+    '''
+    Addresses of blobs being stored by writers of `BlobStore`.
+    Writers that finish same blob at the same time store it one
+    after another, so second one finds blob already stored and
+    drops its copy instead of storing it again.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writes = {}
+
+    @contextmanager
+    def storing(self, file_id):
+        with self.lock:
+            entry = self.writes.get(file_id)
+            if entry is None:
+                entry = self.writes[file_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.writes[file_id]
+
+    def __len__(self):
+        return len(self.writes)
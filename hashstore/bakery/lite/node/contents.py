@@ -0,0 +1,201 @@
+import io
+import os
+import mmap
+import struct
+import sqlite3
+from contextlib import contextmanager
+
+from hashstore.utils.chunking import IterStream
+from hashstore.utils.compress import open_encoded
+from hashkernel.hashing import B36
+from hashkernel.file_types import file_types, HSB, BINARY
+from sqlalchemy import func, select
+from hashkernel.bakery import NotFoundError, CakeRole, Content
+from . import blob, ContentAddress
+
+
+class MappedContent(Content):
+    '''
+    File backed `Content` that is read through `mmap`, so it could
+    be streamed as `memoryview` slices without copying it into
+    python objects. `size` is known from lookup without a read.
+    '''
+    @contextmanager
+    def view(self):
+        with open(self.file, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                yield memoryview(b'')
+                return
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        try:
+            yield view
+        finally:
+            view.release()
+            try:
+                mm.close()
+            except BufferError:
+                pass  # slices still referenced, unmapped on collect
+
+    def chunks(self, chunk_size=1 << 20, start=0, stop=None):
+        with self.view() as view:
+            stop = len(view) if stop is None else min(stop, len(view))
+            for i in range(start, stop, chunk_size):
+                yield view[i:min(i + chunk_size, stop)]
+
+
+class CompressedContent(Content):
+    '''
+    Content of file that starts with header (see
+    `hashstore.utils.compress`), `stream()` and `chunks()`
+    return uncompressed content.
+    '''
+    def stream(self):
+        return open_encoded(self.file)
+
+    def chunks(self, chunk_size=1 << 20, start=0, stop=None):
+        with self.stream() as fp:
+            if fp.seekable():
+                fp.seek(start, io.SEEK_CUR)
+            else:
+                # compressed content is decompressed up to `start`
+                skip = start
+                while skip > 0:
+                    skipped = fp.read(min(skip, chunk_size))
+                    if not skipped:
+                        break
+                    skip -= len(skipped)
+            left = None if stop is None else stop - start
+            while left is None or left > 0:
+                n = chunk_size if left is None else min(chunk_size, left)
+                chunk = fp.read(n)
+                if not chunk:
+                    break
+                if left is not None:
+                    left -= len(chunk)
+                yield chunk
+
+
+MANIFEST_ENTRY = struct.Struct('>32sQ')
+
+
+def pack_manifest(chunks):
+    '''
+    :param chunks: sequence of `(file_id, size)` of chunks
+    '''
+    return b''.join(MANIFEST_ENTRY.pack(file_id.hash_bytes(), size)
+                    for file_id, size in chunks)
+
+
+def parse_manifest(data):
+    return [(ContentAddress(B36.encode(h)), size)
+            for h, size in MANIFEST_ENTRY.iter_unpack(data)]
+
+
+class ChunkedContent(Content):
+    '''
+    Content of blob stored as chunks (see `Manifest`), chunks are
+    fetched from store one by one, as content is streamed.
+    '''
+    @classmethod
+    def from_chunks(cls, store, chunks, role: CakeRole):
+        file_type = HSB if role == CakeRole.NEURON else BINARY
+        content = cls(file_type=file_type,
+                      mime=file_types[file_type].mime)
+        content.store = store
+        content.chunk_list = chunks
+        return content
+
+    def stream(self):
+        return io.BufferedReader(IterStream(self.chunks()))
+
+    def chunks(self, chunk_size=1 << 20, start=0, stop=None):
+        offset = 0
+        for file_id, size in self.chunk_list:
+            end = offset + size
+            if stop is not None and offset >= stop:
+                break
+            if start < end:
+                # only chunks that overlap with range are fetched
+                content = self.store.get_content(file_id, size_hint=size)
+                yield from content_chunks(
+                    content, chunk_size, max(start - offset, 0),
+                    None if stop is None else stop - offset)
+            offset = end
+
+
+# incremental blob io is in `sqlite3` since python 3.11
+BLOBOPEN = hasattr(sqlite3.Connection, 'blobopen')
+
+
+class DbContent(Content):
+    '''
+    Content of uncompressed blob in `blob.db` that is read chunk by
+    chunk: with incremental blob io (`blobopen`) where it is
+    available, otherwise with `substr()` queries. Shard is leased
+    for one chunk at a time, so slow reader does not hold
+    connection of shard.
+    '''
+    @classmethod
+    def from_lookup(cls, lookup, role: CakeRole):
+        file_type = HSB if role == CakeRole.NEURON else BINARY
+        content = cls(file_type=file_type,
+                      mime=file_types[file_type].mime,
+                      size=lookup.size)
+        content.lookup = lookup
+        return content
+
+    def stream(self):
+        return io.BufferedReader(IterStream(self.chunks()))
+
+    def chunks(self, chunk_size=1 << 20, start=0, stop=None):
+        lookup = self.lookup
+        stop = lookup.size if stop is None else min(stop, lookup.size)
+        for offset in range(start, stop, chunk_size):
+            n = min(chunk_size, stop - offset)
+            with lookup.blob_db() as blob_db:
+                if BLOBOPEN:
+                    chunk = self._blob_read(blob_db, offset, n)
+                else:
+                    chunk = blob_db.execute(select([
+                            func.substr(blob.c.content, offset + 1, n)
+                        ]).where(blob.c.file_id == lookup.file_id)
+                    ).scalar()
+            if chunk is None or len(chunk) != n:
+                raise NotFoundError(f'{lookup.file_id} is gone')
+            yield chunk
+
+    def _blob_read(self, blob_db, offset, n):
+        conn = blob_db.engine().raw_connection()
+        try:
+            row = conn.connection.execute(
+                'SELECT rowid FROM blob WHERE file_id = ?',
+                (str(self.lookup.file_id),)).fetchone()
+            if row is None:
+                return None
+            with conn.connection.blobopen('blob', 'content', row[0],
+                                          readonly=True) as fp:
+                fp.seek(offset)
+                return fp.read(n)
+        finally:
+            conn.close()
+
+
+# content types that could be streamed with `chunks()`
+STREAMED_CONTENT = (MappedContent, CompressedContent, ChunkedContent,
+                    DbContent)
+
+
+def content_chunks(content, chunk_size=1 << 20, start=0, stop=None):
+    '''
+    Chunks of bytes `start:stop` of `content`. Only that part of
+    `STREAMED_CONTENT` is read, content that is not streamed is
+    sliced in memory.
+    '''
+    if isinstance(content, STREAMED_CONTENT):
+        yield from content.chunks(chunk_size, start, stop)
+        return
+    data = content.get_data()
+    stop = len(data) if stop is None else min(stop, len(data))
+    for i in range(start, stop, chunk_size):
+        yield data[i:min(i + chunk_size, stop)]
@@ -0,0 +1,76 @@
+import enum
+import threading
+
+from hashstore.utils.fio import fsync_path
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Durability(enum.Enum):
+    '''
+    When file blobs (and pack files) reach the disk:
+
+    `strict` - file and its directory are fsynced before writer's
+    `done()` returns.
+
+    `batched` - files and directories of recent blobs are fsynced
+    together every `sync_interval` seconds, and on `flush()`
+    and `close()`.
+
+    `relaxed` - left to OS.
+    '''
+    strict = 0
+    batched = 1
+    relaxed = 2
+
+
+class SyncBatch:
+    '''
+    Files and directories waiting for `fsync`, synced by background
+    thread every `interval` seconds. Files are synced before
+    directories, so directory entries never outlive content they
+    point to.
+    '''
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files = set()
+        self.dirs = set()
+        self.syncs = 0
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='sync-batch', daemon=True)
+        self.thread.start()
+
+    def add(self, file, dirs=()):
+        with self.lock:
+            self.files.add(file)
+            self.dirs.update(dirs)
+
+    def sync(self):
+        with self.lock:
+            files, self.files = self.files, set()
+            dirs, self.dirs = self.dirs, set()
+        for path in files:
+            try:
+                fsync_path(path)
+            except FileNotFoundError:
+                pass  # removed meanwhile
+        for path in dirs:
+            fsync_path(path)
+        if files or dirs:
+            self.syncs += 1
+
+    def _run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.sync()
+            except Exception:
+                log.exception('batched fsync')
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.sync()
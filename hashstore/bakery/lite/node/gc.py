@@ -0,0 +1,271 @@
+import os
+import time
+import datetime
+from io import BytesIO
+
+from hashkernel import utf8_reader
+from hashkernel.bakery import CakeRack, CakeRole, NotFoundError
+from hashkernel.hashing import shard_name_int
+from sqlalchemy import select, and_, or_, column
+from hashstore.utils.db import Dbf
+from . import (GcBase, gc_state, gc_mark, gc_queue, Portal,
+               PortalHistory, VolatileTree, ContentAddress)
+from .blobs import pid_lock, COLLECTING_CHECK_INTERVAL
+import logging
+
+
+log = logging.getLogger(__name__)
+
+MARK = 'mark'
+WALK = 'walk'
+SWEEP = 'sweep'
+DONE = 'done'
+
+
+class GcAlreadyRunning(Exception):
+    pass
+
+
+class GarbageCollector:
+    '''
+    Mark-and-sweep of blobs that are not reachable from:
+
+     * `Portal.latest` of active portals,
+     * `PortalHistory` entries of last `retention_days`,
+     * `VolatileTree` entries that are current or were ended
+       within last `retention_days`,
+
+    bundles are walked recursively thru `CakeRack`, chunks of
+    chunked blobs are marked along with them. Progress is kept
+    in `gc.db` and committed after every step, so `run()` could be
+    interrupted at any point or limited by `max_seconds`, next
+    `run()` resumes where previous one stopped.
+
+    Collection runs along with the server: blobs created later
+    then `grace` before collection started or confirmed to writer
+    while it is in progress (see `BlobStore.confirm`) are never
+    swept, and portals, history and tree entries added while
+    collection is running are marked again at least every
+    `remark_interval` while shards are swept.
+
+    '''
+    def __init__(self, store, retention_days=30,
+                 grace=datetime.timedelta(days=1),
+                 remark_interval=datetime.timedelta(minutes=1),
+                 remark_overlap=datetime.timedelta(minutes=10),
+                 batch=500):
+        self.store = store
+        self.retention = datetime.timedelta(days=retention_days)
+        self.grace = grace
+        self.remark_interval = remark_interval
+        self.remark_overlap = remark_overlap
+        self.batch = batch
+        self.gc_db = Dbf(GcBase.metadata,
+                         os.path.join(store.store_dir, 'gc.db'))
+        self.lock_file = os.path.join(store.store_dir, 'gc.lock')
+
+    def blob_store(self):
+        return self.store.blob_store()
+
+    def state(self):
+        if not self.gc_db.exists():
+            return None
+        row = self.gc_db.execute(select([gc_state])).first()
+        return None if row is None else dict(row)
+
+    def _update(self, **values):
+        self.gc_db.execute(gc_state.update().values(**values))
+
+    def start(self):
+        now = datetime.datetime.utcnow()
+        self.gc_db.ensure_db()
+        for table in (gc_mark, gc_queue, gc_state):
+            self.gc_db.execute(table.delete())
+        self.gc_db.execute(gc_state.insert().values(
+            phase=MARK, cursor=0, started_dt=now,
+            retain_since_dt=now - self.retention,
+            remarked_dt=now, marked=0, swept=0))
+        self.blob_store().set_collecting(True)
+        # writers of other processes notice marker before sweep
+        time.sleep(COLLECTING_CHECK_INTERVAL)
+
+    def run(self, max_seconds=None, restart=False):
+        '''
+        :param max_seconds: stop after that many seconds, next run
+                            continues from there
+        :param restart: drop progress of unfinished collection
+        :return: state of collection
+        '''
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        with pid_lock(self.lock_file, GcAlreadyRunning):
+            state = self.state()
+            if restart or state is None or state['phase'] == DONE:
+                self.start()
+                state = self.state()
+            while state['phase'] != DONE:
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                getattr(self, '_' + state['phase'])(state)
+                state = self.state()
+            return state
+
+    def _mark(self, state):
+        shard_dbs = self.store.cake_shard_dbs()
+        i = state['cursor']
+        if i >= len(shard_dbs):
+            self._update(phase=WALK, cursor=0)
+            return
+        if shard_dbs[i].exists():
+            since = state['retain_since_dt']
+            self._mark_roots(
+                shard_dbs[i],
+                Portal.active == True,
+                PortalHistory.dt >= since,
+                or_(VolatileTree.end_dt == None,
+                    VolatileTree.end_dt >= since))
+        self._update(cursor=i + 1)
+
+    def _remark(self, state):
+        now = datetime.datetime.utcnow()
+        since = state['remarked_dt'] - self.remark_overlap
+        retain_since = state['retain_since_dt']
+        for shard_db in self.store.cake_shard_dbs():
+            if shard_db.exists():
+                self._mark_roots(
+                    shard_db,
+                    and_(Portal.active == True,
+                         or_(Portal.created_dt >= since,
+                             Portal.updated_dt >= since)),
+                    and_(PortalHistory.dt >= since,
+                         PortalHistory.dt >= retain_since),
+                    and_(VolatileTree.start_dt >= since,
+                         or_(VolatileTree.end_dt == None,
+                             VolatileTree.end_dt >= retain_since)))
+        self._update(remarked_dt=now)
+
+    def _mark_roots(self, shard_db, portal_cond, history_cond,
+                    vtree_cond):
+        rowid = column('rowid')
+        queries = (
+            (Portal.latest, and_(Portal.latest != None, portal_cond)),
+            (PortalHistory.cake, history_cond),
+            (VolatileTree.cake,
+             and_(VolatileTree.cake != None, vtree_cond)))
+        for cake_column, condition in queries:
+            # short read transactions, so writers are not blocked
+            last = 0
+            while True:
+                rows = shard_db.execute(
+                    select([rowid, cake_column.label('cake')])
+                    .where(and_(condition, rowid > last))
+                    .order_by(rowid).limit(self.batch)).fetchall()
+                if not rows:
+                    break
+                last = rows[-1].rowid
+                self._mark_cakes(row.cake for row in rows)
+
+    def _mark_cakes(self, cakes):
+        bundles = {}
+        addresses = set()
+        for cake in cakes:
+            if cake is None or not cake.is_immutable():
+                continue  # portals are marked on their own
+            if cake.has_data():
+                if cake.header.role == CakeRole.NEURON:
+                    bundles[cake] = None
+                continue
+            file_id = ContentAddress(cake)
+            addresses.add(file_id)
+            if cake.header.role == CakeRole.NEURON:
+                bundles[cake] = file_id
+        if not addresses and not bundles:
+            return
+        new = addresses - self._marked(list(addresses))
+        chunks = set(self.blob_store().manifest_chunks(new)) - new
+        new.update(chunks - self._marked(list(chunks)))
+        with self.gc_db.engine().begin() as conn:
+            if new:
+                conn.execute(gc_mark.insert(),
+                             [dict(file_id=f) for f in new])
+                conn.execute(gc_state.update().values(
+                    marked=gc_state.c.marked + len(new)))
+            walk = [dict(cake=cake) for cake, file_id in bundles.items()
+                    if file_id is None or file_id in new]
+            if walk:
+                conn.execute(gc_queue.insert().prefix_with('OR IGNORE'),
+                             walk)
+
+    def _marked(self, file_ids):
+        marked = set()
+        for i in range(0, len(file_ids), self.batch):
+            marked.update(row.file_id for row in self.gc_db.execute(
+                select([gc_mark.c.file_id]).where(
+                    gc_mark.c.file_id.in_(file_ids[i:i + self.batch]))))
+        return marked
+
+    def _walk_batch(self):
+        '''
+        :return: `True` if there were bundles to walk
+        '''
+        cakes = [row.cake for row in self.gc_db.execute(
+            select([gc_queue.c.cake]).limit(self.batch))]
+        if not cakes:
+            return False
+        children = []
+        for cake in cakes:
+            try:
+                if cake.has_data():
+                    data = cake.data()
+                else:
+                    data = self.blob_store().get_content(cake).get_data()
+            except NotFoundError:
+                log.warning(f'bundle is missing: {cake}')
+                continue
+            rack = CakeRack(utf8_reader(BytesIO(data)))
+            children.extend(rack[name] for name in rack)
+        self._mark_cakes(children)
+        for i in range(0, len(cakes), self.batch):
+            self.gc_db.execute(gc_queue.delete().where(
+                gc_queue.c.cake.in_(cakes[i:i + self.batch])))
+        return True
+
+    def _walk(self, state):
+        if not self._walk_batch():
+            self._update(phase=SWEEP, cursor=0)
+
+    def _sweep(self, state):
+        if self._walk_batch():
+            return
+        now = datetime.datetime.utcnow()
+        if state['remarked_dt'] <= state['started_dt'] or \
+                now - state['remarked_dt'] > self.remark_interval:
+            self._remark(state)
+            return
+        shard_n = state['cursor']
+        max_shards = self.blob_store().max_shards()
+        while shard_n < max_shards and not os.path.isdir(
+                os.path.join(self.blob_store().root,
+                             shard_name_int(shard_n))):
+            shard_n += 1
+        if shard_n >= max_shards:
+            self._update(phase=DONE, finished_dt=now)
+            self.blob_store().set_collecting(False)
+            return
+        shard_name = shard_name_int(shard_n)
+        cutoff = state['started_dt'] - self.grace
+        candidates = list(self.blob_store().shard_blobs(
+            shard_name, created_before=cutoff))
+        marked = self._marked(candidates)
+        garbage = [f for f in candidates if f not in marked]
+        # could be referenced by writer that skipped their upload
+        confirmed = self.blob_store().confirmed_since(garbage, cutoff)
+        garbage = [f for f in garbage if f not in confirmed]
+        swept = 0
+        if garbage:
+            swept = self.blob_store().remove(garbage)
+            log.info(f'swept {swept} blobs from {shard_name}')
+        self.blob_store().forget_confirmed(shard_name, cutoff)
+        self._update(cursor=shard_n + 1,
+                     swept=state['swept'] + swept)
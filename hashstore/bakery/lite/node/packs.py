@@ -0,0 +1,141 @@
+import os
+import time
+import uuid
+import threading
+
+from hashstore.utils.fio import ensure_directory
+import logging
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+PACK_EXT = '.pack'
+SEALED_EXT = '.sealed'
+
+
+class Packs:
+    '''
+    Append-only pack files in `<root>/packs`. Each `BlobStore`
+    appends into its own active pack, so several processes could
+    write into same store. Pack is sealed when it grows over
+    `pack_file_size` or when store is closed, only sealed packs
+    are considered by repack. Writer holds `flock` on its active
+    pack, so pack of writer that crashed is sealed by first
+    `sealed()` that gets the lock.
+
+    Offset index of pack entries lives in `blob.db` of the shard
+    of every blob, so pack itself is just concatenated content.
+
+    '''
+    def __init__(self, root, pack_file_size=1 << 30):
+        self.dir = os.path.join(root, 'packs')
+        self.pack_file_size = pack_file_size
+        self.lock = threading.Lock()
+        self.active_id = None
+        self.active_fp = None
+
+    def exists(self):
+        return os.path.isdir(self.dir)
+
+    def path(self, pack_id, ext=PACK_EXT):
+        return os.path.join(self.dir, pack_id + ext)
+
+    def append(self, data):
+        '''
+        :return: `(pack_id, offset)` where data was written
+        '''
+        with self.lock:
+            if self.active_fp is not None and \
+                    self.active_fp.tell() + len(data) > \
+                    self.pack_file_size:
+                self._seal()
+            if self.active_fp is None:
+                ensure_directory(self.dir)
+                self.active_id = '%013d-%s' % (int(time.time() * 1000),
+                                               uuid.uuid4().hex)
+                # pack is locked before it is visible to `sealed()`
+                tmp = self.path(self.active_id, '.tmp')
+                self.active_fp = open(tmp, 'ab')
+                if fcntl is not None:
+                    fcntl.flock(self.active_fp.fileno(), fcntl.LOCK_EX)
+                os.rename(tmp, self.path(self.active_id))
+            offset = self.active_fp.tell()
+            self.active_fp.write(data)
+            self.active_fp.flush()
+            return self.active_id, offset
+
+    def _seal(self):
+        open(self.path(self.active_id, SEALED_EXT), 'wb').close()
+        self.active_fp.close()
+        log.debug(f'sealed pack: {self.active_id}')
+        self.active_fp = None
+        self.active_id = None
+
+    def close(self):
+        with self.lock:
+            if self.active_fp is not None:
+                self._seal()
+
+    def read(self, pack_id, offset, size):
+        with open(self.path(pack_id), 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(size)
+        if len(data) != size:
+            raise AssertionError(f'truncated pack {pack_id}: '
+                                 f'{len(data)} != {size}')
+        return data
+
+    def _abandoned(self, pack_id):
+        '''
+        Seal pack that is not locked by its writer anymore.
+
+        :return: `True` if pack was sealed
+        '''
+        if fcntl is None:  # pragma: no cover
+            return False
+        try:
+            with open(self.path(pack_id), 'rb') as fp:
+                try:
+                    fcntl.flock(fp.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                log.warning(f'sealing abandoned pack: {pack_id}')
+                open(self.path(pack_id, SEALED_EXT), 'wb').close()
+                return True
+        except FileNotFoundError:
+            return False
+
+    def sealed(self):
+        '''
+        :return: dict of `pack_id` to file size of all packs that
+                 are not going to be appended anymore
+        '''
+        packs = {}
+        if not self.exists():
+            return packs
+        with self.lock:
+            active_id = self.active_id
+        names = set(os.listdir(self.dir))
+        for name in names:
+            if not name.endswith(PACK_EXT):
+                continue
+            pack_id = name[:-len(PACK_EXT)]
+            if pack_id == active_id:
+                continue
+            if pack_id + SEALED_EXT in names or \
+                    self._abandoned(pack_id):
+                packs[pack_id] = os.path.getsize(
+                    os.path.join(self.dir, name))
+        return packs
+
+    def remove(self, pack_id):
+        os.remove(self.path(pack_id))
+        try:
+            os.remove(self.path(pack_id, SEALED_EXT))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+
+from hashkernel.hashing import shard_name_int
+from . import MAX_NUM_OF_SHARDS
+from .blobs import pid_lock
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class ReshardAlreadyRunning(Exception):
+    pass
+
+
+class ShardMigration:
+    '''
+    Changes number of shards of `BlobStore` of `CakeStore`. New
+    number of shards is recorded in `ServerKey` right away, along
+    with old one, so store opened meanwhile writes blobs into new
+    layout and finds blobs that are not moved yet at their old
+    location. Shards of old layout are migrated one by one (see
+    `BlobStore.migrate_shard`) and progress is checkpointed in
+    `ServerKey`, so migration could be spread over many
+    `run(max_seconds)` calls and it is run by server in background.
+    Old layout is dropped from `ServerKey` once every shard of it
+    is migrated.
+
+    Only process that runs migration should write into store
+    opened before migration was started: such process still writes
+    into old layout until it calls `pick_up()`. Running server polls
+    `pick_up()`, so migration started by `hs server reshard` is
+    run by server.
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.lock_file = os.path.join(store.store_dir, 'reshard.lock')
+        self.stopped = threading.Event()
+
+    def state(self):
+        skey = self.store.server_config()
+        return dict(
+            num_shards=skey.num_blob_shards or MAX_NUM_OF_SHARDS,
+            prev_num_shards=skey.prev_num_blob_shards,
+            migrated=skey.blob_shards_migrated)
+
+    def pending(self):
+        return self.state()['prev_num_shards'] is not None
+
+    def start(self, num_shards):
+        state = self.state()
+        if state['num_shards'] == num_shards:
+            return
+        if state['prev_num_shards'] is not None:
+            raise ValueError(
+                f'migration from {state["prev_num_shards"]} to '
+                f'{state["num_shards"]} shards is not finished')
+        blob_store = self.store.blob_store()
+        blob_store.flush()
+        blob_store.set_shards(num_shards, state['num_shards'])
+        self.store.update_server_config(
+            num_blob_shards=num_shards,
+            prev_num_blob_shards=state['num_shards'],
+            blob_shards_migrated=0)
+        log.info(f'migration from {state["num_shards"]} to '
+                 f'{num_shards} shards started')
+
+    def pick_up(self):
+        '''
+        switch `BlobStore` of this process into layout recorded in
+        `ServerKey`, migration could be started by other process
+
+        :return: `True` if migration is pending
+        '''
+        state = self.state()
+        if state['prev_num_shards'] is None:
+            return False
+        blob_store = self.store.blob_store()
+        if blob_store.num_shards != state['num_shards']:
+            # queued blobs are committed into shards of old layout
+            blob_store.flush()
+            blob_store.set_shards(state['num_shards'],
+                                  state['prev_num_shards'])
+            log.info(f'picked up migration to {state["num_shards"]} '
+                     f'shards')
+        return True
+
+    def run(self, max_seconds=None):
+        '''
+        :param max_seconds: don't start new shards after that many
+                            seconds, next run continues from there
+        :return: state of migration
+        '''
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        with pid_lock(self.lock_file, ReshardAlreadyRunning):
+            state = self.state()
+            if state['prev_num_shards'] is None:
+                return state
+            blob_store = self.store.blob_store()
+            shard_n = state['migrated'] or 0
+            while shard_n < state['prev_num_shards']:
+                if self.stopped.is_set() or (
+                        deadline is not None and
+                        time.monotonic() > deadline):
+                    return self.state()
+                shard_name = shard_name_int(shard_n)
+                shard_n += 1
+                if not os.path.isdir(os.path.join(blob_store.root,
+                                                  shard_name)):
+                    continue
+                moved = blob_store.migrate_shard(shard_name)
+                log.info(f'moved {moved} blobs from {shard_name}')
+                self.store.update_server_config(
+                    blob_shards_migrated=shard_n)
+            blob_store.set_shards(state['num_shards'])
+            self.store.update_server_config(
+                prev_num_blob_shards=None, blob_shards_migrated=None)
+            log.info(f'migration to {state["num_shards"]} shards '
+                     f'finished')
+            return self.state()
+
+    def stop(self):
+        '''
+        make `run()` return after shard that is being migrated
+        '''
+        self.stopped.set()
@@ -0,0 +1,322 @@
+import os
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from hashkernel.hashing import Hasher
+from sqlalchemy import select, and_, column
+from sqlalchemy.exc import DatabaseError
+from hashstore.utils.compress import open_encoded, DECODE_ERRORS
+from hashstore.utils.db import Dbf
+from hashstore.utils.fio import ensure_directory
+from hashstore.utils.throttle import RateLimiter
+from . import (ScrubBase, scrub_state, scrub_shard, scrub_corrupt,
+               blob, pack_entry, cold_entry, ContentAddress)
+from .blobs import pid_lock
+import logging
+
+
+log = logging.getLogger(__name__)
+
+DB = 'db'
+PACK = 'pack'
+FILE = 'file'
+
+# prefix of checkpoints and locations of cold tier
+COLD = 'cold'
+
+
+class ScrubAlreadyRunning(Exception):
+    pass
+
+
+class Scrubber:
+    '''
+    Verifies integrity of `BlobStore`: every blob in `blob.db`,
+    pack files and shard directories is rehashed and compared with
+    its address. Corrupt copy is moved into `<root>/quarantine`
+    as `<address>.<location>`, dropped from index and recorded in
+    `scrub_corrupt` table of `scrub.db`, so lookup no longer serves
+    it and blob could be uploaded again.
+
+    Shards are scrubbed by `workers` threads in parallel, all
+    reads together are capped at `bytes_per_sec`. Shard is
+    checkpointed in `scrub.db` when it is done, so pass over whole
+    store could be spread over many `run(max_seconds)` calls.
+    Shard that was started before deadline is finished.
+
+    Shards of cold tier are scrubbed too, they are checkpointed as
+    `cold/<shard>` and their corrupt blobs are quarantined as
+    `<address>.cold-<location>`. Blob that is lost in cold tier is
+    dropped from `cold_entry` of hot tier.
+
+    '''
+    def __init__(self, store, bytes_per_sec=None, workers=4,
+                 batch=100, chunk_size=1 << 20):
+        self.store = store
+        self.limiter = RateLimiter(bytes_per_sec)
+        self.workers = workers
+        self.batch = batch
+        self.chunk_size = chunk_size
+        self.scrub_db = Dbf(ScrubBase.metadata,
+                            os.path.join(store.root, 'scrub.db'))
+        self.lock_file = os.path.join(store.root, 'scrub.lock')
+        self.quarantine_dir = os.path.join(store.root, 'quarantine')
+
+    def state(self):
+        if not self.scrub_db.exists():
+            return None
+        row = self.scrub_db.execute(select([scrub_state])).first()
+        return None if row is None else dict(row)
+
+    def corrupt(self):
+        '''
+        :return: list of `(file_id, location, path)` of all
+                 quarantined blobs
+        '''
+        if not self.scrub_db.exists():
+            return []
+        return [(row.file_id, row.location, row.path)
+                for row in self.scrub_db.execute(select([
+                    scrub_corrupt.c.file_id, scrub_corrupt.c.location,
+                    scrub_corrupt.c.path]))]
+
+    def start(self):
+        state = self.state()
+        pass_no = 1 if state is None else state['pass_no'] + 1
+        self.scrub_db.ensure_db()
+        self.scrub_db.execute(scrub_state.delete())
+        self.scrub_db.execute(scrub_state.insert().values(
+            pass_no=pass_no, started_dt=datetime.datetime.utcnow(),
+            checked=0, checked_bytes=0, corrupt=0))
+
+    def run(self, max_seconds=None, restart=False):
+        '''
+        :param max_seconds: don't start new shards after that many
+                            seconds, next run continues from there
+        :param restart: start new pass even if current one is not
+                        finished
+        :return: state of pass
+        '''
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        with pid_lock(self.lock_file, ScrubAlreadyRunning):
+            state = self.state()
+            if restart or state is None or \
+                    state['finished_dt'] is not None:
+                self.start()
+                state = self.state()
+            pass_no = state['pass_no']
+            done = {row.shard_name for row in self.scrub_db.execute(
+                select([scrub_shard.c.shard_name])
+                .where(scrub_shard.c.pass_no == pass_no))}
+            todo = sorted(set(self._shards()) - done)
+            finished = True
+            with ThreadPoolExecutor(self.workers) as executor:
+                futures = [executor.submit(self._scrub_shard,
+                                           key, deadline)
+                           for key in todo]
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result is None:
+                        finished = False
+                    else:
+                        self._checkpoint(pass_no, *result)
+            if finished:
+                self.scrub_db.execute(scrub_state.update().values(
+                    finished_dt=datetime.datetime.utcnow()))
+            return self.state()
+
+    def _shards(self):
+        '''
+        yields checkpoint keys of shards of both tiers
+        '''
+        yield from self.store.shard_names()
+        if self.store.cold is not None:
+            for shard_name in self.store.cold.shard_names():
+                yield f'{COLD}/{shard_name}'
+
+    def _checkpoint(self, pass_no, shard_name, checked, checked_bytes,
+                    corrupt):
+        with self.scrub_db.engine().begin() as conn:
+            conn.execute(scrub_shard.insert().prefix_with('OR REPLACE'),
+                         shard_name=shard_name, pass_no=pass_no)
+            if corrupt:
+                conn.execute(
+                    scrub_corrupt.insert().prefix_with('OR REPLACE'),
+                    [dict(file_id=file_id, location=location, path=path)
+                     for file_id, location, path in corrupt])
+            conn.execute(scrub_state.update().values(
+                checked=scrub_state.c.checked + checked,
+                checked_bytes=scrub_state.c.checked_bytes +
+                              checked_bytes,
+                corrupt=scrub_state.c.corrupt + len(corrupt)))
+
+    def _scrub_shard(self, key, deadline):
+        '''
+        :param key: `shard_name`, or `cold/<shard_name>` for shard of
+                    cold tier
+        :return: `None` if deadline passed, otherwise tuple of
+                 `key`, number of checked blobs, number of
+                 checked bytes and list of corrupt blobs
+        '''
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        tier, _, shard_name = key.rpartition('/')
+        store = self.store if tier == '' else self.store.cold
+        prefix = '' if tier == '' else f'{tier}-'
+        counts = [0, 0]
+        corrupt = []
+        for check in (self._check_db, self._check_packs,
+                      self._check_files):
+            for file_id, size, location, path in check(store,
+                                                       shard_name,
+                                                       prefix):
+                counts[0] += 1
+                counts[1] += size
+                if location is not None:
+                    log.error(f'corrupt blob {file_id} in {location} '
+                              f'quarantined: {path}')
+                    corrupt.append((file_id, location, path))
+        # blob could have good copy in other location
+        lost = [file_id for file_id, _, _ in corrupt
+                if not store.lookup(file_id).found()]
+        store.index.discard(lost)
+        if store is not self.store:
+            self._drop_cold_entries(lost)
+        return (key, counts[0], counts[1], corrupt)
+
+    def _drop_cold_entries(self, file_ids):
+        for file_id in file_ids:
+            with self.store.blob_dbf(
+                    self.store.shard_name(file_id)) as blob_db:
+                if blob_db.exists():
+                    blob_db.execute(cold_entry.delete().where(
+                        cold_entry.c.file_id == file_id))
+            self.store.cache.discard(file_id)
+        self.store.index.discard(
+            file_id for file_id in file_ids
+            if not self.store.lookup(file_id).found())
+
+    def _verify(self, file_id, data):
+        self.limiter.consume(len(data))
+        return file_id.match(Hasher(data))
+
+    def _quarantine_path(self, file_id, location):
+        ensure_directory(self.quarantine_dir)
+        return os.path.join(self.quarantine_dir,
+                            f'{file_id}.{location}')
+
+    def _quarantine_data(self, store, file_id, location, data):
+        path = self._quarantine_path(file_id, location)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        store.cache.discard(file_id)
+        return path
+
+    def _check_db(self, store, shard_name, prefix=''):
+        '''
+        yields `(file_id, size, location, path)` where `location`
+        and `path` are `None` for good blobs, `prefix` is prepended
+        to location of corrupt blob
+        '''
+        rowid = column('rowid')
+        last = 0
+        while True:
+            with store.blob_dbf(shard_name) as blob_db:
+                if not blob_db.exists():
+                    return
+                try:
+                    rows = blob_db.execute(
+                        select([rowid, blob.c.file_id, blob.c.content,
+                                blob.c.codec])
+                        .where(rowid > last)
+                        .order_by(rowid).limit(self.batch)).fetchall()
+                except DatabaseError:
+                    log.exception(f'cannot read blob.db of {shard_name}')
+                    return
+            if not rows:
+                return
+            last = rows[-1].rowid
+            for row in rows:
+                data = row.content
+                if row.codec is not None:
+                    try:
+                        data = row.codec.decompress(data)
+                    except DECODE_ERRORS:
+                        pass  # stored bytes are quarantined as is
+                if self._verify(row.file_id, data):
+                    yield row.file_id, len(data), None, None
+                    continue
+                location = prefix + DB
+                path = self._quarantine_data(store, row.file_id,
+                                             location, row.content)
+                with store.blob_dbf(shard_name) as blob_db:
+                    blob_db.execute(blob.delete().where(
+                        blob.c.file_id == row.file_id))
+                yield row.file_id, len(data), location, path
+
+    def _check_packs(self, store, shard_name, prefix=''):
+        with store.blob_dbf(shard_name) as blob_db:
+            if not blob_db.exists():
+                return
+            entries = blob_db.execute(select([
+                pack_entry.c.file_id, pack_entry.c.pack_id,
+                pack_entry.c.offset, pack_entry.c.size])).fetchall()
+        for entry in entries:
+            try:
+                data = store.packs.read(
+                    entry.pack_id, entry.offset, entry.size)
+            except FileNotFoundError:
+                continue  # repacked meanwhile, checked in next pass
+            except AssertionError:
+                data = b''  # truncated pack
+            if self._verify(entry.file_id, data):
+                yield entry.file_id, entry.size, None, None
+                continue
+            location = prefix + PACK
+            path = self._quarantine_data(store, entry.file_id,
+                                         location, data)
+            with store.blob_dbf(shard_name) as blob_db:
+                blob_db.execute(pack_entry.delete().where(and_(
+                    pack_entry.c.file_id == entry.file_id,
+                    pack_entry.c.pack_id == entry.pack_id)))
+            yield entry.file_id, entry.size, location, path
+
+    def _check_files(self, store, shard_name, prefix=''):
+        shard_dir = os.path.join(store.root, shard_name)
+        try:
+            with os.scandir(shard_dir) as entries:
+                names = [e.name for e in entries if len(e.name) > 48]
+        except FileNotFoundError:
+            return
+        for name in names:
+            file_id = ContentAddress(name)
+            file = os.path.join(shard_dir, name)
+            hasher = Hasher()
+            size = 0
+            try:
+                with open_encoded(file) as fp:
+                    while True:
+                        chunk = fp.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        self.limiter.consume(len(chunk))
+                        hasher.update(chunk)
+                        size += len(chunk)
+            except FileNotFoundError:
+                continue  # removed by gc meanwhile
+            except DECODE_ERRORS:
+                pass  # undecodable, does not match
+            if file_id.match(hasher):
+                yield file_id, size, None, None
+                continue
+            location = prefix + FILE
+            path = self._quarantine_path(file_id, location)
+            try:
+                os.replace(file, path)
+            except FileNotFoundError:
+                continue
+            store.cache.discard(file_id)
+            yield file_id, size, location, path
@@ -0,0 +1,298 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from hashstore.utils.db import Dbf
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
+from . import blob_meta
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+BLOB_DB_VERSION = 7
+
+
+class BlobDbf(Dbf):
+    '''
+    `blob.db` of one shard. Version of schema is kept in
+    `PRAGMA user_version`. Shards written by older versions are
+    brought to current schema in place, in single transaction,
+    so other processes either see old or new tables: missing
+    tables are created, new trailing nullable columns are added and tables
+    with otherwise different columns are rebuilt.
+
+    '''
+    def __init__(self, path, **engine_kwargs):
+        Dbf.__init__(self, blob_meta, path, **engine_kwargs)
+        self.leases = 0
+        self._exists = False
+        self._ensured = False
+
+    def exists(self):
+        if not self._exists:
+            self._exists = Dbf.exists(self)
+        return self._exists
+
+    def ensure_db(self):
+        if not self._ensured:
+            Dbf.ensure_db(self)
+            self.migrate()
+            self._ensured = True
+
+    def version(self):
+        return self.execute('PRAGMA user_version').scalar()
+
+    def migrate(self):
+        if self.version() >= BLOB_DB_VERSION:
+            return False
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] \
+                    < BLOB_DB_VERSION:
+                for table in blob_meta.sorted_tables:
+                    columns = [r[1] for r in conn.execute(
+                        f'PRAGMA table_info({table.name})')]
+                    names = [c.name for c in table.c]
+                    if not columns:
+                        self._create(conn, table)
+                    elif names[:len(columns)] == columns:
+                        self._add_columns(conn, table, columns)
+                    elif columns != names:
+                        self._rebuild(conn, table, columns)
+                # rows written before `size` column was introduced
+                conn.execute('UPDATE blob SET size = length(content) '
+                             'WHERE size IS NULL')
+                conn.execute(f'PRAGMA user_version = {BLOB_DB_VERSION}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return True
+
+    @staticmethod
+    def _create(conn, table):
+        dialect = sqlite.dialect()
+        conn.execute(str(CreateTable(table).compile(dialect=dialect)))
+        for index in table.indexes:
+            conn.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+    @staticmethod
+    def _add_columns(conn, table, old_columns):
+        dialect = sqlite.dialect()
+        for c in table.c:
+            if c.name not in old_columns:
+                conn.execute(f'ALTER TABLE {table.name} ADD COLUMN '
+                             f'{c.name} '
+                             f'{c.type.compile(dialect=dialect)}')
+
+    @staticmethod
+    def _rebuild(conn, table, old_columns):
+        name = table.name
+        log.info(f'rebuilding {name} table with columns: {old_columns}')
+        conn.execute(f'ALTER TABLE {name} RENAME TO {name}_prev')
+        BlobDbf._create(conn, table)
+        copy = [c.name for c in table.c if c.name in old_columns]
+        names = ', '.join(copy)
+        # duplicates were possible in old schema, first one wins
+        conn.execute(f'INSERT OR IGNORE INTO {name} ({names}) '
+                     f'SELECT {names} FROM {name}_prev ORDER BY rowid')
+        conn.execute(f'DROP TABLE {name}_prev')
+
+
+class FilePresence:
+    '''
+    Names of blobs stored as files, per shard, so lookup opens
+    shard file only for blobs that are known to be there, and
+    goes straight to `blob.db` for others. Shard directory is
+    listed once, when shard is first looked up, names are added
+    and removed by this process afterwards. Listings of at most
+    `max_shards` shards used most recently are kept.
+
+    It is only a hint: file written by other process is still
+    found, lookup just tries file after all other locations.
+    '''
+    def __init__(self, root, max_shards=1024):
+        self.root = root
+        self.max_shards = max_shards
+        self.shards = OrderedDict()
+        self.lock = threading.Lock()
+        self.listings = 0
+
+    def _names(self, shard_name):
+        with self.lock:
+            names = self.shards.get(shard_name)
+            if names is not None:
+                self.shards.move_to_end(shard_name)
+                return names
+        try:
+            with os.scandir(os.path.join(self.root,
+                                         shard_name)) as entries:
+                names = {e.name for e in entries if len(e.name) > 48}
+        except FileNotFoundError:
+            names = set()
+        with self.lock:
+            self.listings += 1
+            names = self.shards.setdefault(shard_name, names)
+            while len(self.shards) > self.max_shards:
+                self.shards.popitem(last=False)
+        return names
+
+    def may_have(self, shard_name, name):
+        return name in self._names(shard_name)
+
+    def add(self, shard_name, name):
+        with self.lock:
+            names = self.shards.get(shard_name)
+            if names is not None:
+                names.add(name)
+
+    def discard(self, shard_name, name):
+        with self.lock:
+            names = self.shards.get(shard_name)
+            if names is not None:
+                names.discard(name)
+
+    def forget(self, shard_name):
+        with self.lock:
+            self.shards.pop(shard_name, None)
+
+
+class ShardPool:
+    '''
+    Bounded pool of open `blob.db` shards, shared by all threads of
+    `BlobStore`. Each shard keeps up to `connections_per_shard`
+    SQLite connections open (one file descriptor each), shard used
+    least recently is evicted when more then `max_open_shards`
+    are open. Shards are leased to callers and evicted shard is
+    disposed as soon as last lease on it is released.
+
+    Shard is opened and its schema is migrated outside of pool
+    lock, under lock of that shard only, and it is published in
+    pool after that. Schema of shard is migrated once, not on
+    every reopen after eviction.
+    '''
+    def __init__(self, root, max_open_shards=64, connections_per_shard=1,
+                 metrics=None):
+        self.root = root
+        self.metrics = metrics
+        self.max_open_shards = max_open_shards
+        self.connections_per_shard = connections_per_shard
+        self.shards = OrderedDict()
+        self.retired = []
+        self.lock = threading.RLock()
+        self.opening = {}
+        self.migrated = set()
+        self.open_connections = 0
+        self.evictions = 0
+
+    def _count(self, delta):
+        def listener(*_):
+            with self.lock:
+                self.open_connections += delta
+        return listener
+
+    def _open(self, shard_name):
+        dbf = BlobDbf(
+            os.path.join(self.root, shard_name, 'blob.db'),
+            poolclass=QueuePool,
+            pool_size=self.connections_per_shard,
+            max_overflow=self.connections_per_shard,
+            connect_args={'check_same_thread': False})
+        engine = dbf.engine()
+        event.listen(engine, 'connect', self._count(1))
+        event.listen(engine, 'close', self._count(-1))
+        event.listen(engine, 'close_detached', self._count(-1))
+        if self.metrics is not None:
+            self.metrics.shard_opens.inc()
+            self.metrics.time_queries(engine)
+        if shard_name not in self.migrated and dbf.exists():
+            dbf.migrate()
+            self.migrated.add(shard_name)
+        return dbf
+
+    def _lease_open(self, shard_name):
+        '''
+        must be called with `self.lock` held
+
+        :return: leased shard or `None` if it is not open
+        '''
+        dbf = self.shards.get(shard_name)
+        if dbf is not None:
+            self.shards.move_to_end(shard_name)
+            dbf.leases += 1
+        return dbf
+
+    def _get(self, shard_name):
+        with self.lock:
+            dbf = self._lease_open(shard_name)
+            if dbf is not None:
+                return dbf
+            opening = self.opening.setdefault(shard_name,
+                                              threading.Lock())
+        with opening:
+            with self.lock:
+                # could be opened while we waited
+                dbf = self._lease_open(shard_name)
+                if dbf is not None:
+                    return dbf
+            dbf = self._open(shard_name)
+            with self.lock:
+                dbf.leases += 1
+                self.shards[shard_name] = dbf
+                self.opening.pop(shard_name, None)
+                while len(self.shards) > self.max_open_shards:
+                    _, evicted = self.shards.popitem(last=False)
+                    self.retired.append(evicted)
+                    self.evictions += 1
+            return dbf
+
+    @contextmanager
+    def lease(self, shard_name):
+        dbf = self._get(shard_name)
+        with self.lock:
+            self._dispose_retired()
+        try:
+            yield dbf
+        finally:
+            with self.lock:
+                dbf.leases -= 1
+                self._dispose_retired()
+
+    def _dispose_retired(self, force=False):
+        in_use = []
+        for dbf in self.retired:
+            if force or dbf.leases == 0:
+                dbf.dispose()
+            else:
+                in_use.append(dbf)
+        self.retired = in_use
+
+    def evict(self, shard_name):
+        '''
+        close shard, so its `blob.db` could be removed
+        '''
+        with self.lock:
+            dbf = self.shards.pop(shard_name, None)
+            if dbf is not None:
+                self.retired.append(dbf)
+                self._dispose_retired()
+
+    def open_shards(self):
+        return len(self.shards)
+
+    def close(self):
+        with self.lock:
+            while self.shards:
+                _, dbf = self.shards.popitem()
+                dbf.dispose()
+            self._dispose_retired(force=True)
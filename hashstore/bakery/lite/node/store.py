@@ -4,15 +4,17 @@ from hashkernel.bakery import CakeRole
 from hashstore.bakery.lite import dal
 from hashstore.bakery.lite.node import (
     ServerConfigBase, GlueBase,  CakeShardBase, User, UserType,
-    UserState, Permission, Portal, ServerKey, PermissionType as PT)
+    UserState, Permission, Portal, ServerKey, PermissionType as PT,
+    MAX_NUM_OF_SHARDS)
 from hashstore.bakery.lite.node.blobs import BlobStore
 from hashstore.utils.db import Dbf
 from hashkernel.hashing import shard_name_int, SaltedSha
 
 
 class CakeStore:
-    def __init__(self, store_dir):
+    def __init__(self, store_dir, **blob_options):
         self.store_dir = store_dir
+        self.blob_options = blob_options
         self._blob_store = None
         self.srvcfg_db = Dbf(
             ServerConfigBase.metadata,
@@ -24,8 +26,9 @@ class CakeStore:
         )
         self.max_shards = None
         self.shards_db = None
+        self._srvcfg_migrated = False
 
-    def cake_shard_db(self, cake):
+    def cake_shard_dbs(self):
         if self.max_shards is None:
             self.max_shards = self.server_config().num_cake_shards
             self.shards_db = [Dbf(
@@ -33,37 +36,59 @@ class CakeStore:
                 os.path.join(self.store_dir,
                              'shard_' + shard_name_int(i) + '.db')
             ) for i in range(self.max_shards)]
-        db = self.shards_db[cake.shard_num(self.max_shards)]
+        return self.shards_db
+
+    def cake_shard_db(self, cake):
+        shards_db = self.cake_shard_dbs()
+        db = shards_db[cake.shard_num(self.max_shards)]
         if not(db.exists()):
             db.ensure_db()
         return db
 
     def blob_store(self):
         if self._blob_store is None:
+            options = dict(self.blob_options)
+            skey = self._server_key()
+            if skey is not None and skey.num_blob_shards is not None:
+                options['num_shards'] = skey.num_blob_shards
+                options['prev_num_shards'] = skey.prev_num_blob_shards
+            if skey is not None and skey.cold_blob_dir is not None:
+                options.setdefault('cold_root', skey.cold_blob_dir)
             self._blob_store = BlobStore(
-                os.path.join(self.store_dir, 'backend')
+                os.path.join(self.store_dir, 'backend'),
+                **options
             )
         return self._blob_store
 
-    def initdb(self, external_ip, port, num_cake_shards=10):
+    def close(self):
+        if self._blob_store is not None:
+            self._blob_store.close()
+            self._blob_store = None
+
+    def initdb(self, external_ip, port, num_cake_shards=10,
+               num_blob_shards=MAX_NUM_OF_SHARDS, cold_blob_dir=None):
         if not os.path.exists(self.store_dir):
             os.makedirs(self.store_dir)
         self.srvcfg_db.ensure_db()
+        self._migrate_srvcfg()
         os.chmod(self.srvcfg_db.path, 0o600)
         self.glue_db.ensure_db()
-        self.blob_store()
         with self.srvcfg_db.session_scope() as srv_session:
             skey = srv_session.query(ServerKey).one_or_none()
             if skey is None:
                 skey = ServerKey()
                 skey.num_cake_shards = num_cake_shards
+                skey.num_blob_shards = num_blob_shards
             elif skey.num_cake_shards != num_cake_shards:
                 raise ValueError(
                     f'reshard required: '
                     f'{skey.num_cake_shards} != {num_cake_shards}')
             skey.port = port
             skey.external_ip = external_ip
+            if cold_blob_dir is not None:
+                skey.cold_blob_dir = os.path.abspath(cold_blob_dir)
             srv_session.merge(skey)
+        self.blob_store()
         with self.glue_db.session_scope() as glue_session:
             make_system_user = lambda n: User(
                 email=f'{n}@' ,
@@ -96,7 +121,27 @@ class CakeStore:
                                user=system))
 
 
+    def _migrate_srvcfg(self):
+        if not self._srvcfg_migrated:
+            self.srvcfg_db.add_missing_columns()
+            self._srvcfg_migrated = True
+
+    def _server_key(self):
+        if not self.srvcfg_db.exists():
+            return None
+        self._migrate_srvcfg()
+        with self.srvcfg_db.session_scope() as session:
+            return session.query(ServerKey).one_or_none()
+
     def server_config(self):
+        self._migrate_srvcfg()
         with self.srvcfg_db.session_scope() as session:
             return session.query(ServerKey).one()
 
+    def update_server_config(self, **values):
+        self._migrate_srvcfg()
+        with self.srvcfg_db.session_scope() as session:
+            skey = session.query(ServerKey).one()
+            for k, v in values.items():
+                setattr(skey, k, v)
+
@@ -0,0 +1,70 @@
+import os
+import time
+import datetime
+
+from sqlalchemy import select
+from . import blob_access, cold_entry
+from .blobs import pid_lock
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class TieringAlreadyRunning(Exception):
+    pass
+
+
+class Tiering:
+    '''
+    Demotes blobs from hot tier of `BlobStore` into its cold tier:
+    blob is demoted when it was neither created nor read (see
+    `TierKeeper`) for `idle` time. Shards are processed one by one,
+    run stops after `max_seconds`. Demoted blobs are not looked at
+    again, so next run quickly gets to shards that were not done.
+    '''
+    def __init__(self, store, idle=datetime.timedelta(days=30)):
+        if store.cold is None:
+            raise ValueError('store has no cold tier')
+        self.store = store
+        self.idle = idle
+        self.lock_file = os.path.join(store.root, 'tier.lock')
+
+    def run(self, max_seconds=None):
+        '''
+        :return: number of demoted blobs and their size in bytes
+        '''
+        deadline = None
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        demoted, demoted_bytes = 0, 0
+        with pid_lock(self.lock_file, TieringAlreadyRunning):
+            self.store.tier_keeper.flush()
+            cutoff = datetime.datetime.utcnow() - self.idle
+            for shard_name in sorted(self.store.shard_names()):
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                for size in self._demote_shard(shard_name, cutoff):
+                    demoted += 1
+                    demoted_bytes += size
+        return demoted, demoted_bytes
+
+    def _demote_shard(self, shard_name, cutoff):
+        candidates = set(self.store.shard_blobs(
+            shard_name, created_before=cutoff))
+        if not candidates:
+            return
+        with self.store.blob_dbf(shard_name) as blob_db:
+            if blob_db.exists():
+                candidates.difference_update(
+                    row.file_id for row in blob_db.execute(
+                        select([blob_access.c.file_id])
+                        .where(blob_access.c.accessed_dt >= cutoff)))
+                candidates.difference_update(
+                    row.file_id for row in blob_db.execute(
+                        select([cold_entry.c.file_id])))
+        for file_id in sorted(candidates, key=str):
+            size = self.store.demote(file_id)
+            if size is not None:
+                log.debug(f'demoted {file_id}')
+                yield size
@@ -0,0 +1,146 @@
+import os
+import time
+from unittest import mock
+
+from hashkernel.bakery import Cake
+from hashstore.bakery.lite.node import ContentAddress
+from hashstore.bakery.lite.node.addresses import RECORD_SIZE
+from hashstore.bakery.lite.node.blobs import BlobStore, DbLookup
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+def test_address_index():
+    root = os.path.join(test.dir, 'test_address_index')
+    options = dict(pack_max_blob_size=100000, chunk_avg_size=1 << 18,
+                   num_shards=16)
+    hs = BlobStore(root, **options)
+    seed(22)
+    data = [random_bytes(n) for n in (100, 70000, 300000)]
+    data.append(random_bytes(200000) * 8)
+    data += [random_bytes(200) for _ in range(200)]
+    ids = [hs.writer().write(d, done=True) for d in data]
+    ok_(not hs.index.exists())
+    scanned = set(hs.scan())
+
+    # blobs written and removed while scan is consumed are journaled
+    other = BlobStore(root, **options)
+    new_data = random_bytes(300)
+
+    def scan_meanwhile():
+        for i, file_id in enumerate(sorted(scanned, key=str)):
+            if i == 10:
+                ids.append(other.writer().write(new_data, done=True))
+                eq_(other.remove(ids[-2:-1]), 1)
+            yield file_id
+    eq_(hs.index.rebuild(scan_meanwhile()), len(scanned))
+    expected = scanned - {ids[-2]} | {ids[-1]}
+    ok_(hs.index.complete())
+    listed = list(hs)
+    eq_(set(listed), expected)
+    eq_(listed, sorted(listed, key=lambda f: f.hash_bytes()))
+    eq_(set(listed), set(hs.scan()))
+
+    # index is shared through journal, merged when it grows
+    other.index.min_merge = 1
+    more = [other.writer().write(random_bytes(100), done=True)
+            for _ in range(30)]
+    ok_(all(f in hs.index for f in more))
+    eq_(other.remove(more[:20]), 20)
+    ok_(not any(f in hs.index for f in more[:20]))
+    eq_(set(hs), expected | set(more[20:]))
+    logs = [os.path.getsize(os.path.join(hs.index.dir, name))
+            for name in os.listdir(hs.index.dir)
+            if name.endswith('.log')]
+    ok_(max(logs) <= RECORD_SIZE, logs)
+
+    # cached blobs are found without looking into index
+    eq_(hs.get_content(ids[4]).get_data(), data[4])
+    with mock.patch('os.stat', wraps=os.stat) as stat:
+        eq_(hs.lookup(ids[4]).tier, 'cache')
+    eq_(stat.call_count, 0)
+
+    # address is journaled before blob is stored, journal is
+    # synced as durability of store says, writer marker is synced
+    # once by first append
+    expected.add(hs.writer().write(random_bytes(40), done=True))
+    seen = []
+    save = DbLookup.save_content
+
+    def checked_save(lookup, content):
+        seen.append(lookup.file_id in hs.index)
+        return save(lookup, content)
+    with mock.patch.object(DbLookup, 'save_content', checked_save), \
+            mock.patch('os.fsync', wraps=os.fsync) as fsync:
+        late = hs.writer().write(random_bytes(50), done=True)
+    eq_(seen, [True])
+    eq_(fsync.call_count, 0)
+    expected.add(late)
+    strict = BlobStore(root, durability='strict', **options)
+    with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+        expected.add(strict.writer().write(random_bytes(50), done=True))
+    ok_(fsync.called)
+    strict.close()
+
+    # missing blobs are answered by index
+    missing = [ContentAddress(Cake.from_bytes(random_bytes(100)))
+               for _ in range(1000)]
+    queries = hs.metrics.queries
+
+    def count_queries():
+        return sum(h['count'] for h in queries.snapshot().values())
+    before = count_queries()
+    start = time.perf_counter()
+    ok_(not any(hs.lookup(f).found() for f in missing))
+    indexed = time.perf_counter() - start
+    eq_(count_queries(), before)
+    sizes = hs.exists_many(missing + more)
+    eq_([sizes[f] for f in more], [None] * 20 + [100] * 10)
+    # only shards of indexed blobs are queried
+    eq_(count_queries(),
+        before + len({hs.shard_name(f) for f in more[20:]}))
+    no_index = BlobStore(os.path.join(test.dir, 'no_index'), **options)
+    for d in data:
+        no_index.writer().write(d, done=True)
+    start = time.perf_counter()
+    ok_(not any(no_index.lookup(f).found() for f in missing))
+    scanned_lookups = time.perf_counter() - start
+    log.info(f'lookup of missing blob: {indexed * 1000:.1f}us with '
+             f'index, {scanned_lookups * 1000:.1f}us without')
+    no_index.close()
+
+    eq_(hs.get_content(ids[3]).stream().read(), data[3])
+    other.close()
+    hs.close()
+
+    # torn journal is not trusted until index is rebuilt
+    with open(os.path.join(root, 'index', '00.log'), 'ab') as fp:
+        fp.write(b'+' + b'\0' * 10)
+    hs = BlobStore(root, **options)
+    ok_(not hs.index.complete())
+    eq_(set(hs), expected | set(more[20:]))
+    eq_(hs.rebuild_index(), len(expected) + 10)
+    ok_(hs.index.complete())
+    hs.close()
+
+    # index is not trusted after writer did not close it, appends
+    # that were not synced could be lost
+    hs = BlobStore(root, **options)
+    ok_(hs.index.complete())
+    hs.writer().write(random_bytes(60), done=True)
+    os.close(hs.index.writer_fd)  # lock is released, as on crash
+    hs.shard_pool.close()
+    hs = BlobStore(root, **options)
+    ok_(not hs.index.complete())
+    eq_(hs.rebuild_index(), len(expected) + 11)
+    hs.writer().write(random_bytes(70), done=True)
+    hs.close()
+    hs = BlobStore(root, **options)
+    ok_(hs.index.complete())
+    hs.close()
+    eq_([n for n in os.listdir(hs.index.dir) if n.startswith('writer')],
+        [])
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import threading
+
+from hashkernel.bakery import Cake
+from hashstore.bakery.lite.node.aio import AsyncBlobStore
+from hashstore.bakery.lite.node.blobs import BlobStore
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+def test_async_blob_store():
+    hs = BlobStore(os.path.join(test.dir, 'test_async_blob_store'))
+    blobs = AsyncBlobStore(hs, max_workers=2)
+    seed(16)
+    small, big = random_bytes(100), random_bytes(300000)
+    io_threads = set()
+    run = blobs.run
+
+    def tracking_run(fn, *args, **kwargs):
+        def call():
+            io_threads.add(threading.current_thread().name)
+            return fn(*args, **kwargs)
+        return run(call)
+    blobs.run = tracking_run
+
+    async def scenario():
+        w = blobs.writer()
+        await w.write(big[:1000])
+        await w.write(big[1000:])
+        big_id = await w.done()
+        small_id = await blobs.writer().write(small, done=True)
+        ok_(hs.lookup(big_id).found())
+        eq_((await blobs.lookup(small_id)).size, 100)
+        eq_((await blobs.get_content(Cake.from_bytes(big))).size,
+            len(big))
+        chunks = [c async for c in blobs.chunks(
+            await blobs.get_content(big_id), chunk_size=1 << 16)]
+        eq_(len(chunks), 5)
+        eq_(b''.join(chunks), big)
+        sizes = await blobs.exists_many([small_id, big_id])
+        eq_(sizes, {small_id: 100, big_id: len(big)})
+        eq_((await blobs.get_content(small_id)).get_data(), small)
+        ok_(io_threads)
+        # small blob is in cache now, served without thread pool
+        io_threads.clear()
+        eq_((await blobs.get_content(small_id)).get_data(), small)
+        eq_(io_threads, set())
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+    blobs.close()
+    hs.close()
@@ -1,10 +1,27 @@
 import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from unittest import mock
 
 from hashkernel.bakery import NotFoundError
-from hashstore.bakery.lite.node import ContentAddress
-from hashstore.tests import TestSetup, seed, random_bytes
-from ..node.blobs import BlobStore
-from hashkernel.bakery import Cake
+from hashkernel.hashing import B36, Hasher
+from hashstore.bakery.lite.node import ContentAddress, blob, pack_entry
+from hashstore.tests import TestSetup, seed, random_bytes, sqlite_q
+from hashstore.utils.fio import ensure_directory
+from hashstore.utils.compress import Codec, MAGIC
+from ..node.blobs import (BlobStore, DbLookup, FileLookup, PackLookup,
+                          ManifestLookup)
+from ..node.shards import BlobDbf, BLOB_DB_VERSION
+from ..node.durability import Durability
+from ..node.contents import (MappedContent, CompressedContent,
+                             ChunkedContent, DbContent)
+from hashkernel.bakery import Cake, CakeRole, Content
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from hs_build_tools.nose import eq_,ok_
 
 
@@ -78,5 +95,752 @@ def test_LiteBackend():
 
 
 
+def shard_zero_address(i):
+    '''
+    address that falls into shard `0`: first two bytes of hash give
+    8192, which is `0` modulo `MAX_NUM_OF_SHARDS`
+    '''
+    return ContentAddress(B36.encode(
+        bytes([0x20, 0]) + i.to_bytes(30, 'big')))
 
 
+def fill_shard_zero(hs, start, end):
+    with hs.blob_dbf('0') as dbf:
+        ensure_directory(os.path.dirname(dbf.path))
+        dbf.ensure_db()
+        dbf.execute(blob.insert(), [
+            {'file_id': shard_zero_address(i), 'content': b'x' * 100,
+             'size': 100}
+            for i in range(start, end)])
+
+
+def test_legacy_blob_db_migration():
+    hs = BlobStore(os.path.join(test.dir, 'test_legacy'))
+    ensure_directory(os.path.join(hs.root, '0'))
+    path = os.path.join(hs.root, '0', 'blob.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE blob (blob_id INTEGER NOT NULL, '
+                     'created_dt DATETIME NOT NULL, '
+                     'file_id VARCHAR NOT NULL, content BLOB, '
+                     'PRIMARY KEY (blob_id))')
+        for i in (1, 2, 1):
+            conn.execute('INSERT INTO blob (created_dt, file_id, content)'
+                         ' VALUES (?, ?, ?)',
+                         ('2018-01-01 00:00:00.000000',
+                          str(shard_zero_address(i)), b'%d' % i))
+    eq_(sqlite_q(path, 'PRAGMA user_version'), [(0,)])
+    lookup = hs.lookup(shard_zero_address(1))
+    eq_(lookup.size, 1)
+    eq_(hs.get_content(shard_zero_address(2)).get_data(), b'2')
+    eq_(sqlite_q(path, 'PRAGMA user_version'), [(BLOB_DB_VERSION,)])
+    eq_(sqlite_q(path, 'select count(*) from blob'), [(2,)])
+    eq_(sqlite_q(path, 'select count(*) from blob where size is null'),
+        [(0,)])
+    eq_(2, len(list(hs)))
+
+
+def test_blob_lookup_is_indexed():
+    hs = BlobStore(os.path.join(test.dir, 'test_indexed'))
+    fill_shard_zero(hs, 0, 10)
+    with hs.blob_dbf('0') as dbf:
+        plan = dbf.execute(
+            'EXPLAIN QUERY PLAN SELECT content FROM blob '
+            'WHERE file_id = ?', str(shard_zero_address(5))).fetchall()
+    ok_('USING INDEX' in ' '.join(str(r) for r in plan), plan)
+
+    # every statement of `DbLookup` searches blob by index, so
+    # lookup does not slow down as shard grows
+    fill_shard_zero(hs, 10, 1000)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, *_):
+        statements.append((statement, parameters))
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        ok_(DbLookup(hs, shard_zero_address(500)).found())
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+    ok_(statements)
+    with hs.blob_dbf('0') as dbf:
+        for statement, parameters in statements:
+            plan = ' '.join(row[-1] for row in dbf.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters))
+            ok_('SCAN' not in plan, (statement, plan))
+            ok_('USING INDEX' in plan or 'PRIMARY KEY' in plan,
+                (statement, plan))
+
+
+def test_db_lookup_statements():
+    hs = BlobStore(os.path.join(test.dir, 'test_db_lookup_statements'),
+                   cache_max_bytes=0)
+    seed(19)
+    datas = [random_bytes(n) for n in (100, 5000, 50000)]
+    stored = [hs.writer().write(d, done=True) for d in datas]
+    statements = []
+
+    def count(conn, cursor, statement, *_):
+        statements.append(statement)
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        for a, d in zip(stored, datas):
+            del statements[:]
+            lookup = hs.lookup(a)
+            eq_(lookup.size, len(d))
+            eq_(len(statements), 1)
+            ok_('content' not in statements[0], statements[0])
+            eq_(lookup.content(CakeRole.SYNAPSE).get_data(), d)
+            eq_(len(statements), 2)
+            del statements[:]
+            content = hs.get_content(a)
+            eq_((content.size, content.get_data()), (len(d), d))
+            eq_(len(statements), 1)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+
+    def timing(read):
+        start = time.perf_counter()
+        for _ in range(200):
+            for a in stored:
+                read(a)
+        return (time.perf_counter() - start) / 200 / len(stored)
+    separate = timing(lambda a: hs.lookup(a).content(CakeRole.SYNAPSE))
+    fused = timing(hs.get_content)
+    log.info(f'lookup then read: {separate * 1e6:.1f}us '
+             f'fused: {fused * 1e6:.1f}us')
+    hs.close()
+
+
+def test_db_streaming():
+    hs = BlobStore(os.path.join(test.dir, 'test_db_streaming'),
+                   db_max_blob_size=4 << 20, cache_max_bytes=0,
+                   compression='zlib')
+    seed(20)
+    big = random_bytes(200000) * 10
+    text = b''.join(b'line %d\n' % i for i in range(200000))
+    big_id, text_id = [hs.writer().write(d, done=True)
+                       for d in (big, text)]
+    eq_(os.listdir(os.path.join(hs.root, big_id.shard_name)),
+        ['blob.db'])
+    content = hs.get_content(big_id)
+    ok_(isinstance(content, DbContent))
+    eq_(content.size, len(big))
+    tracemalloc.start()
+    try:
+        digest = Hasher()
+        for chunk in content.chunks(1 << 16):
+            digest.update(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    log.info(f'streamed {len(big)} bytes with peak of {peak} bytes')
+    ok_(peak < len(big) // 4, peak)
+    eq_(ContentAddress(digest), big_id)
+    eq_(content.stream().read(), big)
+    # compressed blob is read whole
+    content = hs.get_content(text_id)
+    ok_(not isinstance(content, DbContent))
+    eq_(content.get_data(), text)
+
+    content = hs.get_content(big_id)
+    hs.remove([big_id])
+    try:
+        next(content.chunks())
+        ok_(False)
+    except NotFoundError:
+        pass
+    hs.close()
+
+
+def test_read_range():
+    root = os.path.join(test.dir, 'test_read_range')
+    seed(25)
+    ranges = [(0, None), (0, 10), (1000, 1001), (65000, 70000),
+              (69999, None), (5, 1 << 30), (1 << 30, None)]
+    stores = {
+        'plain': BlobStore(os.path.join(root, 'plain'),
+                           pack_max_blob_size=100000),
+        'zlib': BlobStore(os.path.join(root, 'zlib'),
+                          compression='zlib', cache_max_bytes=0),
+        'db': BlobStore(os.path.join(root, 'db'),
+                        db_max_blob_size=1 << 20, cache_max_bytes=0),
+        'chunked': BlobStore(os.path.join(root, 'chunked'),
+                             chunk_avg_size=1 << 16)}
+    cases = [('plain', random_bytes(100), Content),
+             ('plain', random_bytes(70000), Content),
+             ('plain', random_bytes(300000), MappedContent),
+             ('zlib', random_bytes(1000) * 300, CompressedContent),
+             ('db', random_bytes(300000), DbContent),
+             ('chunked', random_bytes(1000000), ChunkedContent)]
+    for name, data, content_cls in cases:
+        hs = stores[name]
+        file_id = hs.writer().write(data, done=True)
+        ok_(type(hs.get_content(file_id)) is content_cls, content_cls)
+        for start, stop in ranges:
+            eq_(hs.read_range(file_id, start, stop), data[start:stop])
+    # only chunks that overlap with range are fetched
+    hs = stores['chunked']
+    content = hs.get_content(file_id)
+    with mock.patch.object(hs, 'get_content',
+                           wraps=hs.get_content) as get_content:
+        eq_(b''.join(content.chunks(start=500000, stop=500010)),
+            data[500000:500010])
+        eq_(get_content.call_count, 1)
+    for hs in stores.values():
+        hs.close()
+
+
+def test_metrics():
+    hs = BlobStore(os.path.join(test.dir, 'test_metrics'),
+                   cached_max_size=1000)
+    seed(21)
+    small, big = random_bytes(100), random_bytes(100000)
+    small_id, big_id = [hs.writer().write(d, done=True)
+                        for d in (small, big)]
+    hs.cache.clear()
+    for _ in range(3):
+        eq_(hs.get_content(small_id).get_data(), small)
+    eq_(hs.get_content(big_id).get_data(), big)
+    ok_(not hs.lookup(Cake.from_bytes(b'x' * 100)).found())
+
+    m = hs.metrics.snapshot()
+    counts = {tags: h['count']
+              for tags, h in m['blob_lookup_seconds'].items()}
+    eq_(counts, {'{tier="db"}': 1, '{tier="cache"}': 2,
+                 '{tier="file"}': 1, '{tier="miss"}': 1})
+    eq_(m['blob_read_bytes_total'], {'{tier="db"}': 100,
+                                     '{tier="cache"}': 200,
+                                     '{tier="file"}': 100000})
+    eq_(m['blob_written_bytes_total'], {'{tier="db"}': 100,
+                                        '{tier="file"}': 100000})
+    eq_(m['incoming_bytes_total'], {'': 100000})
+    eq_(m['blob_cache_hits_total'], {'': 2})
+    ok_(m['shard_db_opens_total'][''] >= 2)
+    ok_(m['shard_db_query_seconds']['']['count'] >= 5)
+    text = hs.metrics.render()
+    ok_('blob_lookup_seconds_bucket{tier="db",le="+Inf"} 1' in text)
+    ok_('# TYPE blob_cache_hits_total counter' in text)
+    hs.close()
+
+
+def test_shard_pool():
+    hs = BlobStore(os.path.join(test.dir, 'test_shard_pool'),
+                   max_open_shards=4)
+    seed(1)
+    addresses = [hs.writer().write(random_bytes(50), done=True)
+                 for _ in range(20)]
+    pool = hs.shard_pool
+    eq_(pool.open_shards(), 4)
+    ok_(pool.evictions > 0)
+    ok_(0 < pool.open_connections <= 4 * 2, pool.open_connections)
+    errors = []
+
+    def read_all():
+        try:
+            for a in addresses:
+                eq_(hs.lookup(a).size, 50)
+        except Exception as e: # pragma: no cover
+            errors.append(e)
+
+    migrated = []
+
+    def migrate(dbf):
+        migrated.append(os.path.basename(os.path.dirname(dbf.path)))
+
+    threads = [threading.Thread(target=read_all) for _ in range(4)]
+    with mock.patch.object(BlobDbf, 'migrate', autospec=True,
+                           side_effect=migrate):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    eq_(errors, [])
+    ok_(pool.open_shards() <= 4)
+    # shards are reopened after eviction, but migrated once
+    ok_(pool.evictions > len(migrated))
+    eq_(sorted(migrated), sorted(set(migrated)))
+    hs.close()
+    eq_(pool.open_shards(), 0)
+    eq_(pool.open_connections, 0)
+
+
+def test_bloom_filter():
+    root = os.path.join(test.dir, 'test_bloom')
+    hs = BlobStore(root)
+    seed(2)
+    stored = [hs.writer().write(random_bytes(n), done=True)
+              for n in (50, 70000)]
+    hs.close()
+    hs = BlobStore(root, bloom_capacity=1000)
+    eq_(len(hs.bloom), 2)
+    new = hs.writer().write(random_bytes(60), done=True)
+    for a in stored + [new]:
+        ok_(hs.lookup(a).found())
+    with mock.patch('os.stat', side_effect=AssertionError('stat')):
+        ok_(not hs.lookup(shard_zero_address(1)).found())
+    hs.close()
+    ok_(os.path.exists(os.path.join(root, 'bloom.snapshot')))
+    hs = BlobStore(root, bloom_capacity=1000)
+    ok_(not os.path.exists(os.path.join(root, 'bloom.snapshot')))
+    eq_(len(hs.bloom), 3)
+    ok_(hs.lookup(new).found())
+    hs.close()
+    # blob written while server is stopped
+    other = BlobStore(root)
+    written = other.writer().write(random_bytes(70), done=True)
+    ok_(not os.path.exists(os.path.join(root, 'bloom.snapshot')))
+    other.close()
+    hs = BlobStore(root, bloom_capacity=1000)
+    eq_(len(hs.bloom), 4)
+    ok_(hs.lookup(written).found())
+    hs.close()
+
+
+def test_exists_many():
+    hs = BlobStore(os.path.join(test.dir, 'test_exists_many'))
+    seed(3)
+    small = hs.writer().write(random_bytes(50), done=True)
+    big = hs.writer().write(random_bytes(70000), done=True)
+    cake = Cake.from_bytes(random_bytes(100))
+    hs.writer().write(b'x' * 100, done=True)
+    missing = [shard_zero_address(i) for i in range(700)]
+    keys = [small, big, cake] + missing
+    shards = {ContentAddress.ensure_it(k).shard_name for k in keys}
+    with mock.patch('os.stat', wraps=os.stat) as stat:
+        found = hs.exists_many(keys)
+        ok_(stat.call_count <= 2 * len(shards), stat.call_count)
+    eq_(found[small], 50)
+    eq_(found[big], 70000)
+    eq_(found[cake], None)
+    eq_(sum(1 for a in missing if found[a] is None), 700)
+
+
+def test_concurrent_small_writes():
+    hs = BlobStore(os.path.join(test.dir, 'test_concurrent_small'))
+    data = b'same content'
+    file_id = ContentAddress(Hasher(data))
+    # both writers decided that blob is not stored yet
+    lookups = [DbLookup(hs, file_id) for _ in range(2)]
+    for l in lookups:
+        ok_(l.save_content(data))
+    eq_(hs.get_content(file_id).get_data(), data)
+
+
+def test_concurrent_same_blob_writes():
+    root = os.path.join(test.dir, 'test_concurrent_same_blob')
+    hs = BlobStore(root)
+    seed(23)
+    data = random_bytes(300000)
+    file_id = ContentAddress(Hasher(data))
+    uploaded = threading.Barrier(4)
+    stored = []
+
+    def upload():
+        w = hs.writer()
+        for i in range(0, len(data), 50000):
+            w.write(data[i:i + 50000])
+        uploaded.wait()
+        stored.append(w.done())
+    threads = [threading.Thread(target=upload) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    eq_(stored, [file_id] * 4)
+    # first writer stored blob, the rest dropped their copies
+    eq_(hs.metrics.incoming_duplicates.value(), 3)
+    eq_(len(hs.in_flight), 0)
+    eq_(os.listdir(hs.incoming_dir), [])
+    eq_(hs.get_content(file_id).get_data(), data)
+
+    # other process stores blob after this one decided to store it
+    other = BlobStore(root)
+    data = random_bytes(200000)
+    file_id = ContentAddress(Hasher(data))
+    w = hs.writer()
+    w.write(data)
+    stale = FileLookup(hs, file_id)
+    eq_(other.writer().write(data, done=True), file_id)
+    inode = os.stat(stale.file).st_ino
+    ok_(not w.incoming_file.close(stale))
+    eq_(os.stat(stale.file).st_ino, inode)
+    eq_(os.listdir(hs.incoming_dir), [])
+
+    # without hard links file is renamed
+    data = random_bytes(200000)
+    with mock.patch('os.link', side_effect=PermissionError):
+        file_id = hs.writer().write(data, done=True)
+    ok_(isinstance(hs.lookup(file_id), FileLookup))
+    eq_(hs.get_content(file_id).get_data(), data)
+    eq_(os.listdir(hs.incoming_dir), [])
+    other.close()
+    hs.close()
+
+
+def test_pack_files():
+    root = os.path.join(test.dir, 'test_pack_files')
+    hs = BlobStore(root, pack_max_blob_size=1 << 20,
+                   pack_file_size=300000)
+    seed(4)
+    datas = [random_bytes(100000) for _ in range(10)]
+    stored = [hs.writer().write(d, done=True) for d in datas]
+    big = hs.writer().write(random_bytes(1 << 20), done=True)
+    ok_(FileLookup(hs, big).found())
+    for a, d in zip(stored, datas):
+        ok_(not FileLookup(hs, a).found())
+        l = hs.lookup(a)
+        ok_(isinstance(l, PackLookup))
+        eq_(l.content(None).get_data(), d)
+    eq_(len(hs.packs.sealed()), 3)
+
+    # pack of other writer is never sealed while it is open, however
+    # old it is, pack of writer that crashed is
+    other = BlobStore(root, pack_max_blob_size=1 << 20)
+    other_blob = other.writer().write(random_bytes(100000), done=True)
+    other_pack = other.packs.path(other.packs.active_id)
+    os.utime(other_pack, (0, 0))
+    eq_(len(hs.packs.sealed()), 3)
+    other.packs.active_fp.close()
+    eq_(len(hs.packs.sealed()), 4)
+    ok_(os.path.exists(other.packs.path(other.packs.active_id,
+                                        '.sealed')))
+    other.packs.active_fp = None
+    eq_(other.remove([other_blob]), 1)
+    other.close()
+    os.remove(other_pack)
+    os.remove(other.packs.path(other.packs.active_id, '.sealed'))
+
+    def packs_size():
+        return sum(os.path.getsize(os.path.join(hs.packs.dir, f))
+                   for f in os.listdir(hs.packs.dir))
+    before = packs_size()
+    eq_(hs.writer().write(datas[0], done=True), stored[0])
+    eq_(packs_size(), before)
+
+    found = hs.exists_many(stored + [big])
+    ok_(all(found[a] == 100000 for a in stored))
+    eq_(found[big], 1 << 20)
+    eq_(set(hs), set(stored + [big]))
+
+    # nothing to reclaim yet
+    eq_(hs.repack(), (0, 0))
+    # drop two entries out of first pack
+    for a in stored[:2]:
+        with hs.blob_dbf(a.shard_name) as blob_db:
+            blob_db.execute(pack_entry.delete().where(
+                pack_entry.c.file_id == a))
+    hs.cache.clear()
+    eq_(hs.repack(), (1, 200000))
+    eq_(len(hs.packs.sealed()), 2)
+    for a in stored[:2]:
+        ok_(not hs.lookup(a).found())
+    for a, d in zip(stored[2:], datas[2:]):
+        eq_(hs.get_content(a).get_data(), d)
+    hs.close()
+
+    # packs are readable even if packing is not configured
+    hs = BlobStore(root)
+    for a, d in zip(stored[2:], datas[2:]):
+        eq_(hs.get_content(a).get_data(), d)
+    hs.close()
+
+
+def test_blob_cache():
+    hs = BlobStore(os.path.join(test.dir, 'test_blob_cache'),
+                   cache_max_bytes=300000)
+    seed(5)
+    hot = [hs.writer().write(random_bytes(50000), done=True)
+           for _ in range(2)]
+    scan = [hs.writer().write(random_bytes(20000), done=True)
+            for _ in range(40)]
+    for _ in range(3):
+        for a in hot:
+            hs.get_content(a)
+    for a in scan:
+        hs.get_content(a)
+    ok_(all(a in hs.cache for a in hot))
+    ok_(hs.cache.size <= 300000)
+    stats = hs.cache.stats()
+    eq_(stats['hits'], 4)
+    ok_(stats['misses'] >= 42)
+    ok_(stats['evictions'] > 0)
+    hs.close()
+
+
+def test_mapped_content():
+    hs = BlobStore(os.path.join(test.dir, 'test_mapped_content'),
+                   cached_max_size=1000)
+    seed(6)
+    data = random_bytes(300000)
+    a = hs.writer().write(data, done=True)
+    content = hs.get_content(a)
+    ok_(isinstance(content, MappedContent))
+    eq_(content.size, 300000)
+    chunks = list(content.chunks(100000))
+    eq_(len(chunks), 3)
+    ok_(all(isinstance(c, memoryview) for c in chunks))
+    eq_(b''.join(chunks), data)
+    del chunks
+    with content.view() as view:
+        eq_(view[1000:1010], data[1000:1010])
+    eq_(content.get_data(), data)
+    eq_(len(hs.cache), 0)
+
+
+def test_group_commit():
+    root = os.path.join(test.dir, 'test_group_commit')
+    hs = BlobStore(root, group_commit_count=50, group_commit_delay=60)
+    gc = hs.group_commit
+    blob_row = hs.blob_row
+
+    def unlocked_blob_row(*args):
+        # compression does not hold up other writers
+        ok_(not gc.lock.locked())
+        return blob_row(*args)
+    with mock.patch.object(hs, 'blob_row', unlocked_blob_row):
+        for i in range(49):
+            gc.add(shard_zero_address(i), b'%d' % i)
+        eq_(gc.commits, 0)
+        ok_(hs.lookup(shard_zero_address(3)).found())
+        ok_(not DbLookup(hs, shard_zero_address(3)).found())
+        gc.add(shard_zero_address(49), b'49')
+    eq_(gc.commits, 1)
+    ok_(DbLookup(hs, shard_zero_address(3)).found())
+
+    seed(7)
+    datas = [random_bytes(1000) for _ in range(3)]
+    queued = hs.writer().write(datas[0], done=True)
+    eq_(hs.get_content(queued).get_data(), datas[0])
+    eq_(hs.exists_many([queued])[queued], 1000)
+    ok_(not DbLookup(hs, queued).found())
+    w = hs.writer()
+    w.write(datas[1])
+    flushed = w.done(flush=True)
+    ok_(DbLookup(hs, flushed).found())
+    last = hs.writer().write(datas[2], done=True)
+    hs.close()
+    hs = BlobStore(root, group_commit_count=50, group_commit_delay=0.2)
+    for a, d in zip((queued, last), datas[::2]):
+        eq_(DbLookup(hs, a).content(None).get_data(), d)
+    timed = hs.writer().write(random_bytes(1000), done=True)
+    time.sleep(1)
+    ok_(DbLookup(hs, timed).found())
+    hs.close()
+
+
+def test_durability():
+    seed(8)
+    datas = [random_bytes(70000 + i) for i in range(20)]
+    fsyncs = {}
+    for durability in Durability:
+        root = os.path.join(test.dir, 'test_durability', durability.name)
+        hs = BlobStore(root, durability=durability, sync_interval=60)
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            start = time.perf_counter()
+            stored = [hs.writer().write(d, done=True) for d in datas]
+            hs.flush()
+            elapsed = time.perf_counter() - start
+            fsyncs[durability] = fsync.call_count
+        log.info(f'{durability.name}: {len(datas) / elapsed:.1f} blobs/s '
+                 f'{fsync.call_count} fsyncs')
+        for a, d in zip(stored, datas):
+            eq_(hs.get_content(a).get_data(), d)
+        hs.close()
+    # file and shard directory per blob, plus root for new shards
+    ok_(fsyncs[Durability.strict] >= 3 * len(datas))
+    # file per blob and every shard once, in single batch
+    ok_(fsyncs[Durability.batched] <= 2 * len(datas) + 1)
+    eq_(fsyncs[Durability.relaxed], 0)
+
+
+def test_lookup_hints():
+    seed(18)
+    datas = [random_bytes(1000 + i) for i in range(100)] + \
+            [random_bytes(70000 + i) for i in range(5)]
+    opens = {}
+    for hints in (False, True):
+        root = os.path.join(test.dir, 'test_lookup_hints', str(hints))
+        hs = BlobStore(root, lookup_hints=hints, num_shards=16)
+        stored = [hs.writer().write(d, done=True) for d in datas]
+        hs.close()
+        hs = BlobStore(root, lookup_hints=hints, num_shards=16)
+        for a in stored:  # open shards and list their directories
+            ok_(hs.lookup(a).found())
+        with mock.patch(f'{BlobStore.__module__}.open', wraps=open,
+                        create=True) as file_open:
+            start = time.perf_counter()
+            for _ in range(10):
+                for a in stored:
+                    ok_(hs.lookup(a).found())
+            elapsed = time.perf_counter() - start
+            opens[hints] = file_open.call_count
+        log.info(f'lookup_hints={hints}: {file_open.call_count} opens, '
+                 f'{elapsed / len(stored) * 1e5:.1f}us per lookup')
+        if hints:
+            with mock.patch(f'{BlobStore.__module__}.open', wraps=open,
+                            create=True) as file_open:
+                ok_(hs.lookup(stored[0], size_hint=1000).found())
+                ok_(hs.lookup(stored[-1], size_hint=70004).found())
+                eq_(file_open.call_count, 1)
+            # file written by other process is found too
+            d = random_bytes(80000)
+            ok_(not hs.lookup(Cake.from_bytes(d)).found())
+            other = BlobStore(root, num_shards=16)
+            a = other.writer().write(d, done=True)
+            other.close()
+            eq_(hs.get_content(a).get_data(), d)
+        hs.close()
+    # only blobs that are stored as files are opened
+    eq_(opens, {False: 10 * len(datas), True: 10 * 5})
+
+
+def test_incoming_sweep():
+    root = os.path.join(test.dir, 'test_incoming_sweep')
+    hs = BlobStore(root)
+    seed(9)
+    datas = [random_bytes(70000 + i) for i in range(8)]
+    stored = {}
+
+    def upload(i):
+        w = hs.writer()
+        for j in range(0, len(datas[i]), 10000):
+            w.write(datas[i][j:j + 10000])
+        stored[i] = w.done()
+    threads = [threading.Thread(target=upload, args=(i,))
+               for i in range(len(datas))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, d in enumerate(datas):
+        eq_(hs.get_content(stored[i]).get_data(), d)
+    eq_(os.listdir(hs.incoming_dir), [])
+    hs.close()
+
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    own = f'{os.getpid()}-live.tmp'
+    for name in (f'{dead.pid}-crashed.tmp', '5.tmp', own):
+        with open(os.path.join(hs.incoming_dir, name), 'wb') as fp:
+            fp.write(b'partial')
+    hs = BlobStore(root)
+    eq_(os.listdir(hs.incoming_dir), [own])
+    eq_(hs.sweep_incoming(max_age=0), 1)
+    eq_(os.listdir(hs.incoming_dir), [])
+    hs.close()
+
+
+def test_compression():
+    root = os.path.join(test.dir, 'test_compression')
+    ensure_directory(os.path.join(root, '0'))
+    path = os.path.join(root, '0', 'blob.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE blob (created_dt DATETIME NOT NULL, '
+                     'file_id VARCHAR NOT NULL, content BLOB, '
+                     'PRIMARY KEY (file_id))')
+        conn.execute('INSERT INTO blob VALUES (?, ?, ?)',
+                     ('2018-01-01 00:00:00.000000',
+                      str(shard_zero_address(1)), b'old'))
+        conn.execute('PRAGMA user_version = 2')
+    hs = BlobStore(root, compression='lzma', cached_max_size=1000)
+    eq_(hs.lookup(shard_zero_address(1)).size, 3)
+    eq_([r[1] for r in sqlite_q(path, 'PRAGMA table_info(blob)')],
+        ['created_dt', 'file_id', 'content', 'codec', 'size'])
+
+    seed(10)
+    text = b''.join(b'{"line": %d, "level": "info"}\n' % i
+                    for i in range(20000))
+    blobs = {
+        'small_text': text[:5000],
+        'small_random': random_bytes(5000),
+        'big_text': text,
+        'big_random': random_bytes(200000),
+        'big_magic': MAGIC + random_bytes(100000),
+    }
+    stored = {}
+    for name, data in blobs.items():
+        w = hs.writer()
+        for i in range(0, len(data), 30000):
+            w.write(data[i:i + 30000])
+        stored[name] = w.done()
+        eq_(stored[name], ContentAddress(Hasher(data)))
+    hs.cache.clear()
+
+    def stored_size(name):
+        file_id = stored[name]
+        if len(blobs[name]) < 1 << 16:
+            return sqlite_q(os.path.join(root, file_id.shard_name,
+                                         'blob.db'),
+                            'select length(content), codec from blob '
+                            'where file_id = ?', str(file_id))[0]
+        return os.path.getsize(os.path.join(root, file_id.shard_name,
+                                            str(file_id)))
+    ok_(stored_size('small_text')[0] < 1000)
+    eq_(stored_size('small_text')[1], Codec.lzma)
+    eq_(stored_size('small_random'), (5000, None))
+    ok_(stored_size('big_text') < len(text) // 5)
+    eq_(stored_size('big_random'), 200000)
+    eq_(stored_size('big_magic'), 100008 + 17)
+
+    sizes = hs.exists_many(stored.values())
+    for name, data in blobs.items():
+        content = hs.get_content(stored[name])
+        eq_(content.size, len(data), name)
+        eq_(sizes[stored[name]], len(data), name)
+        eq_(content.get_data(), data, name)
+    ok_(isinstance(hs.get_content(stored['big_text']),
+                   CompressedContent))
+    eq_(b''.join(hs.get_content(stored['big_text']).chunks(7000)), text)
+    ok_(isinstance(hs.get_content(stored['big_random']), MappedContent))
+
+    # stores without compression read compressed blobs
+    hs.close()
+    hs = BlobStore(root)
+    eq_(hs.get_content(stored['big_text']).get_data(), text)
+    eq_(hs.get_content(stored['small_text']).get_data(), text[:5000])
+    hs.close()
+
+
+def test_chunking():
+    root = os.path.join(test.dir, 'test_chunking')
+    hs = BlobStore(root, chunk_avg_size=1 << 16)
+    seed(11)
+    v1 = random_bytes(1000000)
+    v2 = v1[:300000] + b'inserted' + v1[300000:700000] + v1[700100:]
+
+    def write(data):
+        w = hs.writer()
+        for i in range(0, len(data), 100000):
+            w.write(data[i:i + 100000])
+        return w.done()
+
+    def blob_count():
+        return len(list(hs))
+    a1 = write(v1)
+    eq_(a1, ContentAddress(Hasher(v1)))
+    ok_(ManifestLookup(hs, a1).found())
+    ok_(not FileLookup(hs, a1).found())
+    v1_blobs = blob_count()
+    ok_(v1_blobs > 5)
+    a2 = write(v2)
+    new_blobs = blob_count() - v1_blobs
+    ok_(new_blobs <= 5, new_blobs)
+    eq_(write(v1), a1)
+    eq_(blob_count(), v1_blobs + new_blobs)
+
+    for address, data in ((a1, v1), (a2, v2)):
+        content = hs.get_content(address)
+        ok_(isinstance(content, ChunkedContent))
+        eq_(content.size, len(data))
+        eq_(content.get_data(), data)
+        eq_(b''.join(content.chunks()), data)
+        eq_(hs.exists_many([address])[address], len(data))
+    chunks = set(hs.manifest_chunks([a1]))
+    ok_(all(hs.lookup(c).found() for c in chunks))
+
+    # blobs smaller then chunk or without chunking are stored whole
+    eq_(FileLookup(hs, write(random_bytes(70000))).size, 70000)
+    whole = BlobStore(root)
+    a3 = whole.writer().write(v1[:200000] + b'y', done=True)
+    ok_(FileLookup(hs, a3).found())
+    whole.close()
+    hs.close()
@@ -0,0 +1,106 @@
+import datetime
+import os
+from io import BytesIO
+
+from hashkernel.bakery import (Cake, CakeRack, CakeRole, CakeType,
+                               CakePath, PatchAction)
+from hashstore.bakery.lite.node import ContentAddress
+from hashstore.bakery.lite.node.access import (StoreContext,
+                                               PrivilegedAccess)
+from hashstore.bakery.lite.node.gc import (GarbageCollector,
+                                           GcAlreadyRunning)
+from hashstore.bakery.lite.node.store import CakeStore
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+class NotRead(BytesIO):
+    def read(self, *_):
+        raise AssertionError('content was read')
+
+
+def test_gc():
+    store = CakeStore(os.path.join(test.dir, 'test_gc'),
+                      chunk_avg_size=1 << 18)
+    store.initdb(None, 7000)
+    hs = store.blob_store()
+    seed(10)
+
+    def write(data, role=CakeRole.SYNAPSE):
+        hs.writer().write(data, done=True)
+        return Cake.from_bytes(data, role=role)
+    kept = [write(random_bytes(70000)), write(random_bytes(100))]
+    chunked = write(random_bytes(200000) * 8)
+    chunks = [ContentAddress(c) for c in hs.manifest_chunks(
+        [ContentAddress(chunked)])]
+    ok_(len(chunks) > 1)
+    kept.extend([chunked] + chunks)
+    rack = CakeRack()
+    rack['a'] = kept[0]
+    rack['b'] = kept[1]
+    rack['c'] = chunked
+    bundle = write(bytes(rack), role=CakeRole.NEURON)
+    kept.append(bundle)
+    garbage = [write(random_bytes(70000)), write(random_bytes(100))]
+    in_tree = write(random_bytes(200))
+    ended_in_tree = write(random_bytes(300))
+    garbage.append(ended_in_tree)
+    kept.append(in_tree)
+    deduped = random_bytes(100)
+    rewritten = random_bytes(70000)
+    reused = [write(deduped), write(rewritten)]
+    portal = Cake.new_portal()
+    vtree = Cake.new_portal(type=CakeType.VTREE)
+    with StoreContext(store) as ctx:
+        access = PrivilegedAccess.system_access(ctx)
+        access.create_portal(portal_id=portal, cake=bundle)
+        access.edit_portal_tree([
+            (PatchAction.update, CakePath(f'/{vtree}/x'), in_tree),
+            (PatchAction.update, CakePath(f'/{vtree}/y'),
+             ended_in_tree)])
+        access.delete_in_portal_tree(CakePath(f'/{vtree}/y'))
+
+    # confirmations are not recorded while no collection runs
+    since = datetime.datetime.utcnow()
+    reused_ids = [ContentAddress(cake) for cake in reused]
+    hs.confirm(reused_ids)
+    eq_(hs.confirmed_since(reused_ids, since), set())
+
+    collector = GarbageCollector(store, retention_days=0,
+                                 grace=datetime.timedelta(0))
+    eq_(collector.run(max_seconds=0)['phase'], 'mark')
+    ok_(hs.collecting())
+    # unreferenced blobs are reused by writers while collecting
+    with StoreContext(store) as ctx:
+        access = PrivilegedAccess.system_access(ctx)
+        eq_(access.write_content(NotRead(), expected=reused[0]),
+            ContentAddress(reused[0]))
+    write(rewritten)
+    with open(collector.lock_file, 'w') as fp:
+        fp.write(str(os.getpid()))
+    try:
+        collector.run()
+        ok_(False)
+    except GcAlreadyRunning:
+        os.remove(collector.lock_file)
+    state = collector.run()
+    eq_(state['phase'], 'done')
+    eq_(state['swept'], 3)
+    ok_(not hs.collecting())
+    for cake in kept + reused:
+        ok_(hs.lookup(cake).found(), cake)
+    for cake in garbage:
+        ok_(not hs.lookup(cake).found(), cake)
+    ok_(not os.path.exists(os.path.join(
+        hs.root, ContentAddress(garbage[0]).shard_name,
+        str(ContentAddress(garbage[0])))))
+
+    # blobs are too fresh for default grace period
+    write(random_bytes(100))
+    state = GarbageCollector(store).run()
+    eq_(state['swept'], 0)
+    store.close()
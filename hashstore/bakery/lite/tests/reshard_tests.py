@@ -0,0 +1,103 @@
+import os
+import sqlite3
+
+from hashstore.bakery.lite.node import ServerKey, MAX_NUM_OF_SHARDS
+from hashstore.bakery.lite.node.reshard import (ShardMigration,
+                                                ReshardAlreadyRunning)
+from hashstore.bakery.lite.node.store import CakeStore
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+def test_reshard():
+    store_dir = os.path.join(test.dir, 'test_reshard')
+    store = CakeStore(store_dir, pack_max_blob_size=100000,
+                      chunk_avg_size=1 << 18)
+    store.initdb(None, 7000)
+    # server.db created before shard count was recorded
+    conn = sqlite3.connect(store.srvcfg_db.path)
+    conn.execute(f'CREATE TABLE sk AS SELECT id, single, secret, '
+                 f'external_ip, port, num_cake_shards '
+                 f'FROM {ServerKey.__tablename__}')
+    conn.execute(f'DROP TABLE {ServerKey.__tablename__}')
+    conn.execute(f'ALTER TABLE sk RENAME TO {ServerKey.__tablename__}')
+    conn.commit()
+    conn.close()
+    store.close()
+    store = CakeStore(store_dir, pack_max_blob_size=100000,
+                      chunk_avg_size=1 << 18)
+    hs = store.blob_store()
+    eq_(hs.num_shards, MAX_NUM_OF_SHARDS)
+    seed(15)
+    data = [random_bytes(n) for n in (100, 200, 70000, 300000)]
+    data.append(random_bytes(200000) * 8)
+    old = [hs.writer().write(d, done=True) for d in data]
+    ok_(len(list(hs.shard_names())) > 5)
+
+    migration = ShardMigration(store)
+    eq_(migration.state()['prev_num_shards'], None)
+    migration.start(4)
+    eq_(migration.state(), dict(num_shards=4,
+                                prev_num_shards=MAX_NUM_OF_SHARDS,
+                                migrated=0))
+    try:
+        migration.start(8)
+        ok_(False)
+    except ValueError:
+        pass
+    new = [hs.writer().write(random_bytes(n), done=True)
+           for n in (100, 70000)]
+    for file_id in new:
+        ok_(os.path.isdir(os.path.join(hs.root, file_id.shard(4))))
+
+    def check_all():
+        for file_id, d in zip(old, data):
+            eq_(hs.get_content(file_id).get_data(), d)
+        sizes = hs.exists_many(old + new)
+        ok_(all(sizes[f] is not None for f in old + new), sizes)
+    check_all()
+
+    # partially migrated
+    for file_id in old[:2]:
+        hs.migrate_shard(file_id.shard_name)
+    check_all()
+    eq_(migration.run(max_seconds=0)['migrated'], 0)
+
+    with open(migration.lock_file, 'w') as fp:
+        fp.write(str(os.getpid()))
+    try:
+        migration.run()
+        ok_(False)
+    except ReshardAlreadyRunning:
+        os.remove(migration.lock_file)
+
+    eq_(migration.run(), dict(num_shards=4, prev_num_shards=None,
+                              migrated=None))
+    eq_(hs.prev_num_shards, None)
+    check_all()
+    eq_(sorted(hs.shard_names()), ['0', '1', '2', '3'])
+    eq_(len(list(hs)), len(set(hs)))
+    store.close()
+
+    store = CakeStore(store_dir)
+    hs = store.blob_store()
+    eq_(hs.num_shards, 4)
+    check_all()
+
+    # migration started by other process is picked up
+    server_migration = ShardMigration(store)
+    ok_(not server_migration.pick_up())
+    other = CakeStore(store_dir)
+    ShardMigration(other).start(2)
+    other.close()
+    ok_(server_migration.pick_up())
+    eq_((hs.num_shards, hs.prev_num_shards), (2, 4))
+    check_all()
+    eq_(server_migration.run()['prev_num_shards'], None)
+    eq_(sorted(hs.shard_names()), ['0', '1'])
+    check_all()
+    store.close()
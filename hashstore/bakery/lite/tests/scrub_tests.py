@@ -0,0 +1,102 @@
+import os
+
+from sqlalchemy import select
+
+from hashstore.bakery.lite.node import blob, scrub_shard, ContentAddress
+from hashstore.bakery.lite.node.blobs import BlobStore, PackLookup
+from hashstore.bakery.lite.node.scrub import (Scrubber,
+                                              ScrubAlreadyRunning)
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+def test_scrub():
+    hs = BlobStore(os.path.join(test.dir, 'test_scrub'),
+                   pack_max_blob_size=100000)
+    seed(12)
+    good = [hs.writer().write(random_bytes(n), done=True)
+            for n in (100, 70000, 200000)]
+    bad_db, bad_pack, bad_file = [
+        hs.writer().write(random_bytes(n), done=True)
+        for n in (100, 70000, 200000)]
+
+    with hs.blob_dbf(bad_db.shard_name) as blob_db:
+        blob_db.execute(blob.update().values(content=b'rot')
+                        .where(blob.c.file_id == bad_db))
+    pack = PackLookup(hs, bad_pack)
+    with open(hs.packs.path(pack.pack_id), 'r+b') as fp:
+        fp.seek(pack.offset + 10)
+        fp.write(b'rot')
+    with open(os.path.join(hs.root, bad_file.shard_name,
+                           str(bad_file)), 'r+b') as fp:
+        fp.write(b'rot')
+
+    scrubber = Scrubber(hs, bytes_per_sec=100 << 20, workers=2)
+    state = scrubber.run(max_seconds=0)
+    eq_(state['checked'], 0)
+    ok_(state['finished_dt'] is None)
+    with open(scrubber.lock_file, 'w') as fp:
+        fp.write(str(os.getpid()))
+    try:
+        scrubber.run()
+        ok_(False)
+    except ScrubAlreadyRunning:
+        os.remove(scrubber.lock_file)
+
+    state = scrubber.run()
+    ok_(state['finished_dt'] is not None)
+    eq_(state['checked'], 6)
+    eq_(state['corrupt'], 3)
+    corrupt = {file_id: (location, path)
+               for file_id, location, path in scrubber.corrupt()}
+    eq_(corrupt[bad_db][0], 'db')
+    eq_(corrupt[bad_pack][0], 'pack')
+    eq_(corrupt[bad_file][0], 'file')
+    with open(corrupt[bad_db][1], 'rb') as fp:
+        eq_(fp.read(), b'rot')
+    for file_id in good:
+        ok_(hs.lookup(file_id).found(), file_id)
+    for file_id in corrupt:
+        ok_(not hs.lookup(file_id).found(), file_id)
+
+    # next run starts new pass
+    state = scrubber.run()
+    eq_(state['pass_no'], 2)
+    eq_((state['checked'], state['corrupt']), (3, 0))
+    hs.close()
+
+
+def test_scrub_cold():
+    root = os.path.join(test.dir, 'test_scrub_cold')
+    hs = BlobStore(os.path.join(root, 'hot'),
+                   cold_root=os.path.join(root, 'cold'),
+                   pack_max_blob_size=100000)
+    seed(13)
+    data = [random_bytes(n) for n in (100, 200, 70000)]
+    good, bad, hot = [hs.writer().write(d, done=True) for d in data]
+    eq_(hs.demote(good), 100)
+    eq_(hs.demote(bad), 200)
+    with hs.cold.blob_dbf(bad.shard_name) as blob_db:
+        blob_db.execute(blob.update().values(content=b'rot')
+                        .where(blob.c.file_id == bad))
+
+    scrubber = Scrubber(hs, bytes_per_sec=100 << 20)
+    state = scrubber.run()
+    eq_((state['checked'], state['corrupt']), (3, 1))
+    eq_([(file_id, location) for file_id, location, _
+         in scrubber.corrupt()], [(bad, 'cold-db')])
+    shards = {row.shard_name for row in scrubber.scrub_db.execute(
+        select([scrub_shard.c.shard_name]))}
+    ok_(f'cold/{good.shard_name}' in shards)
+    eq_(hs.get_content(good).get_data(), data[0])
+    eq_(hs.get_content(hot).get_data(), data[2])
+    ok_(not hs.lookup(bad).found())
+    ok_(bad not in hs.index)
+    # lost blob could be uploaded again
+    eq_(hs.writer().write(data[1], done=True), bad)
+    eq_(hs.get_content(bad).get_data(), data[1])
+    hs.close()
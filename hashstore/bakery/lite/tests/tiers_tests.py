@@ -0,0 +1,69 @@
+import datetime
+import os
+import time
+
+from hashkernel.bakery import Cake
+from hashstore.bakery.lite.node.blobs import BlobStore, ColdLookup
+from hashstore.bakery.lite.node.tiers import (Tiering,
+                                              TieringAlreadyRunning)
+from hashstore.tests import TestSetup, seed, random_bytes
+from hs_build_tools.nose import eq_, ok_
+
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+def test_tiers():
+    root = os.path.join(test.dir, 'test_tiers')
+    hs = BlobStore(os.path.join(root, 'hot'),
+                   cold_root=os.path.join(root, 'cold'),
+                   pack_max_blob_size=100000, chunk_avg_size=1 << 18,
+                   promote_on_read=True, access_interval=3600)
+    seed(17)
+    data = [random_bytes(100), random_bytes(200), random_bytes(70000),
+            random_bytes(300000), random_bytes(200000) * 8]
+    ids = [hs.writer().write(d, done=True) for d in data]
+    read, small, packed, file, chunked = ids
+    tiering = Tiering(hs, idle=datetime.timedelta(seconds=1))
+    eq_(tiering.run(), (0, 0))
+    time.sleep(1.1)
+    eq_(hs.get_content(read).get_data(), data[0])
+
+    with open(tiering.lock_file, 'w') as fp:
+        fp.write(str(os.getpid()))
+    try:
+        tiering.run()
+        ok_(False)
+    except TieringAlreadyRunning:
+        os.remove(tiering.lock_file)
+
+    demoted, demoted_bytes = tiering.run()
+    ok_(demoted > 4)  # chunks of chunked blob were idle too
+    ok_(demoted_bytes > len(data[4]))
+    ok_(not isinstance(hs.lookup(read), ColdLookup))
+    for file_id in (small, packed, file, chunked):
+        ok_(isinstance(hs.lookup(file_id), ColdLookup), file_id)
+        ok_(hs.cold.lookup(file_id).found())
+    eq_(os.listdir(os.path.join(hs.root, file.shard_name)), ['blob.db'])
+    eq_(hs.exists_many(ids),
+        {file_id: len(d) for file_id, d in zip(ids, data)})
+    eq_(set(hs), set(hs.cold) | {read})
+    eq_(tiering.run(), (0, 0))
+    ok_(not hs.lookup(Cake.from_bytes(b'x' * 100)).found())
+
+    # read of cold blob promotes it
+    eq_(hs.get_content(chunked).stream().read(), data[4])
+    eq_(hs.get_content(small).get_data(), data[1])
+    hs.tier_keeper.flush()
+    eq_(hs.tier_keeper.promoted, 2)
+    for file_id in (small, chunked):
+        ok_(not isinstance(hs.lookup(file_id), ColdLookup))
+        ok_(not hs.cold.lookup(file_id).found())
+    eq_(hs.get_content(chunked).stream().read(), data[4])
+
+    eq_(hs.remove([packed, file]), 2)
+    for file_id in (packed, file):
+        ok_(not hs.lookup(file_id).found())
+        ok_(not hs.cold.lookup(file_id).found())
+    hs.close()
@@ -0,0 +1,113 @@
+import io
+import os
+import socket
+import ssl
+import subprocess
+import threading
+
+from hs_build_tools.nose import eq_, ok_
+
+from hashstore.bakery.cake_client import post_expecting_continue
+from hashstore.tests import TestSetup
+
+test = TestSetup(__name__, ensure_empty=True)
+log = test.log
+
+
+class NotSent(io.BytesIO):
+    def read(self, *_):
+        raise AssertionError('body was sent')
+
+
+def _read_until(conn, end):
+    data = b''
+    while not data.endswith(end):
+        chunk = conn.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _respond(conn, status, body):
+    conn.sendall(b'HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n%s'
+                 % (status, len(body), body))
+
+
+def test_post_expecting_continue_over_tls():
+    cert, key = (os.path.join(test.dir, n) for n in ('c.pem', 'k.pem'))
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key, '-out', cert, '-days', '1',
+         '-subj', '/CN=localhost'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(cert, key)
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(2)
+    port = listener.getsockname()[1]
+    received = []
+
+    def serve():
+        with server_ctx.wrap_socket(listener, server_side=True) as tls:
+            # blob is there: answered before body
+            conn, _ = tls.accept()
+            with conn:
+                _read_until(conn, b'\r\n\r\n')
+                _respond(conn, b'200 OK', b'"stored"')
+            # blob is missing: body is asked for
+            conn, _ = tls.accept()
+            with conn:
+                _read_until(conn, b'\r\n\r\n')
+                conn.sendall(b'HTTP/1.1 100 (Continue)\r\n\r\n')
+                received.append(_read_until(conn, b'0\r\n\r\n'))
+                _respond(conn, b'409 Conflict', b'"uploaded"')
+    server = threading.Thread(target=serve)
+    server.start()
+    client_ctx = ssl.create_default_context(cafile=cert)
+    client_ctx.check_hostname = False
+    url = f'https://localhost:{port}/-/api/up'
+    try:
+        eq_(post_expecting_continue(url, {}, NotSent(),
+                                    context=client_ctx),
+            (200, '"stored"'))
+        eq_(post_expecting_continue(url, {}, io.BytesIO(b'abc'),
+                                    context=client_ctx),
+            (409, '"uploaded"'))
+    finally:
+        server.join()
+    eq_(received, [b'3\r\nabc\r\n0\r\n\r\n'])
+    ok_(not server.is_alive())
+
+
+def test_post_expecting_continue_timeout():
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    received = []
+    done = threading.Event()
+
+    def serve():
+        # server neither asks for body nor answers after it
+        conn, _ = listener.accept()
+        with conn:
+            _read_until(conn, b'\r\n\r\n')
+            received.append(_read_until(conn, b'0\r\n\r\n'))
+            done.wait(10)
+        listener.close()
+    server = threading.Thread(target=serve)
+    server.start()
+    try:
+        post_expecting_continue(f'http://localhost:{port}/-/api/up', {},
+                                io.BytesIO(b'abc'), wait=0.1,
+                                timeout=0.5)
+        ok_(False)
+    except socket.timeout:
+        pass
+    finally:
+        done.set()
+        server.join()
+    # body is sent after short wait for `100 Continue`
+    eq_(received, [b'3\r\nabc\r\n0\r\n\r\n'])
@@ -42,12 +42,13 @@ optional arguments:
 def test_hsd():
     '''
 usage: hs.py [-h] [--store_dir store_dir] [--debug]
-             {initdb,add_user,remove_user,acl,backup,pull,start,stop} ...
+             {initdb,add_user,remove_user,acl,backup,pull,start,repack,gc,scrub,demote,reshard,reindex,stop}
+             ...
 
 hashstore server subcomands
 
 positional arguments:
-  {initdb,add_user,remove_user,acl,backup,pull,start,stop}
+  {initdb,add_user,remove_user,acl,backup,pull,start,repack,gc,scrub,demote,reshard,reindex,stop}
     initdb              initialize storage and set host specific parameters
     add_user
     remove_user
@@ -55,6 +56,17 @@ positional arguments:
     backup              Backup dir
     pull                Restore dir
     start               start server
+    repack              compact pack files
+    gc                  collect garbage: remove blobs that are not reachable
+                        from portals
+    scrub               verify content of stored blobs and quarantine corrupt
+                        ones
+    demote              move blobs that were not read for a while into cold
+                        tier
+    reshard             change number of blob shards, blobs are moved into new
+                        shards while store stays readable
+    reindex             build sorted index of blob addresses, writers keep it
+                        up to date after that
     stop                stop server
 
 optional arguments:
@@ -181,6 +193,10 @@ def test_scan_ls():
                              '--user {email}'.format(**locals()),
                              expect_rc=0)
 
+    test.run_script_and_wait('server --store_dir {store} reindex'
+                             .format(**locals()),
+                             expect_rc=0, expect_read='.... Indexed: ...')
+
     pull_cake = fileset2_cake
     pull_dir = os.path.join(test.dir, 'pull')
     test.run_script_and_wait('server --store_dir {store} pull '
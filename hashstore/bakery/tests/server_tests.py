@@ -1,10 +1,16 @@
+import io
 import json
+import requests
 
 from hs_build_tools.nose import eq_,ok_
 
 from hashkernel.bakery import Cake, CakeRole, CakeType, CakePath
 from hashstore.tests import (sqlite_q, TestSetup, file_set1, file_set2,
-    prep_mount, update_mount, fileset1_cake, fileset2_cake)
+    prep_mount, update_mount, fileset1_cake, fileset2_cake, seed,
+    random_bytes)
+from hashstore.bakery.cake_client import (CakeClient,
+                                          post_expecting_continue)
+from hashstore.bakery.lite.node import ContentAddress
 import os
 from time import sleep
 import urllib.request
@@ -52,7 +58,7 @@ class ServerSetup:
         server_db = os.path.join(self.store, "server.db")
         server_key = sqlite_q(server_db,'select * from server_key')
         eq_(len(server_key),1)
-        eq_(server_key[0][3:],(None, 7623, 10))
+        eq_(server_key[0][3:],(None, 7623, 10, 8192, None, None, None))
         server_id = server_key[0][1]
 
         self.test.run_script_and_wait(
@@ -62,7 +68,7 @@ class ServerSetup:
 
         server_key = sqlite_q(server_db,'select * from server_key')
         eq_(len(server_key),1)
-        eq_(server_key[0][3:],(None, 8765, 10))
+        eq_(server_key[0][3:],(None, 8765, 10, 8192, None, None, None))
         eq_(server_id, server_key[0][1])
 
         server_id = self.test.run_script_in_bg(
@@ -210,6 +216,60 @@ class ServerSetup:
                 .format(**locals()), expect_rc=0, expect_read=
                     'Not there: /{new_portal!s}/x/z'.format(**locals()))
 
+        # content already stored is not sent again
+        session = CakeClient(self.test.home).check_mount_session(files)
+
+        class NotSent(io.BytesIO):
+            def read(self, *_):
+                raise AssertionError('body was sent')
+        stored = Cake.ensure_it(
+            '2f3WYb52iUTL1WqN55lZ6Md8zl9Rk7vNlSs0nzECYQmh')
+        ok_(session.proxy.write_content(NotSent(), expected=stored)
+            .match(stored))
+        seed(24)
+        big = data = random_bytes(100000)
+        cake = Cake.from_bytes(data)
+        for fp in (io.BytesIO(data), NotSent()):
+            ok_(session.proxy.write_content(fp, expected=cake)
+                .match(cake))
+        # uploaded content is checked against expected cake
+        data, other = random_bytes(1000), random_bytes(1000)
+        status, text = post_expecting_continue(
+            session.url + '-/api/up',
+            dict(session.headers,
+                 ExpectedCake=str(Cake.from_bytes(other))),
+            io.BytesIO(data))
+        eq_(status, 409)
+        ok_(ContentAddress(json.loads(text))
+            .match(Cake.from_bytes(data)))
+
+        # parts of content are served
+        for content, c in ((big, cake), (data, Cake.from_bytes(data))):
+            url = f'{session.url}-/get/data/{c}'
+
+            def get(**headers):
+                return requests.get(url, headers=dict(session.headers,
+                                                      **headers))
+            r = get(Range='bytes=10-19')
+            eq_(r.status_code, 206)
+            eq_(r.content, content[10:20])
+            eq_(r.headers['Content-Range'], f'bytes 10-19/{len(content)}')
+            eq_(r.headers['Accept-Ranges'], 'bytes')
+            etag = r.headers['Etag']
+            r = get(Range='bytes=-10', **{'If-Range': etag})
+            eq_((r.status_code, r.content), (206, content[-10:]))
+            r = get(Range='bytes=-10', **{'If-Range': '"changed"'})
+            eq_((r.status_code, r.content), (200, content))
+            r = get(Range=f'bytes={len(content)}-')
+            eq_(r.status_code, 416)
+            eq_(r.headers['Content-Range'], f'bytes */{len(content)}')
+
+        metrics = http_GET(
+            f'http://localhost:{self.port}/-/metrics').decode()
+        ok_('# TYPE blob_lookup_seconds histogram' in metrics)
+        ok_('blob_written_bytes_total{tier="file"}' in metrics, metrics)
+        ok_('blob_read_bytes_total{tier=' in metrics, metrics)
+
         if self.shutdown:
             self.do_shutdown()
             self.test.wait_process(server_id, expect_rc=[0,2])
@@ -3,12 +3,19 @@ from hashstore.bakery.lite.node.access import (
 from hashstore.bakery.cake_server import CakeServer
 from hashstore.bakery.lite.node import PermissionType, Acl
 from hashstore.bakery.lite.node.store import CakeStore
+from hashstore.bakery.lite.node.durability import Durability
+from hashstore.bakery.lite.node.gc import GarbageCollector
+from hashstore.bakery.lite.node.scrub import Scrubber
+from hashstore.bakery.lite.node.reshard import ShardMigration
+from hashstore.bakery.lite.node.tiers import Tiering
 from hashstore.utils import print_pad
+from hashstore.utils.compress import Codec
 from hashstore.utils.args import Switch, CommandArgs
 from hashkernel.hashing import SaltedSha
 from hashstore.bakery.cake_scan import pull, backup, ScanPath
 from hashkernel.bakery import ensure_cakepath
 import getpass
+import datetime
 
 import logging
 
@@ -36,9 +43,18 @@ class DaemonApp():
 
     @ca.command('initialize storage and set host specific parameters',
                 port=('port to listen. ',int),
-                external_ip='external IP of server. ')
-    def initdb(self, external_ip=None, port=7532):
-        self.store.initdb(external_ip, port)
+                external_ip='external IP of server. ',
+                num_blob_shards=('number of directories blobs are '
+                                 'spread over. ', int),
+                cold_dir=('directory of cold tier, where blobs that '
+                          'are not read are demoted to. '))
+    def initdb(self, external_ip=None, port=7532, num_blob_shards=None,
+               cold_dir=None):
+        kwargs = {}
+        if num_blob_shards is not None:
+            kwargs['num_blob_shards'] = num_blob_shards
+        self.store.initdb(external_ip, port, cold_blob_dir=cold_dir,
+                          **kwargs)
 
     @ca.command(email='email of user')
     def add_user(self, email, password=None, full_name=None):
@@ -99,12 +115,149 @@ class DaemonApp():
             actions = PrivilegedAccess.system_access(ctx)
             pull(actions, ensure_cakepath(cake), dir)
 
-    @ca.command('start server')
-    def start(self):
-        server = CakeServer(self.store)
+    @ca.command('start server',
+                bloom_capacity=('keep bloom filter of stored blobs '
+                                'sized for that many addresses, '
+                                'server has to be the only writer '
+                                'into the store. ', int),
+                pack_max_blob_size=('append blobs smaller then that '
+                                    'into pack files instead of '
+                                    'keeping them as separate '
+                                    'files. ', int),
+                group_commit_count=('commit small blobs in batches of '
+                                    'up to that many blobs per shard, '
+                                    'blobs are committed at least '
+                                    'once a second. ', int),
+                durability=('when file blobs are fsynced. ', str,
+                            [d.name for d in Durability]),
+                compression=('compress new blobs with that codec. ',
+                             str, [c.name for c in Codec]),
+                chunk_avg_size=('split big blobs into content defined '
+                                'chunks of about that size, so '
+                                'chunks shared by different versions '
+                                'of file are stored once. ', int),
+                io_threads=('number of threads that read and write '
+                            'blobs for server. ', int),
+                promote_on_read=('move cold blobs that are read back '
+                                 'into hot tier. ', Switch))
+    def start(self, bloom_capacity=None, pack_max_blob_size=None,
+              group_commit_count=None, durability=None,
+              compression=None, chunk_avg_size=None, io_threads=8,
+              promote_on_read=False):
+        if bloom_capacity is not None:
+            self.store.blob_options['bloom_capacity'] = bloom_capacity
+        if pack_max_blob_size is not None:
+            self.store.blob_options['pack_max_blob_size'] = \
+                pack_max_blob_size
+        if group_commit_count is not None:
+            self.store.blob_options['group_commit_count'] = \
+                group_commit_count
+        if durability is not None:
+            self.store.blob_options['durability'] = durability
+        if compression is not None:
+            self.store.blob_options['compression'] = compression
+        if chunk_avg_size is not None:
+            self.store.blob_options['chunk_avg_size'] = chunk_avg_size
+        if promote_on_read:
+            self.store.blob_options['promote_on_read'] = True
+        server = CakeServer(self.store, io_threads=io_threads)
         server.shutdown(wait_until_down=True)
         server.run_server()
 
+    @ca.command('compact pack files',
+                min_live_ratio=('rewrite packs where live entries '
+                                'take less then that fraction of '
+                                'pack size. ', float))
+    def repack(self, min_live_ratio=0.5):
+        removed, reclaimed = \
+            self.store.blob_store().repack(min_live_ratio)
+        self.store.close()
+        print('Packs removed: %d\nBytes reclaimed: %d' %
+              (removed, reclaimed))
+
+    @ca.command('collect garbage: remove blobs that are not '
+                'reachable from portals',
+                max_seconds=('stop after that many seconds, next run '
+                             'resumes from there. ', int),
+                retention_days=('keep content of portal history and '
+                                'volatile tree changes for that many '
+                                'days. ', int),
+                restart=('drop progress of unfinished '
+                         'collection. ', Switch))
+    def gc(self, max_seconds=None, retention_days=30, restart=False):
+        collector = GarbageCollector(self.store,
+                                     retention_days=retention_days)
+        state = collector.run(max_seconds, restart=restart)
+        self.store.close()
+        print('Phase: %s\nMarked: %d\nSwept: %d' %
+              (state['phase'], state['marked'], state['swept']))
+
+    @ca.command('verify content of stored blobs and quarantine '
+                'corrupt ones',
+                bytes_per_sec=('read at most that many bytes per '
+                               'second. ', int),
+                workers=('number of shards scrubbed in '
+                         'parallel. ', int),
+                max_seconds=('stop after that many seconds, next run '
+                             'resumes from there. ', int),
+                restart=('start new pass even if current one is not '
+                         'finished. ', Switch))
+    def scrub(self, bytes_per_sec=None, workers=4, max_seconds=None,
+              restart=False):
+        scrubber = Scrubber(self.store.blob_store(),
+                            bytes_per_sec=bytes_per_sec,
+                            workers=workers)
+        state = scrubber.run(max_seconds, restart=restart)
+        self.store.close()
+        print('Pass: %d%s\nChecked: %d\nBytes: %d\nCorrupt: %d' %
+              (state['pass_no'],
+               '' if state['finished_dt'] is None else ' finished',
+               state['checked'], state['checked_bytes'],
+               state['corrupt']))
+
+    @ca.command('move blobs that were not read for a while into '
+                'cold tier',
+                idle_days=('demote blobs that were neither created '
+                           'nor read for that many days. ', float),
+                max_seconds=('stop after that many seconds, next run '
+                             'continues from there. ', int))
+    def demote(self, idle_days=30, max_seconds=None):
+        tiering = Tiering(self.store.blob_store(),
+                          idle=datetime.timedelta(days=idle_days))
+        demoted, demoted_bytes = tiering.run(max_seconds)
+        self.store.close()
+        print('Demoted: %d\nBytes: %d' % (demoted, demoted_bytes))
+
+    @ca.command('change number of blob shards, blobs are moved '
+                'into new shards while store stays readable',
+                num_blob_shards=('new number of shards, without it '
+                                 'unfinished migration is '
+                                 'resumed. ', int),
+                max_seconds=('stop after that many seconds, next run '
+                             'resumes from there. ', int))
+    def reshard(self, num_blob_shards=None, max_seconds=None):
+        migration = ShardMigration(self.store)
+        if num_blob_shards is not None:
+            migration.start(num_blob_shards)
+        if CakeServer(self.store).running_pid() is not None:
+            # running server picks up migration and runs it
+            print('Server is running, it migrates shards '
+                  'in background')
+            state = migration.state()
+        else:
+            state = migration.run(max_seconds)
+        self.store.close()
+        print('Shards: %d\nMigrating from: %s\nMigrated: %s' %
+              (state['num_shards'], state['prev_num_shards'],
+               state['migrated']))
+
+    @ca.command('build sorted index of blob addresses, writers '
+                'keep it up to date after that')
+    def reindex(self):
+        count = self.store.blob_store().rebuild_index()
+        self.store.close()
+        print('Indexed: %d' % count)
+
     @ca.command('stop server')
     def stop(self):
         server = CakeServer(self.store)
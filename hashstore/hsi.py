@@ -218,7 +218,8 @@ class ClientApp:
                 log.warning(' Server does not have %s stored.'%cake)
             else:
                 fp = open(file, 'rb')
-                stored = self.remote().write_content(fp)
+                stored = self.remote().write_content(
+                    fp, expected=cake)
 
         print('CPath: {cake_path!s} \nCake: {cake!s}\n'
                 .format(**locals()) )
@@ -15,8 +15,14 @@ def test_docs():
     import doctest
     import hashstore.utils as utils
     import hashstore.utils.ignore_file as ignore_file
-
-    for t in (utils, ignore_file):
+    import hashstore.utils.bloom as bloom
+    import hashstore.utils.cache as cache
+    import hashstore.utils.throttle as throttle
+    import hashstore.utils.compress as compress
+    import hashstore.utils.chunking as chunking
+
+    for t in (utils, ignore_file, bloom, cache, throttle,
+              compress, chunking):
         r = doctest.testmod(t)
         ok_(r.attempted > 0, f'There is no doctests in module {t}')
         eq_(r.failed,0)
@@ -0,0 +1,107 @@
+"""
+Bloom filter over hash bytes
+"""
+import math
+import os
+import struct
+import threading
+from typing import Optional
+
+_MAGIC = b'HSBLOOM1'
+_HEADER = struct.Struct('>8sQII')
+
+
+class BloomFilter:
+    """
+    Probabilistic set of hash bytes. Keys has to be uniformly
+    distributed (sha256 digests), so bit positions are derived
+    straight from key bytes without rehashing.
+
+    >>> from hashkernel.hashing import Hasher
+    >>> bf = BloomFilter(capacity=1000)
+    >>> (bf.num_bits, bf.num_hashes)
+    (14378, 10)
+    >>> keys = [Hasher(b'%d' % i).digest() for i in range(1000)]
+    >>> for k in keys: bf.add(k)
+    >>> all(k in bf for k in keys)
+    True
+    >>> len(bf)
+    1000
+    >>> misses = [Hasher(b'x%d' % i).digest() for i in range(10000)]
+    >>> sum(k in bf for k in misses) < 30
+    True
+
+    Survives save and load:
+    >>> import tempfile, os
+    >>> path = os.path.join(tempfile.mkdtemp(), 'bloom')
+    >>> bf.save(path)
+    >>> bf2 = BloomFilter.load(path)
+    >>> all(k in bf2 for k in keys), len(bf2)
+    (True, 1000)
+    >>> BloomFilter.load(path + '.nothing') is None
+    True
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.001,
+                 num_bits: Optional[int] = None,
+                 num_hashes: Optional[int] = None) -> None:
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate)
+                                     / (math.log(2) ** 2)))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(
+                num_bits / capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, hash_bytes: bytes):
+        h1 = int.from_bytes(hash_bytes[0:8], 'big')
+        h2 = int.from_bytes(hash_bytes[8:16], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, hash_bytes: bytes) -> None:
+        new = False
+        with self.lock:
+            for pos in self._positions(hash_bytes):
+                mask = 1 << (pos & 7)
+                if not self.bits[pos >> 3] & mask:
+                    self.bits[pos >> 3] |= mask
+                    new = True
+            if new:
+                self.count += 1
+
+    def __contains__(self, hash_bytes: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(hash_bytes))
+
+    def __len__(self):
+        return self.count
+
+    def save(self, path: str) -> None:
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(_HEADER.pack(_MAGIC, self.num_bits,
+                                  self.num_hashes, self.count))
+            fp.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['BloomFilter']:
+        try:
+            with open(path, 'rb') as fp:
+                magic, num_bits, num_hashes, count = _HEADER.unpack(
+                    fp.read(_HEADER.size))
+                if magic != _MAGIC:
+                    return None
+                bf = cls(0, num_bits=num_bits, num_hashes=num_hashes)
+                bits = fp.read()
+        except (OSError, struct.error):
+            return None
+        if len(bits) != len(bf.bits):
+            return None
+        bf.bits[:] = bits
+        bf.count = count
+        return bf
@@ -0,0 +1,219 @@
+"""
+Byte budgeted cache with frequency based admission
+"""
+import threading
+from collections import OrderedDict
+from typing import (Any, Callable, Dict, Hashable, List, Optional,
+                    Tuple)
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of access frequencies with small saturating
+    counters. Counters are halved every `sample_size` increments,
+    so old popularity fades away.
+
+    >>> fs = FrequencySketch(1024)
+    >>> for _ in range(5): fs.increment('a')
+    >>> fs.increment('b')
+    >>> fs.frequency('a'), fs.frequency('b'), fs.frequency('c')
+    (5, 1, 0)
+    >>> for _ in range(20): fs.increment('a')
+    >>> fs.frequency('a')
+    15
+    >>> fs.reset()
+    >>> fs.frequency('a'), fs.frequency('b')
+    (7, 0)
+    """
+    def __init__(self, width: int, depth: int = 4,
+                 max_count: int = 15) -> None:
+        self.width = width
+        self.max_count = max_count
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _indexes(self, key: Hashable):
+        h = hash(key) & 0xffffffffffffffff
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        for i, row in enumerate(self.rows):
+            yield row, (h1 + i * h2) % self.width
+
+    def increment(self, key: Hashable) -> None:
+        for row, i in self._indexes(key):
+            if row[i] < self.max_count:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def frequency(self, key: Hashable) -> int:
+        return min(row[i] for row, i in self._indexes(key))
+
+    def reset(self) -> None:
+        for row in self.rows:
+            row[:] = bytes(c >> 1 for c in row)
+        self.additions //= 2
+
+
+class BlobCache:
+    """
+    Cache bounded by total size of values, not by number of
+    entries. Layout follows W-TinyLFU: new entries land in small
+    LRU window, entries pushed out of window are admitted into main
+    segmented LRU (probation and protected parts) only if they
+    accessed more often then entries they would evict. One-off
+    sequential reads therefore churn only the window and don't
+    flush hot entries.
+
+    >>> c = BlobCache(1000, window_ratio=0.1)
+    >>> for k in 'abcd': c[k] = b'x' * 200
+    >>> for _ in range(3): hot = c['a'], c['b']
+    >>> for i in range(50): c['scan%d' % i] = b'y' * 100
+    >>> 'a' in c, 'b' in c
+    (True, True)
+    >>> c.size <= 1000
+    True
+    >>> c['nothing']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'nothing'
+    >>> s = c.stats()
+    >>> s['hits'], s['misses'], s['evictions'] > 0
+    (6, 1, True)
+
+    Values bigger then whole budget are not cached:
+    >>> c['huge'] = b'z' * 1001
+    >>> 'huge' in c
+    False
+    """
+    def __init__(self, max_bytes: int,
+                 sizeof: Callable[[Any], int] = len,
+                 window_ratio: float = 0.01,
+                 protected_ratio: float = 0.8,
+                 sketch_width: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.window_max = max(1, int(max_bytes * window_ratio))
+        self.main_max = max_bytes - self.window_max
+        self.protected_max = int(self.main_max * protected_ratio)
+        if sketch_width is None:
+            sketch_width = max(1024, max_bytes >> 12)
+        self.sketch = FrequencySketch(sketch_width)
+        self.window = OrderedDict()  # type: OrderedDict
+        self.probation = OrderedDict()  # type: OrderedDict
+        self.protected = OrderedDict()  # type: OrderedDict
+        self.window_bytes = 0
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @property
+    def size(self) -> int:
+        return self.window_bytes + self.probation_bytes + \
+               self.protected_bytes
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + \
+               len(self.protected)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.window or key in self.probation or \
+               key in self.protected
+
+    def __getitem__(self, key: Hashable) -> Any:
+        with self.lock:
+            self.sketch.increment(key)
+            if key in self.window:
+                self.window.move_to_end(key)
+                value, _ = self.window[key]
+            elif key in self.protected:
+                self.protected.move_to_end(key)
+                value, _ = self.protected[key]
+            elif key in self.probation:
+                value, size = self.probation.pop(key)
+                self.probation_bytes -= size
+                self._protect(key, value, size)
+            else:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self.lock:
+            self.discard(key)
+            if size > self.main_max and size > self.window_max:
+                return
+            self.window[key] = (value, size)
+            self.window_bytes += size
+            while self.window_bytes > self.window_max:
+                k, (v, s) = self.window.popitem(last=False)
+                self.window_bytes -= s
+                self._admit(k, v, s)
+
+    def discard(self, key: Hashable) -> None:
+        with self.lock:
+            for segment, attr in ((self.window, 'window_bytes'),
+                                  (self.probation, 'probation_bytes'),
+                                  (self.protected, 'protected_bytes')):
+                if key in segment:
+                    _, size = segment.pop(key)
+                    setattr(self, attr, getattr(self, attr) - size)
+                    return
+
+    def clear(self) -> None:
+        with self.lock:
+            self.window.clear()
+            self.probation.clear()
+            self.protected.clear()
+            self.window_bytes = 0
+            self.probation_bytes = 0
+            self.protected_bytes = 0
+
+    def _protect(self, key, value, size):
+        self.protected[key] = (value, size)
+        self.protected_bytes += size
+        while self.protected_bytes > self.protected_max:
+            k, (v, s) = self.protected.popitem(last=False)
+            self.protected_bytes -= s
+            self.probation[k] = (v, s)
+            self.probation_bytes += s
+
+    def _admit(self, key, value, size):
+        if size > self.main_max:
+            self.evictions += 1
+            return
+        victims = []  # type: List[Tuple[OrderedDict, Hashable]]
+        free = self.main_max - self.probation_bytes - self.protected_bytes
+        for segment in (self.probation, self.protected):
+            for k, (_, s) in segment.items():
+                if free >= size:
+                    break
+                victims.append((segment, k))
+                free += s
+        if victims:
+            frequency = self.sketch.frequency(key)
+            if any(self.sketch.frequency(k) >= frequency
+                   for _, k in victims):
+                self.evictions += 1
+                return
+            for segment, k in victims:
+                _, s = segment.pop(k)
+                if segment is self.probation:
+                    self.probation_bytes -= s
+                else:
+                    self.protected_bytes -= s
+                self.evictions += 1
+        self.probation[key] = (value, size)
+        self.probation_bytes += size
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self),
+                'bytes': self.size}
@@ -0,0 +1,133 @@
+"""
+Content defined chunking
+"""
+import io
+from hashlib import sha256
+from typing import Iterable, Iterator, List, Optional
+
+# every byte value is mapped to one pseudo random bit
+_BIT_TABLE = bytes(sha256(bytes([i])).digest()[0] & 1
+                   for i in range(256))
+
+_PATTERN_SOURCE = bytes(b & 1
+                        for b in sha256(b'hashstore.cut').digest())
+
+
+class Chunker:
+    """
+    Splits stream into chunks at content defined positions, so
+    boundaries move along with content: insert or change in one
+    place of a stream changes only chunks around it, and the rest
+    of chunks dedupe with previous version.
+
+    Stream is cut after every window of `log2(avg_size - min_size)`
+    bytes that (each byte mapped to one bit by fixed random table)
+    spells fixed random pattern. Such rolling condition is searched
+    with `bytes.translate()` and `bytes.find()`, so chunking is not
+    limited by speed of python loop. Chunks are between `min_size`
+    and `max_size`, `avg_size` is approximate.
+
+    >>> import random
+    >>> rnd = random.Random(5)
+    >>> data = bytes(rnd.getrandbits(8) for _ in range(100000))
+    >>> chunker = Chunker(avg_size=4096)
+    >>> chunks = chunker.split(data)
+    >>> b''.join(chunks) == data
+    True
+    >>> 10 < len(chunks) < 50
+    True
+    >>> all(1024 <= len(c) <= 16384 for c in chunks[:-1])
+    True
+
+    Fed in pieces, stream is cut at the same places:
+    >>> pieces = [data[i:i + 999] for i in range(0, len(data), 999)]
+    >>> chunks == [c for p in pieces for c in chunker.feed(p)] + \\
+    ...     list(chunker.flush())
+    True
+
+    Change in the middle keeps most of chunks:
+    >>> edited = data[:50000] + b'edit' + data[50000:]
+    >>> len(set(chunks) - set(chunker.split(edited))) <= 2
+    True
+    """
+    def __init__(self, avg_size: int = 1 << 20,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None) -> None:
+        self.min_size = avg_size // 4 if min_size is None else min_size
+        self.max_size = avg_size * 4 if max_size is None else max_size
+        bits = max(1, (avg_size - self.min_size).bit_length() - 1)
+        self.pattern = _PATTERN_SOURCE[:bits]
+        self.buffer = bytearray()
+        self.bits = bytearray()
+        self.pos = 0
+
+    def _find_cut(self) -> Optional[int]:
+        n = len(self.buffer)
+        width = len(self.pattern)
+        start = max(self.pos, self.min_size - width)
+        i = self.bits.find(self.pattern, start, self.max_size)
+        if i >= 0:
+            return i + width
+        if n >= self.max_size:
+            return self.max_size
+        self.pos = max(start, n - width + 1)
+        return None
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """
+        :return: chunks completed by `data`
+        """
+        self.buffer += data
+        self.bits += data.translate(_BIT_TABLE)
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return
+            chunk = bytes(self.buffer[:cut])
+            del self.buffer[:cut]
+            del self.bits[:cut]
+            self.pos = 0
+            yield chunk
+
+    def flush(self) -> Iterator[bytes]:
+        """
+        :return: last chunk, if anything left
+        """
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer = bytearray()
+            self.bits = bytearray()
+            self.pos = 0
+            yield chunk
+
+    def split(self, data: bytes) -> List[bytes]:
+        return list(self.feed(data)) + list(self.flush())
+
+
+class IterStream(io.RawIOBase):
+    """
+    Readable stream over iterable of byte chunks
+
+    >>> fp = io.BufferedReader(IterStream([b'ab', b'', b'cde']))
+    >>> fp.read(3), fp.read()
+    (b'abc', b'de')
+    """
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.chunk):
+            try:
+                self.chunk = next(self.chunks)
+            except StopIteration:
+                return 0
+            self.offset = 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
@@ -0,0 +1,179 @@
+"""
+Stdlib compression codecs for stored blobs
+"""
+import bz2
+import enum
+import io
+import lzma
+import os
+import struct
+import zlib
+from typing import IO, Optional, Tuple
+
+MAGIC = b'\x00HSBLOB\x00'
+HEADER = struct.Struct('>8sBQ')
+SAMPLE_SIZE = 1 << 16
+MIN_SIZE = 128
+DECODE_ERRORS = (OSError, EOFError, ValueError, zlib.error,
+                 lzma.LZMAError)
+
+
+class Codec(enum.IntEnum):
+    """
+    >>> data = b'{"log": "line"}\\n' * 1000
+    >>> all(c.decompress(c.compress(data)) == data for c in Codec)
+    True
+    >>> [len(c.compress(data)) < len(data) // 10 for c in Codec]
+    [True, True, True]
+    """
+    zlib = 1
+    lzma = 2
+    bz2 = 3
+
+    def compressor(self):
+        if self == Codec.zlib:
+            return zlib.compressobj(6)
+        elif self == Codec.lzma:
+            return lzma.LZMACompressor()
+        else:
+            return bz2.BZ2Compressor()
+
+    def decompressor(self):
+        if self == Codec.zlib:
+            return zlib.decompressobj()
+        elif self == Codec.lzma:
+            return lzma.LZMADecompressor()
+        else:
+            return bz2.BZ2Decompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor().decompress(data)
+
+
+def worth_compressing(sample: bytes, min_ratio: float = 0.9) -> bool:
+    """
+    Cheap check on first `SAMPLE_SIZE` bytes of content: fast zlib
+    has to shrink it at least to `min_ratio`, so compressed
+    media and random bytes are stored as is.
+
+    >>> worth_compressing(b'abc' * 1000)
+    True
+    >>> worth_compressing(os.urandom(10000))
+    False
+    >>> worth_compressing(b'abc')
+    False
+    """
+    sample = sample[:SAMPLE_SIZE]
+    if len(sample) < MIN_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * min_ratio
+
+
+def compress_if_worth(codec: Codec, data: bytes,
+                      min_ratio: float = 0.9) -> Optional[bytes]:
+    """
+    :return: compressed `data` or `None` if it does not compress
+             at least to `min_ratio`
+
+    >>> len(compress_if_worth(Codec.zlib, b'abc' * 1000)) < 100
+    True
+    >>> compress_if_worth(Codec.lzma, os.urandom(1000)) is None
+    True
+    """
+    if not worth_compressing(data, min_ratio):
+        return None
+    compressed = codec.compress(data)
+    if len(compressed) > len(data) * min_ratio:
+        return None
+    return compressed
+
+
+def pack_header(codec: Optional[Codec], size: int) -> bytes:
+    return HEADER.pack(MAGIC, 0 if codec is None else codec, size)
+
+
+def read_header(fp: IO[bytes]) -> Optional[Tuple[Optional[Codec], int]]:
+    """
+    Files that start with `MAGIC` carry header with codec (`None`
+    for content stored as is) and size of uncompressed content.
+    Header is consumed, for other files stream is left at `0`.
+
+    >>> h = read_header(io.BytesIO(pack_header(Codec.bz2, 5) + b'.'))
+    >>> h
+    (<Codec.bz2: 3>, 5)
+    >>> fp = io.BytesIO(b'plain')
+    >>> read_header(fp) is None, fp.tell()
+    (True, 0)
+    """
+    head = fp.read(HEADER.size)
+    if len(head) == HEADER.size and head.startswith(MAGIC):
+        _, codec, size = HEADER.unpack(head)
+        return (Codec(codec) if codec else None), size
+    fp.seek(0)
+    return None
+
+
+class DecompressingReader(io.RawIOBase):
+    def __init__(self, fp: IO[bytes], codec: Codec,
+                 chunk_size: int = 1 << 16) -> None:
+        self.fp = fp
+        self.decompressor = codec.decompressor()
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.buffer):
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.buffer = self.decompressor.decompress(chunk)
+            self.offset = 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        self.fp.close()
+        io.RawIOBase.close(self)
+
+
+def open_encoded(path: str) -> IO[bytes]:
+    """
+    Open file that might have header and return stream of
+    uncompressed content.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'blob')
+    >>> with open(path, 'wb') as fp:
+    ...     _ = fp.write(pack_header(Codec.zlib, 6000))
+    ...     _ = fp.write(Codec.zlib.compress(b'abc' * 2000))
+    >>> with open_encoded(path) as fp:
+    ...     data = fp.read()
+    >>> data == b'abc' * 2000, logical_size(path)
+    (True, 6000)
+    """
+    fp = open(path, 'rb')
+    header = read_header(fp)
+    if header is None or header[0] is None:
+        return fp
+    return io.BufferedReader(DecompressingReader(fp, header[0]))
+
+
+def logical_size(path: str) -> int:
+    """
+    :return: size of uncompressed content of file
+    """
+    with open(path, 'rb') as fp:
+        header = read_header(fp)
+        if header is None:
+            return os.fstat(fp.fileno()).st_size
+        return header[1]
@@ -43,25 +43,55 @@ class IntCast(TypeDecorator):
 
 class Dbf:
 
-    def __init__(self,meta,path):
+    def __init__(self, meta, path, **engine_kwargs):
         if ismodule(meta):
             meta = meta.Base.metadata
         self.path = path
         self.meta = meta
+        self.engine_kwargs = engine_kwargs
         self._engine = None
         self._Session = None
 
     def engine(self):
         if self._engine is None:
-            self._engine = create_engine('sqlite:///%s' % self.path)
+            self._engine = create_engine('sqlite:///%s' % self.path,
+                                         **self.engine_kwargs)
         return self._engine
 
+    def dispose(self):
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+            self._Session = None
+
     def exists(self):
         return os.path.exists(self.path)
 
     def ensure_db(self):
         self.meta.create_all(self.engine())
 
+    def add_missing_columns(self):
+        '''
+        add columns that were appended to tables of `meta` after
+        db was created, such columns have to be nullable
+
+        :return: names of added columns
+        '''
+        added = []
+        with self.engine().begin() as conn:
+            for table in self.meta.sorted_tables:
+                columns = {r[1] for r in conn.execute(
+                    f'PRAGMA table_info({table.name})')}
+                if not columns:
+                    continue
+                for c in table.c:
+                    if c.name not in columns:
+                        col_type = c.type.compile(dialect=conn.dialect)
+                        conn.execute(f'ALTER TABLE {table.name} '
+                                     f'ADD COLUMN {c.name} {col_type}')
+                        added.append(f'{table.name}.{c.name}')
+        return added
+
     def execute(self, statement, *multiparams, **params):
         return self.engine().execute(statement, *multiparams, **params)
 
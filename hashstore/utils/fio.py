@@ -73,6 +73,20 @@ class ConfigDir:
         return None
 
 
+def fsync_path(path: str)->None:
+    """
+    `fsync` file or directory by its path. Directories cannot
+    be opened on Windows, so they are skipped there.
+    """
+    if os.name == 'nt' and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def read_in_chunks(fp, chunk_size=65535):
     while True:
         data = fp.read(chunk_size)
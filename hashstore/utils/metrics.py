@@ -0,0 +1,247 @@
+"""
+In-process counters, gauges and histograms, rendered in text
+exposition format of Prometheus
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# upper bounds of latency buckets in seconds, from 50us to 10s
+LATENCY_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005,
+                   .01, .025, .05, .1, .25, .5, 1., 2.5, 10.)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(kwargs) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(f'{k}="{v}"' for k, v in pairs)
+
+
+def _format_value(v) -> str:
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels
+
+    >>> c = Counter('reads_total')
+    >>> c.inc(); c.inc(2, tier='db'); c.inc(tier='db')
+    >>> c.value(), c.value(tier='db'), c.value(tier='file')
+    (1, 3, 0)
+    >>> print(c.render())
+    # TYPE reads_total counter
+    reads_total 1
+    reads_total{tier="db"} 3
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str = '') -> None:
+        self.name = name
+        self.help = help
+        self.values = OrderedDict()  # type: Dict[Labels, float]
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(_labels(labels), 0)
+
+    def snapshot(self):
+        with self.lock:
+            return {_format_labels(k): v for k, v in self.values.items()}
+
+    def _header(self) -> List[str]:
+        lines = []
+        if self.help:
+            lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        return lines
+
+    def render(self) -> str:
+        lines = self._header()
+        with self.lock:
+            for labels, v in self.values.items():
+                lines.append(f'{self.name}{_format_labels(labels)} '
+                             f'{_format_value(v)}')
+        return '\n'.join(lines)
+
+
+class Gauge(Counter):
+    """
+    Value that is read from `fn` when metrics are collected, `kind`
+    is `counter` for counts that are kept elsewhere
+
+    >>> g = Gauge('open_shards', lambda: 3)
+    >>> g.snapshot()
+    {'': 3}
+    >>> print(g.render())
+    # TYPE open_shards gauge
+    open_shards 3
+    """
+    def __init__(self, name: str, fn: Callable[[], float],
+                 help: str = '', kind: str = 'gauge') -> None:
+        Counter.__init__(self, name, help)
+        self.fn = fn
+        self.kind = kind
+
+    def snapshot(self):
+        return {'': self.fn()}
+
+    def render(self) -> str:
+        lines = self._header()
+        lines.append(f'{self.name} {_format_value(self.fn())}')
+        return '\n'.join(lines)
+
+
+class Histogram(Counter):
+    """
+    Distribution of observed values over fixed buckets, optionally
+    split by labels. Bucket counts are cumulative, as in Prometheus.
+
+    >>> h = Histogram('lookup_seconds', buckets=(.001, .01))
+    >>> for v in (.0005, .002, .5): h.observe(v, tier='db')
+    >>> h.snapshot()['{tier="db"}']
+    {'buckets': [(0.001, 1), (0.01, 2), ('+Inf', 3)], 'sum': 0.5025, 'count': 3}
+    >>> print(h.render())
+    # TYPE lookup_seconds histogram
+    lookup_seconds_bucket{tier="db",le="0.001"} 1
+    lookup_seconds_bucket{tier="db",le="0.01"} 2
+    lookup_seconds_bucket{tier="db",le="+Inf"} 3
+    lookup_seconds_sum{tier="db"} 0.5025
+    lookup_seconds_count{tier="db"} 3
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str = '',
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        Counter.__init__(self, name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = \
+                    [[0] * (len(self.buckets) + 1), 0.]
+            state[0][i] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        observe time spent in `with` block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _cumulative(self, counts):
+        total = 0
+        for bound, n in zip(self.buckets + ('+Inf',), counts):
+            total += n
+            yield bound, total
+
+    def snapshot(self):
+        with self.lock:
+            return {_format_labels(k): {
+                        'buckets': list(self._cumulative(counts)),
+                        'sum': round(s, 9),
+                        'count': sum(counts)}
+                    for k, (counts, s) in self.values.items()}
+
+    def render(self) -> str:
+        lines = self._header()
+        with self.lock:
+            for labels, (counts, s) in self.values.items():
+                for bound, n in self._cumulative(counts):
+                    le = (('le', _format_value(bound)),)
+                    lines.append(f'{self.name}_bucket'
+                                 f'{_format_labels(labels, le)} {n}')
+                tags = _format_labels(labels)
+                lines.append(f'{self.name}_sum{tags} '
+                             f'{_format_value(round(s, 9))}')
+                lines.append(f'{self.name}_count{tags} {sum(counts)}')
+        return '\n'.join(lines)
+
+
+class Metrics:
+    """
+    Registry of metrics. Asking for metric that is already
+    registered returns existing one, so components could share
+    registry.
+
+    >>> m = Metrics()
+    >>> m.counter('writes_total', 'blobs written').inc(tier='db')
+    >>> m.counter('writes_total').inc(tier='db')
+    >>> m.gauge('cached_bytes', lambda: 100)
+    >>> m.snapshot()
+    {'writes_total': {'{tier="db"}': 2}, 'cached_bytes': {'': 100}}
+    >>> print(m.render())
+    # HELP writes_total blobs written
+    # TYPE writes_total counter
+    writes_total{tier="db"} 2
+    # TYPE cached_bytes gauge
+    cached_bytes 100
+    <BLANKLINE>
+    """
+    def __init__(self) -> None:
+        self.metrics = OrderedDict()  # type: Dict[str, Counter]
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f'{name} is {metric.kind}')
+            return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str = '',
+                  buckets: Sequence[float] = LATENCY_BUCKETS
+                  ) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def gauge(self, name: str, fn: Callable[[], float],
+              help: str = '', kind: str = 'gauge') -> None:
+        with self.lock:
+            self.metrics[name] = Gauge(name, fn, help, kind)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        :return: values of all metrics by name and by labels
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+    def render(self) -> str:
+        """
+        :return: all metrics in text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(m.render() + '\n' for m in metrics)
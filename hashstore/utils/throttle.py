@@ -0,0 +1,50 @@
+"""
+Rate limiting of background work
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+
+class RateLimiter:
+    """
+    Caps rate of consumed units (bytes) shared by any number of
+    threads. Every `consume()` reserves next slot on common
+    schedule and sleeps until it comes, so callers never burst
+    over `rate` regardless how many of them run in parallel.
+
+    >>> clock = [0.]
+    >>> def sleep(s): clock[0] += s
+    >>> rl = RateLimiter(1000, clock=lambda: clock[0], sleep=sleep)
+    >>> for _ in range(5): rl.consume(500)
+    >>> clock[0]
+    2.0
+
+    Idle time is not accumulated as credit:
+    >>> clock[0] += 60
+    >>> rl.consume(500); rl.consume(500)
+    >>> clock[0]
+    62.5
+
+    `None` rate means unlimited:
+    >>> RateLimiter(None).consume(1 << 40)
+    """
+    def __init__(self, rate: Optional[float],
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.next_slot = None  # type: Optional[float]
+        self.lock = threading.Lock()
+
+    def consume(self, units: int) -> None:
+        if self.rate is None:
+            return
+        with self.lock:
+            now = self.clock()
+            start = now if self.next_slot is None \
+                else max(now, self.next_slot)
+            self.next_slot = start + units / self.rate
+        if start > now:
+            self.sleep(start - now)